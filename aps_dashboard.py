@@ -9,24 +9,46 @@ Creates the DAQ instance, radar object, and configures main GUI window.
 Author: Jason Merlo
 Maintainer: Jason Merlo (merlojas@msu.edu)
 """
+# === Startup Profiling ===
+import sys                              # Exit gracefully
+import startup_profile                  # Lazy imports / start-up timing
+profiler = startup_profile.install()
+lazy_import = startup_profile.lazy_import
 # === Window / UI ===
-import pyqtgraph as pg                  # GUI event timer
+pg = lazy_import('pyqtgraph')           # GUI event timer
 import signal                           # Handle ctrl-c
-import sys                              # Exit gracefully
+import argparse                         # Command line options
 # === Error Handling ===
 import traceback                        # Handling errors gracefully
 # === Sampling / Hardware ===
-from pyratk.acquisition.data_mgr import DataManager
-from pyratk.acquisition.mcdaq_win import mcdaq_win
-from pyratk.radars import radar    # RadaryArray object
+data_mgr = lazy_import('pyratk.acquisition.data_mgr')
+mcdaq = lazy_import('pyratk.acquisition.mcdaq_win')
+net_daq = lazy_import('net_daq')
+radar = lazy_import('pyratk.radars.radar')  # RadaryArray object
 # === Tracking ===
-from pyratk.trackers import aps_tracker  # 2D tracker object
+aps_tracker = lazy_import('pyratk.trackers.aps_tracker')  # 2D tracker object
 from pyratk.datatypes.radar import TransmitterTuple, ReceiverTuple, Pulse
 # === Geometry primatives ===
 from pyratk.datatypes.geometry import Point  # Radar locations
 from pyratk.datatypes.motion import StateMatrix
 # === GUI Elements ===
-from data_window import DataWindow
+data_window = lazy_import('data_window')
+gui_panels = lazy_import('gui_panels')
+# === Remote Telemetry ===
+telemetry = lazy_import('telemetry')
+# === Multi-Array Fusion ===
+fusion = lazy_import('fusion')
+import dsp                              # Shared radar configuration
+import precision
+# === IQ Calibration ===
+iq_calibration = lazy_import('iq_calibration')
+# === Event Loop ===
+async_loop = lazy_import('async_loop')
+# === Multi-Process Consumers ===
+shm_ring = lazy_import('shm_ring')
+# === Recording ===
+capture_buffer = lazy_import('capture_buffer')
+product_cache = lazy_import('product_cache')
 # === DEBUG ===
 import warnings
 
@@ -37,17 +59,28 @@ from collections import namedtuple
 
 # === CONSTANTS ===============================================================
 DEFAULT_PATH = 'aps_radar_testing.hdf5'
-
-DELAY = 250e-6
+# Modules built into the pipeline, imported off the GUI thread by
+# --fast-start while the window is already shown
+PIPELINE_MODULES = (
+    'pyratk.acquisition.mcdaq_win', 'pyratk.radars.radar',
+    'pyratk.trackers.aps_tracker', 'pyratk.widgets.fft_widget',
+    'pyratk.widgets.spectrogram_widget', 'pyratk.widgets.iq_widget',
+    'pyratk.widgets.range_doppler_widget',
+    'pyratk.widgets.polar_tracker_widget')
+# Interval at which --fast-start checks for the preloaded modules (ms)
+PRELOAD_POLL_MS = 20
+
+# Radar configuration, shared with the offline tools through dsp.py
+DELAY = dsp.PULSE.delay
 PRF = int(1/DELAY)
-BW = 100e6
-FC = 5.825e9
+BW = dsp.PULSE.bw
+FC = dsp.PULSE.fc
 
-DAQ_SAMPLE_RATE = int(100e3)
-DAQ_CHUNK_SIZE = int(DAQ_SAMPLE_RATE * DELAY)
+DAQ_SAMPLE_RATE = dsp.SAMPLE_RATE
+DAQ_CHUNK_SIZE = dsp.CHUNK_SIZE
 
-FAST_FFT_SIZE = 2**11
-SLOW_FFT_SIZE = 2**5
+FAST_FFT_SIZE = dsp.FAST_FFT_SIZE
+SLOW_FFT_SIZE = dsp.SLOW_FFT_SIZE
 
 # FFT_WIN_SIZE = int(DAQ_CHUNK_SIZE * 1)
 # FFT_WIN_SIZE = DAQ_CHUNK_SIZE
@@ -80,8 +113,15 @@ warnings.showwarning = warn_with_traceback
 class Application(object):
     """Main multi-doppler tracker application class."""
 
-    def __init__(self):
+    def __init__(self, args=None):
         """Start application on initialization."""
+        self.args = args if args is not None else parse_args([])
+        self.publisher = None
+        self.fusion_mgr = None
+        self.runtime = None
+        self.ring = None
+        self.capture = None
+        self.calibration = None
         self.run()
 
     def init_signal_handler(self, app):
@@ -95,6 +135,16 @@ class Application(object):
         """Gracefully handle program shutdown by closing all daq sources."""
         print('Closing sources...')
         self.data_mgr.close()
+        if self.publisher is not None:
+            self.publisher.close()
+        if self.fusion_mgr is not None:
+            self.fusion_mgr.close()
+        if self.runtime is not None:
+            self.runtime.close()
+        if self.ring is not None:
+            self.ring.close()
+        if self.capture is not None:
+            self.capture.close()
 
         print('Program exiting...')
         sys.exit(0)
@@ -108,34 +158,159 @@ class Application(object):
         # === INIT ============================================================
         # Create application context and setup sampler and signal handler
         app = pg.QtGui.QApplication([])
+        profiler.mark('Qt application created')
 
         # Create data manager object for DAQ and playback
-        self.data_mgr = DataManager(db=DEFAULT_PATH)
+        self.data_mgr = data_mgr.DataManager(db=DEFAULT_PATH)
+        profiler.mark('data manager created')
+
+        # Viewer mode: products come from a remote acquisition host
+        if self.args.subscribe:
+            self.run_viewer(app)
+            return
+
+        # Fusion mode: one worker process per sensor head
+        if self.args.head:
+            self.run_fusion(app)
+            return
+
+        # Set up program exit routine
+        self.init_signal_handler(app)
 
+        if self.args.async_loop:
+            self.runtime = async_loop.AsyncRuntime(app)
+
+        if self.args.fast_start:
+            # Show the window first; build the pipeline once its modules
+            # have been imported on a background thread
+            self.show_window(app, None, None, deferred=True)
+            preloaded = startup_profile.preload(PIPELINE_MODULES)
+            self.preload_timer = pg.QtCore.QTimer()
+
+            def pipeline_when_loaded():
+                if preloaded.is_set():
+                    self.preload_timer.stop()
+                    profiler.mark('pipeline modules imported')
+                    self.start_pipeline(app)
+
+            self.preload_timer.timeout.connect(pipeline_when_loaded)
+            self.preload_timer.start(PRELOAD_POLL_MS)
+        else:
+            self.start_pipeline(app)
+
+        # ------ Run Qt program ------ #
+        if self.runtime is not None:
+            sys.exit(self.runtime.run_forever())
+        sys.exit(app.exec_())
+
+    def iq_correction(self):
+        """
+        Build the IQ correction selected on the command line, if any.
+
+        Each source gets its own corrector, so clutter averages of live
+        data and playback are kept apart.
+        """
+        if self.args.iq_calibration is None and not self.args.clutter_alpha:
+            return None
+        if self.calibration is None and self.args.iq_calibration is not None:
+            self.calibration = iq_calibration.IQCalibration.load(
+                self.data_mgr.db, self.args.iq_calibration)
+            print('IQ calibration {}:'.format(self.args.iq_calibration))
+            print(self.calibration)
+        return iq_calibration.IQCorrector(self.calibration,
+                                          self.args.clutter_alpha)
+
+    def correct_sources(self, *sources):
+        """Apply the IQ correction to every chunk `sources` emit."""
+        for source in sources:
+            corrector = self.iq_correction()
+            if corrector is None:
+                return
+            if iq_calibration.correct_source(source, corrector):
+                self.data_mgr.reset_signal.connect(corrector.reset)
+            else:
+                print('Could not apply IQ correction to',
+                      type(source).__name__)
+
+    def start_daq(self):
+        """Create and start the acquisition source."""
         try:
-            mcdaq_daq = mcdaq_win(sample_rate=DAQ_SAMPLE_RATE,
-                            sample_chunk_size=DAQ_CHUNK_SIZE)
-            self.data_mgr.add_source(mcdaq_daq)
-            self.data_mgr.set_source(mcdaq_daq)
-            self.data_mgr.source.start()
+            if self.args.net_daq:
+                host, _, port = self.args.net_daq.partition(':')
+                daq = net_daq.NetworkDAQ(
+                    host, int(port) if port else net_daq.DEFAULT_PORT,
+                    sample_rate=DAQ_SAMPLE_RATE,
+                    sample_chunk_size=DAQ_CHUNK_SIZE,
+                    iq_correction=self.iq_correction())
+            else:
+                daq = mcdaq.mcdaq_win(sample_rate=DAQ_SAMPLE_RATE,
+                                      sample_chunk_size=DAQ_CHUNK_SIZE)
+                # The NetworkDAQ corrects whole batches itself
+                self.correct_sources(daq)
+            self.data_mgr.add_source(daq)
+            self.data_mgr.set_source(daq)
+            # The asyncio runtime starts and drives acquisition itself
+            if not self.args.async_loop:
+                self.data_mgr.source.start()
         except Exception as e:
             print('Could not start DAQ:', e)
 
+    def show_window(self, app, receivers, tracker, deferred=False):
+        """Instantiate and display data-viewing window."""
+        # (close gracefully on failure)
+        try:
+            self.data_win = data_window.DataWindow(
+                app, self.data_mgr, receivers, tracker, deferred=deferred)
+            self.data_win.setGeometry(160, 140, 1400, 1000)
+            # self.data_win.showMaximized()
+            self.data_win.show()
+            profiler.mark('window shown')
+        except Exception:
+            # Catch all errors and exit for dev purposes
+            print(traceback.format_exc())
+            self.signal_handler()
 
-        # Set up program exit routine
-        self.init_signal_handler(app)
+    def yield_to_gui(self, app):
+        """Let a window shown by --fast-start redraw between start-up stages."""
+        if self.args.fast_start:
+            app.processEvents()
+
+    def start_pipeline(self, app):
+        """Start acquisition, build the radar pipeline and connect the GUI."""
+        self.start_daq()
+        # Dataset playback gets the same correction as live data
+        self.correct_sources(self.data_mgr.virt_daq)
+        profiler.mark('DAQ started')
+        if self.args.fast_start:
+            # The window was built before there was a source
+            self.data_win.control_panel.update_control_attr_labels()
+        self.yield_to_gui(app)
+
+        # Share raw chunks with consumer processes
+        if self.args.shm_ring:
+            try:
+                # A ring of the same name can only be left by a run that
+                # did not close it; readers re-attach to the new one
+                self.ring = shm_ring.RingWriter(
+                    8, DAQ_CHUNK_SIZE, name=self.args.shm_ring, replace=True)
+            except Exception as e:
+                print('Could not create shared ring {}: {}'.format(
+                    self.args.shm_ring, e))
+            else:
+                self.data_mgr.data_available_signal.connect(
+                    self.ring.on_data)
+                print('Writing raw chunks to shared ring', self.ring.name)
 
         # Transmitter parameters
         pulses = (Pulse(FC, BW, DELAY),)
         transmitter_list = (TransmitterTuple(Point(0, 0, 0), pulses),)
 
         # Receiver parameters
-        receiver_list = (
-            ReceiverTuple(daq_index=(1, 3), location=Point(0, 0, 0)),
-            ReceiverTuple(daq_index=(5, 7), location=Point(0, 0, 0)),
-            #ReceiverTuple(daq_index=(0, 2), location=Point(0, 0, 0)),
-            #ReceiverTuple(daq_index=(4, 6), location=Point(0, 0, 0))
-        )
+        # One receiver per (I, Q) pair; DAQ channels (0, 2) and (4, 6) are
+        # not used
+        receiver_list = tuple(
+            ReceiverTuple(daq_index=iq, location=Point(0, 0, 0))
+            for iq in dsp.DAQ_INDEX)
 
         receiver_array = radar.Radar(
             self.data_mgr,
@@ -145,34 +320,197 @@ class Application(object):
             slow_fft_size=SLOW_FFT_SIZE,
             slow_fft_len=SLOW_FFT_SIZE
         )
+        self.yield_to_gui(app)
 
         tracker = aps_tracker.ApsTracker(self.data_mgr, receiver_array)
+        profiler.mark('radar pipeline created')
+        self.yield_to_gui(app)
 
         # === GUI =============================================================
-        # Instantiate and display data-viewing window
-        # (close gracefully on failure)
-        try:
-            self.data_win = DataWindow(
-                app, self.data_mgr, (*receiver_array.receivers[0:2],), tracker)
-            self.data_win.setGeometry(160, 140, 1400, 1000)
-            # self.data_win.showMaximized()
-            self.data_win.show()
-        except Exception:
-            # Catch all errors and exit for dev purposes
-            print(traceback.format_exc())
-            self.signal_handler()
+        receivers = (*receiver_array.receivers[0:2],)
+        if self.args.fast_start:
+            self.data_win.set_pipeline(receivers, tracker)
+        else:
+            self.show_window(app, receivers, tracker)
+        profiler.mark('plots created')
+
+        # Keep the live capture under a memory cap, spilling to disk
+        if self.args.capture_cap is not None:
+            self.capture = capture_buffer.BufferedCapture(
+                self.data_mgr, max_memory=int(self.args.capture_cap * 2**20))
+            self.data_win.control_panel.capture = self.capture
+
+        # Replay previously processed datasets from the product cache
+        if self.args.product_cache is not False:
+            cache = product_cache.ProductCache(
+                self.args.product_cache or product_cache.DEFAULT_CACHE_DIR,
+                budget=int(self.args.cache_budget * 2**30))
+            config = product_cache.pipeline_config(
+                transmitter_list, receiver_list, 'ApsTracker',
+                fast_fft_size=FAST_FFT_SIZE,
+                slow_fft_size=SLOW_FFT_SIZE,
+                slow_fft_len=SLOW_FFT_SIZE,
+                iq_calibration=self.args.iq_calibration,
+                clutter_alpha=self.args.clutter_alpha)
+            self.data_win.control_panel.set_product_cache(
+                cache, receiver_array.receivers, tracker,
+                product_cache.config_hash(config))
 
         # Connect events for data processing
         # receiver_array.data_available_signal.connect(self.data_win.update)
+        self.timer = pg.QtCore.QTimer()
+        if self.runtime is not None:
+            # Redraws are driven by data arrival instead of polling
+            self.runtime.start(self.data_mgr, self.data_win)
+        else:
+            self.timer.timeout.connect(self.data_win.update)
+            self.timer.start(30)
+
+        # Stream processed products to remote viewers
+        if self.args.publish is not False:
+            port = self.args.publish
+            self.publisher = telemetry.TelemetryPublisher(
+                port=telemetry.DEFAULT_PORT if port is None else port)
+            print('Publishing telemetry on port', self.publisher.port)
+            receivers = receiver_array.receivers
+            telemetry.check_pipeline(receivers, tracker)
+            self.timer.timeout.connect(lambda: self.publisher.publish(
+                telemetry.collect_products(receivers, tracker)))
+            if not self.timer.isActive():
+                self.timer.start(30)
+
+        # Start sampling
+        # daq.start()
+
+        profiler.report()
+
+    def run_viewer(self, app):
+        """Display products streamed from a remote acquisition host."""
+        host, _, port = self.args.subscribe.partition(':')
+        port = int(port) if port else telemetry.DEFAULT_PORT
+
+        source = telemetry.TelemetrySource(
+            host, port, sample_rate=DAQ_SAMPLE_RATE,
+            sample_chunk_size=DAQ_CHUNK_SIZE)
+        self.data_mgr.add_source(source)
+        self.data_mgr.set_source(source)
+        source.start()
+
+        self.init_signal_handler(app)
+
+        self.data_win = data_window.DataWindow(
+            app, self.data_mgr, (), None,
+            graph_panel=gui_panels.RemoteGraphPanel(source))
+        self.data_win.setGeometry(160, 140, 1400, 1000)
+        self.data_win.show()
+
         timer = pg.QtCore.QTimer()
         timer.timeout.connect(self.data_win.update)
         timer.start(30)
 
-        # Start sampling
-        # daq.start()
+        sys.exit(app.exec_())
+
+    def run_fusion(self, app):
+        """Fuse detections from several sensor heads into one tracker."""
+        heads = [fusion.parse_head(spec) for spec in self.args.head]
+        rd_config = dict(
+            daq_index=dsp.DAQ_INDEX,
+            sample_rate=DAQ_SAMPLE_RATE,
+            pulse=Pulse(FC, BW, DELAY),
+            fast_fft_size=FAST_FFT_SIZE,
+            slow_fft_size=SLOW_FFT_SIZE,
+            slow_fft_len=SLOW_FFT_SIZE,
+            doppler_band=self.args.doppler_band,
+            dtype=precision.PRECISIONS[self.args.precision],
+            iq_correction=self.iq_correction())
+        self.fusion_mgr = fusion.FusionManager(heads, rd_config)
+        tracker = fusion.FusionTracker(heads)
+
+        # The data window and control panel expect a selected source
+        source = fusion.FusionSource(heads, sample_rate=DAQ_SAMPLE_RATE,
+                                     sample_chunk_size=DAQ_CHUNK_SIZE)
+        self.data_mgr.add_source(source)
+        self.data_mgr.set_source(source)
+
+        self.init_signal_handler(app)
+
+        self.data_win = data_window.DataWindow(app, self.data_mgr, (),
+                                               tracker)
+        self.data_win.setGeometry(160, 140, 1400, 1000)
+        self.data_win.show()
+
+        def fusion_step():
+            for timestamp, frame in self.fusion_mgr.poll():
+                tracker.update(timestamp, frame)
+
+        timer = pg.QtCore.QTimer()
+        timer.timeout.connect(fusion_step)
+        timer.timeout.connect(self.data_win.update)
+        timer.start(30)
 
-        # ------ Run Qt program ------ #
         sys.exit(app.exec_())
 
+
+def parse_args(argv=None):
+    """Parse dashboard command line options."""
+    parser = argparse.ArgumentParser(description='APS radar dashboard')
+    parser.add_argument(
+        '--publish', type=int, nargs='?', default=False, metavar='PORT',
+        help='stream processed products to remote viewers on PORT '
+             '(default: 5557)')
+    parser.add_argument(
+        '--subscribe', metavar='HOST[:PORT]',
+        help='view products streamed from a remote dashboard')
+    parser.add_argument(
+        '--net-daq', metavar='HOST[:PORT]',
+        help='acquire raw chunks from a remote capture agent')
+    parser.add_argument(
+        '--async', dest='async_loop', action='store_true',
+        help='run on an asyncio-integrated Qt event loop')
+    parser.add_argument(
+        '--head', action='append', metavar='SOURCE@X,Y',
+        help='add a sensor head at (X, Y) m for fusion mode; SOURCE is '
+             'HOST[:PORT] of a capture agent, ring:NAME of a --shm-ring '
+             'or "synthetic" (repeatable)')
+    parser.add_argument(
+        '--doppler-band', type=float, nargs=2, metavar=('FMIN', 'FMAX'),
+        help='fusion mode: zoom the slow-time FFT onto FMIN..FMAX Hz')
+    parser.add_argument(
+        '--precision', choices=sorted(precision.PRECISIONS), default='double',
+        help='fusion mode: process in float32/complex64 (single) or '
+             'float64/complex128 (double)')
+    parser.add_argument(
+        '--iq-calibration', nargs='?', const='default', metavar='NAME',
+        help='correct IQ imbalance with /calibration/NAME from the '
+             'database (see iq_calibration.py)')
+    parser.add_argument(
+        '--clutter-alpha', type=float, metavar='A',
+        help='subtract static clutter averaged over ~1/A pulses')
+    parser.add_argument(
+        '--shm-ring', nargs='?', const='aps_dashboard_ring', metavar='NAME',
+        help='write raw chunks to a shared-memory ring for other processes')
+    parser.add_argument(
+        '--capture-cap', type=float, metavar='MB',
+        help='keep at most MB of live capture in memory and spill older '
+             'chunks to a temporary file')
+    parser.add_argument(
+        '--product-cache', nargs='?', const=None, default=False,
+        metavar='DIR',
+        help='cache processed products of recorded datasets in DIR and '
+             'replay them on later loads '
+             '(default: ~/.aps_dashboard/product_cache)')
+    parser.add_argument(
+        '--cache-budget', type=float, default=4.0, metavar='GB',
+        help='disk budget of the product cache (default: 4 GB)')
+    parser.add_argument(
+        '--fast-start', action='store_true',
+        help='show the window immediately and load plots and the dataset '
+             'list in the background')
+    parser.add_argument(
+        '--profile-startup', action='store_true',
+        help='print an import and start-up time breakdown')
+    return parser.parse_args(argv)
+
+
 if __name__ == '__main__':
-    app = Application()
+    app = Application(parse_args())
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Asyncio Runtime.
+
+Runs the dashboard on an asyncio event loop integrated with Qt.  Blocking
+work (starting sources, database I/O) is awaited on worker threads and
+only drawing happens on the GUI thread, so handlers never need to re-enter
+the Qt event loop with `processEvents`.  Sources sample on their own
+threads, as in the default loop; redraws follow `data_available_signal`.
+
+`qasync` is used when it is installed; otherwise asyncio is stepped from a
+short Qt timer, which still avoids re-entrancy but adds a few milliseconds
+of latency.
+
+Author: Jason Merlo
+Maintainer: Jason Merlo (merlojas@msu.edu)
+"""
+import asyncio
+import concurrent.futures
+import threading
+import time
+import types
+
+from pyqtgraph import QtCore
+
+try:
+    import qasync
+except ImportError:
+    qasync = None
+
+# === CONSTANTS ===============================================================
+# Minimum time between redraws (s)
+DEFAULT_FRAME_INTERVAL = 1 / 60
+# Interval of the fallback asyncio stepping timer (ms)
+FALLBACK_STEP_MS = 5
+# Time allowed for a started source to report that it is running (s)
+START_TIMEOUT = 2.0
+
+
+class AsyncRuntime(object):
+    """Own the asyncio loop, worker executors and redraw scheduling."""
+
+    def __init__(self, app, frame_interval=DEFAULT_FRAME_INTERVAL):
+        self.app = app
+        self.frame_interval = frame_interval
+
+        if qasync is not None:
+            self.loop = qasync.QEventLoop(app)
+            self.step_timer = None
+        else:
+            self.loop = asyncio.new_event_loop()
+            self.step_timer = QtCore.QTimer()
+            self.step_timer.timeout.connect(self.step)
+        asyncio.set_event_loop(self.loop)
+
+        # Single threads keep acquisition and file access each serialized
+        self.acq_executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.io_executor = concurrent.futures.ThreadPoolExecutor(1)
+
+        self.draw_event = asyncio.Event()
+        self.tasks = []
+
+    # === FALLBACK LOOP =======================================================
+    def step(self):
+        """Run every asyncio callback that is ready, then return to Qt."""
+        self.loop.call_soon(self.loop.stop)
+        self.loop.run_forever()
+
+    # === HELPERS =============================================================
+    def run_io(self, func, *args):
+        """Await `func(*args)` on the file I/O thread."""
+        return self.loop.run_in_executor(self.io_executor, func, *args)
+
+    def run_acq(self, func, *args):
+        """Await `func(*args)` on the acquisition thread."""
+        return self.loop.run_in_executor(self.acq_executor, func, *args)
+
+    def request_draw(self, *args):
+        """Schedule a redraw; safe to call from any thread."""
+        self.loop.call_soon_threadsafe(self.draw_event.set)
+
+    def spawn(self, coro):
+        """Start a coroutine or future as a task owned by the runtime."""
+        task = asyncio.ensure_future(coro, loop=self.loop)
+        self.tasks.append(task)
+        return task
+
+    # === TASKS ===============================================================
+    async def acquire(self, data_mgr):
+        """
+        Watch whichever source is selected until it stops.
+
+        A selected source that has not been started yet (such as the DAQ
+        created at start-up) is started on the acquisition thread, which
+        also starts any hardware scan.  `start` runs the source's own
+        sampling thread, the only caller of `get_samples`; reading here as
+        well would have two threads consuming the same source.
+        """
+        # Source -> time it was started (or first seen running)
+        started = {}
+        while True:
+            source = data_mgr.source
+            if source is None:
+                await asyncio.sleep(0.05)
+                continue
+            if source.running:
+                started.setdefault(source, time.time())
+            elif source not in started:
+                started[source] = time.time()
+                await self.run_acq(source.start)
+                continue
+            elif time.time() - started[source] > START_TIMEOUT:
+                break
+            await asyncio.sleep(0.05)
+
+    async def draw(self, data_win):
+        """Redraw once per frame interval while new data is arriving."""
+        while True:
+            await self.draw_event.wait()
+            self.draw_event.clear()
+            start = time.time()
+            data_win.update()
+            await asyncio.sleep(
+                max(self.frame_interval - (time.time() - start), 0))
+
+    # === ENTRY POINTS ========================================================
+    def start(self, data_mgr, data_win):
+        """Start acquisition and drawing tasks for the dashboard window."""
+        data_win.runtime = self
+        data_win.control_panel.runtime = self
+        data_mgr.data_available_signal.connect(self.request_draw)
+        self.spawn(self.acquire(data_mgr))
+        self.spawn(self.draw(data_win))
+
+    def run_forever(self):
+        """Run Qt and asyncio until the application quits."""
+        if self.step_timer is None:
+            with self.loop:
+                return self.loop.run_forever()
+        self.step_timer.start(FALLBACK_STEP_MS)
+        return self.app.exec_()
+
+    def close(self):
+        for task in self.tasks:
+            task.cancel()
+        self.acq_executor.shutdown(wait=False)
+        self.io_executor.shutdown(wait=False)
+
+
+# === LOOPBACK SELF-TEST ======================================================
+def _loopback_test(num_chunks=400):
+    """
+    Acquire synthetic chunks from a loopback `CaptureAgent` with a source
+    started by the runtime's acquisition task and check they all arrive
+    once and in order.
+    """
+    import pyqtgraph as pg
+    import net_daq
+
+    app = pg.mkQApp()
+    agent = net_daq.CaptureAgent(net_daq.SyntheticChunkSource(),
+                                 host='127.0.0.1', port=0)
+    threading.Thread(target=agent.serve_forever, daemon=True).start()
+
+    # Not started here: the runtime must start it
+    source = net_daq.NetworkDAQ('127.0.0.1', agent.port)
+    received = []
+    source.data_available_signal.connect(
+        lambda item: received.append(item[1]))
+    data_mgr = types.SimpleNamespace(source=source)
+
+    runtime = AsyncRuntime(app)
+    task = runtime.spawn(runtime.acquire(data_mgr))
+
+    async def wait_for_chunks():
+        while len(received) < num_chunks:
+            await asyncio.sleep(0.01)
+
+    start = time.time()
+    runtime.loop.run_until_complete(
+        asyncio.wait_for(wait_for_chunks(), timeout=10))
+    elapsed = time.time() - start
+    source.close()
+    runtime.loop.run_until_complete(asyncio.wait_for(task, timeout=5))
+    runtime.close()
+    agent.close()
+
+    # A second reader would split or repeat the sequence
+    assert received == list(range(len(received))), received[:20]
+    print('{:d} chunks acquired by the async runtime in {:.3f} s'.format(
+        len(received), elapsed))
+
+
+if __name__ == '__main__':
+    _loopback_test()
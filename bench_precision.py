@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Precision Benchmark.
+
+Compares the legacy playback path (big-endian float32 recording ->
+float64 -> complex128 FFTs) with the native float32/complex64 path, and
+reports the memory held by the playback buffer and FFT history and the
+processing throughput of each.
+
+    python bench_precision.py [--chunks N] [--repeat R]
+
+Author: Jason Merlo
+Maintainer: Jason Merlo (merlojas@msu.edu)
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+import dsp
+import precision
+
+# === CONSTANTS ===============================================================
+BATCH = 64
+
+
+def make_recording(path, num_chunks):
+    """Write a synthetic big-endian recording like the existing database."""
+    rng = np.random.RandomState(0)
+    data = rng.standard_normal((num_chunks, 8, dsp.CHUNK_SIZE))
+    with h5py.File(path, 'w') as db:
+        db.create_dataset('samples/sample_0', data=data, dtype='>f4')
+
+
+def run(path, dtype, legacy):
+    """Play back the recording in BATCH blocks; returns (seconds, bytes)."""
+    processor = dsp.RangeDopplerProcessor(dsp.DAQ_INDEX, dsp.SAMPLE_RATE,
+                                          dsp.PULSE, dtype=dtype)
+    with h5py.File(path, 'r') as db:
+        ds = db['samples/sample_0']
+        start = time.perf_counter()
+        if legacy:
+            # Whole recording as float64, as the playback source holds it
+            data = ds[...].astype(np.float64)
+        else:
+            data = precision.read_native(ds)
+        for idx in range(0, len(data), BATCH):
+            processor.process_batch(data[idx:idx + BATCH])
+        elapsed = time.perf_counter() - start
+    return elapsed, data.nbytes, processor.history.nbytes, processor
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark float64 vs native float32 processing')
+    parser.add_argument('--chunks', type=int, default=40000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix='.hdf5')
+    os.close(fd)
+    try:
+        make_recording(path, args.chunks)
+        results = {}
+        for name, dtype, legacy in (('double', np.complex128, True),
+                                    ('single', np.complex64, False)):
+            times = []
+            for _ in range(args.repeat):
+                elapsed, buf, hist, proc = run(path, dtype, legacy)
+                times.append(elapsed)
+            results[name] = (min(times), buf, hist, proc.range_doppler)
+            print('{:6s}  {:7.3f} s  {:8.0f} chunks/s  buffer {:6.1f} MiB  '
+                  'history {:5.2f} MiB'.format(
+                      name, min(times), args.chunks / min(times),
+                      buf / 2**20, hist / 2**20))
+
+        d_time, d_buf, d_hist, d_rd = results['double']
+        s_time, s_buf, s_hist, s_rd = results['single']
+        err = np.abs(d_rd - s_rd).max() / np.abs(d_rd).max()
+        print('speed-up {:.2f}x, memory saved {:.1f} MiB, '
+              'max relative error {:.1e}'.format(
+                  d_time / s_time, (d_buf + d_hist - s_buf - s_hist) / 2**20,
+                  err))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
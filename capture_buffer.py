@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded Capture Buffer.
+
+Holds the raw chunks captured since the last reset under a fixed memory
+cap.  Chunks are stored in fixed-size in-memory blocks; once the cap is
+exceeded the oldest blocks are appended to a temporary file and read back
+through `np.memmap`.  Saving streams every segment into the HDF5 dataset
+in turn, so a long capture is never concatenated into one array.
+
+`BufferedCapture` puts the `SpillBuffer` in place of the `DataManager`'s
+own chunk list, so the manager's accumulation is the capped one and the
+samples are held only once.
+
+Author: Jason Merlo
+Maintainer: Jason Merlo (merlojas@msu.edu)
+"""
+import os
+import tempfile
+import warnings
+
+import numpy as np
+
+
+# === CONSTANTS ===============================================================
+DEFAULT_MAX_MEMORY = 256 * 2**20    # bytes
+DEFAULT_BLOCK_CHUNKS = 4096         # chunks per in-memory block
+# DataManager attribute its data slot appends every captured chunk to
+MANAGER_BUFFER = 'buffer'
+
+
+class SpillBuffer(object):
+    """
+    Append-only chunk store that spills old blocks to a memory-mapped file.
+
+    Supports the list operations the `DataManager` uses on its buffer
+    (`append`, `len`, indexing, iteration and `clear`).
+    """
+
+    def __init__(self, max_memory=DEFAULT_MAX_MEMORY,
+                 block_chunks=DEFAULT_BLOCK_CHUNKS, spill_dir=None,
+                 dtype=np.float32):
+        self.max_memory = max_memory
+        self.block_chunks = block_chunks
+        self.spill_dir = spill_dir
+        self.dtype = np.dtype(dtype)
+
+        self.chunk_shape = None
+        self.blocks = []        # in-memory blocks, oldest first
+        self.fill = 0           # chunks used in the newest block
+        self.spill_file = None
+        self.spilled = 0        # chunks held in the spill file
+        self.spill_map = None
+
+    def __len__(self):
+        if not self.blocks:
+            return self.spilled
+        return (self.spilled + (len(self.blocks) - 1) * self.block_chunks
+                + self.fill)
+
+    def __getitem__(self, idx):
+        """Return chunk `idx` (negative indices count from the newest)."""
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('chunk index out of range')
+        for segment in self.segments():
+            if idx < len(segment):
+                return segment[idx]
+            idx -= len(segment)
+
+    def __iter__(self):
+        for segment in self.segments():
+            for chunk in segment:
+                yield chunk
+
+    def __array__(self, dtype=None):
+        # Only for callers that need one array; saving streams segments
+        if not len(self):
+            return np.empty((0,) + (self.chunk_shape or ()), dtype or
+                            self.dtype)
+        return np.concatenate(list(self.segments())).astype(
+            dtype or self.dtype, copy=False)
+
+    @property
+    def memory_bytes(self):
+        return sum(b.nbytes for b in self.blocks)
+
+    def append(self, chunk):
+        """Copy one chunk into the buffer."""
+        if self.chunk_shape is None:
+            self.chunk_shape = np.shape(chunk)
+        if not self.blocks or self.fill == self.block_chunks:
+            self.blocks.append(np.empty(
+                (self.block_chunks,) + self.chunk_shape, self.dtype))
+            self.fill = 0
+            # Keep the newest block in memory whatever the cap
+            while (len(self.blocks) > 1
+                   and self.memory_bytes > self.max_memory):
+                self.spill(self.blocks.pop(0))
+        self.blocks[-1][self.fill] = chunk
+        self.fill += 1
+
+    def spill(self, block):
+        """Append a full block to the spill file."""
+        if self.spill_file is None:
+            fd, path = tempfile.mkstemp(prefix='aps_capture_',
+                                        suffix='.raw', dir=self.spill_dir)
+            self.spill_file = os.fdopen(fd, 'wb')
+            self.spill_path = path
+        block.tofile(self.spill_file)
+        self.spill_file.flush()
+        self.spilled += len(block)
+        # Remap lazily on the next read
+        self.spill_map = None
+
+    def segments(self):
+        """
+        Yield the captured chunks, oldest first, as a sequence of arrays.
+
+        The first segment is a read-only memory map of the spill file (if
+        anything was spilled), followed by views of the in-memory blocks.
+        """
+        if self.spilled:
+            if self.spill_map is None:
+                self.spill_map = np.memmap(
+                    self.spill_path, dtype=self.dtype, mode='r',
+                    shape=(self.spilled,) + self.chunk_shape)
+            yield self.spill_map
+        for idx, block in enumerate(self.blocks):
+            if idx == len(self.blocks) - 1:
+                yield block[:self.fill]
+            else:
+                yield block
+
+    def clear(self):
+        """Drop all chunks and delete the spill file."""
+        self.blocks = []
+        self.fill = 0
+        self.spilled = 0
+        self.spill_map = None
+        if self.spill_file is not None:
+            self.spill_file.close()
+            os.remove(self.spill_path)
+            self.spill_file = None
+
+    def write_dataset(self, group, name, **kwargs):
+        """
+        Create `group[name]` holding every chunk, one segment at a time.
+
+        Extra keyword arguments are passed to `create_dataset` (e.g.
+        chunking or compression).
+        """
+        ds = group.create_dataset(
+            name, shape=(len(self),) + self.chunk_shape, dtype=self.dtype,
+            **kwargs)
+        offset = 0
+        for segment in self.segments():
+            ds[offset:offset + len(segment)] = segment
+            offset += len(segment)
+        return ds
+
+
+class BufferedCapture(object):
+    """
+    Cap the chunks a `DataManager` keeps with a `SpillBuffer`.
+
+    The buffer replaces the manager's own `MANAGER_BUFFER` list, so the
+    manager keeps appending as before but into capped storage, and is
+    cleared with the manager's `reset_signal`.  If the manager has no such
+    attribute the capture records `data_available_signal` itself.
+    `save_buffer` mirrors `DataManager.save_buffer` but streams the buffer
+    segment by segment.
+    """
+
+    def __init__(self, data_mgr, max_memory=DEFAULT_MAX_MEMORY,
+                 spill_dir=None):
+        self.data_mgr = data_mgr
+        self.buffer = SpillBuffer(max_memory, spill_dir=spill_dir)
+        self.replaces_manager = hasattr(data_mgr, MANAGER_BUFFER)
+        if self.replaces_manager:
+            self.install()
+        else:
+            warnings.warn('(capture) DataManager has no {!r} buffer; '
+                          'recording alongside it'.format(MANAGER_BUFFER))
+            data_mgr.data_available_signal.connect(self.on_data)
+        data_mgr.reset_signal.connect(self.reset)
+
+    def install(self):
+        """Put the buffer in place of the manager's, keeping its chunks."""
+        current = getattr(self.data_mgr, MANAGER_BUFFER)
+        if current is self.buffer:
+            return
+        if current is not None:
+            for chunk in current:
+                self.buffer.append(chunk)
+        setattr(self.data_mgr, MANAGER_BUFFER, self.buffer)
+
+    def on_data(self, data_tuple):
+        # Recorded playback is already in the database
+        if self.data_mgr.source is self.data_mgr.virt_daq:
+            return
+        self.buffer.append(data_tuple[0])
+
+    def reset(self, *args):
+        self.buffer.clear()
+        if self.replaces_manager:
+            # The manager may have replaced its buffer while resetting
+            self.install()
+
+    def save_buffer(self, name, labels, subject, notes):
+        """
+        Save the capture as `/samples/<name>`.
+
+        `labels` and `subject` are the label and subject groups selected in
+        `SaveDialog`; the sample is hard-linked into each of them.  The
+        overview is left to the caller (`ControlPanel.build_overview` reads
+        the dataset back on a background thread).
+        """
+        db = self.data_mgr.db
+        samples = db.require_group('samples')
+        if name in samples:
+            del samples[name]
+        ds = self.buffer.write_dataset(samples, name)
+
+        label_names = [label.name.split('/')[-1] for label in labels]
+        ds.attrs['label'] = ','.join(label_names).encode('utf-8')
+        ds.attrs['subject'] = (subject.name.split('/')[-1].encode('utf-8')
+                               if subject is not None else b'')
+        ds.attrs['notes'] = notes.encode('utf-8')
+        ds.attrs['sample_rate'] = self.data_mgr.sample_rate
+        ds.attrs['sample_chunk_size'] = self.data_mgr.sample_chunk_size
+        ds.attrs['daq_type'] = str(self.data_mgr.daq_type).encode('utf-8')
+
+        for group in list(labels) + ([subject] if subject is not None
+                                     else []):
+            if name in group:
+                del group[name]
+            group[name] = ds
+
+        db.flush()
+        return ds
+
+    def close(self):
+        self.buffer.clear()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+DAQami CSV Reader.
+
+Parses CSV files exported by MCC DAQami.  Kept free of plotting and Qt
+imports so it can be used from worker processes.
+
+Author: Jason Merlo
+Maintainer: Jason Merlo (merlojas@msu.edu)
+"""
+import io
+
+import numpy as np
+
+# === CONSTANTS ===============================================================
+# CSV column holding each logical signal, in (I0, Q0, I1, Q1, ...) order.
+# DAQami numbers its columns like the DAQ channels, so this is also the DAQ
+# channel of each signal (the ReceiverTuple daq_index pairs (1, 3), (5, 7),
+# (0, 2), (4, 6)) and exports need no reordering.
+CHANNEL_MAP = [1, 3, 5, 7, 0, 2, 4, 6]
+
+
+def read_csv(fname, skip_lines=7, skip_cols=2, sample_rate_idx=(5,0), sample_count_idx=(3,0), channel_count_idx=(2,0), dtype=float, verbose=True):
+    """
+    Read a DAQami CSV file.
+
+    Returns (samples, sample_rate) with samples shaped
+    (num_samples, num_channels).
+    """
+    with open(fname) as fp:
+        for line_num in range(skip_lines):
+            line = fp.readline()
+            if line_num == channel_count_idx[0]:
+                num_channels = int(line.split(':')[-1].strip('"\n'))
+            elif line_num == sample_count_idx[0]:
+                num_samples = int(line.split(':')[-1].strip('"\n'))
+            elif line_num == sample_rate_idx[0]:
+                sample_rate = int(line.split(':')[-1].strip('"\n'))
+        body = fp.read().replace('"', '')
+
+    if verbose:
+        print('num_channels:', num_channels)
+        print('num_samples:', num_samples)
+        print('sample_rate:', sample_rate)
+
+    samples = np.loadtxt(
+        io.StringIO(body), delimiter=',', dtype=dtype, ndmin=2,
+        usecols=range(skip_cols, skip_cols + num_channels))
+    return samples[:num_samples], sample_rate
+
+
+def to_daq_order(samples, channel_map=None):
+    """
+    Put CSV columns into the dashboard's DAQ channel numbering.
+
+    DAQami exports are already in that order and are returned unchanged.
+    For a capture wired differently, `channel_map` gives the CSV column of
+    each logical signal (I0, Q0, I1, Q1, ...); signal k is stored in DAQ
+    channel `CHANNEL_MAP[k]`.
+    """
+    if channel_map is None or list(channel_map) == CHANNEL_MAP:
+        return samples
+    out = np.empty((samples.shape[0], len(CHANNEL_MAP)), samples.dtype)
+    out[:, CHANNEL_MAP] = samples[:, channel_map]
+    return out
+
+
+def to_chunks(samples, chunk_size):
+    """
+    Split (num_samples, num_channels) samples into
+    (num_chunks, num_channels, chunk_size) chunks, dropping any remainder.
+    """
+    num_chunks = samples.shape[0] // chunk_size
+    chunks = samples[:num_chunks * chunk_size].reshape(
+        num_chunks, chunk_size, samples.shape[1])
+    return np.ascontiguousarray(chunks.transpose(0, 2, 1))
@@ -9,7 +9,7 @@ Maintainer: Jason Merlo (merlojas@msu.edu)
 # === Window / UI ===
 from pyqtgraph import QtCore, QtGui     # Qt Elements
 # === GUI Elements ===
-from gui_panels import GraphPanel, ControlPanel
+from gui_panels import GraphPanel, ControlPanel, RemoteGraphPanel
 
 import os
 import signal                       # handle escape to exit
@@ -20,13 +20,22 @@ import sys
 from profilehooks import profile
 
 class DataWindow(QtGui.QTabWidget):
-    def __init__(self, app, data_mgr, radar, tracker, parent=None):
+    def __init__(self, app, data_mgr, radar, tracker, graph_panel=None,
+                 deferred=False, parent=None):
         super(DataWindow, self).__init__(parent)
         # Copy member objects
         self.app = app
         self.data_mgr = data_mgr
         self.radar = radar
         self.tracker = tracker
+        self.graph_panel = graph_panel
+        # Build plots and dataset list after the window is shown
+        self.deferred = deferred
+        # Set by AsyncRuntime when running on the asyncio loop
+        self.runtime = None
+        # Set while a dataset plays from the product cache
+        self.player = None
+        self.cache_panel = None
 
         # Setup window
         self.setWindowTitle('Radar Tracking Visualizer')
@@ -53,29 +62,61 @@ class DataWindow(QtGui.QTabWidget):
     def tab_dataUI(self):
         # Create panel objects
         layout = QtGui.QGridLayout()
-        self.graph_panel = GraphPanel(self.radar, self.tracker)
+        if self.graph_panel is None:
+            self.graph_panel = GraphPanel(self.radar, self.tracker,
+                                          deferred=self.deferred)
 
         panel_list = [self.graph_panel]
         self.control_panel = ControlPanel(
-            self.app, self.data_mgr, panel_list)
+            self.app, self.data_mgr, panel_list, deferred=self.deferred)
 
         # Create splitter widget
-        h_split = QtGui.QSplitter(QtCore.Qt.Horizontal)
+        self.h_split = QtGui.QSplitter(QtCore.Qt.Horizontal)
 
         # Add panels to splitter widget
-        h_split.addWidget(self.control_panel)
-        h_split.addWidget(self.graph_panel)
+        self.h_split.addWidget(self.control_panel)
+        self.h_split.addWidget(self.graph_panel)
 
-        layout.addWidget(h_split)
+        layout.addWidget(self.h_split)
 
         self.tab_data.setLayout(layout)
 
+    def set_pipeline(self, radar, tracker):
+        """Attach the radar pipeline to a window created with deferred=True."""
+        self.radar = radar
+        self.tracker = tracker
+        self.graph_panel.build(radar, tracker)
+
+    def set_cached_player(self, player):
+        """Show products from a `CachedPlayer`, or the live plots if None."""
+        self.player = player
+        if player is None:
+            if self.cache_panel is not None:
+                self.cache_panel.hide()
+            self.graph_panel.show()
+            return
+        if self.cache_panel is None:
+            self.cache_panel = RemoteGraphPanel(player)
+            self.h_split.addWidget(self.cache_panel)
+        self.cache_panel.source = player
+        self.cache_panel.reset()
+        self.graph_panel.hide()
+        self.cache_panel.show()
+
     def connect_signals(self):
         self.data_mgr.reset_signal.connect(self.reset)
+        self.control_panel.cache_playback.connect(self.set_cached_player)
 
     # @profile(immediate=True)
     def update(self):
-        self.app.processEvents()
+        # The asyncio runtime only calls update from the event loop itself
+        if self.runtime is None:
+            self.app.processEvents()
+        # Cached products replace the live pipeline
+        if self.player is not None:
+            self.player.update()
+            self.cache_panel.update()
+            return
         # Do not update graphs is no new data is being produced
         if not self.data_mgr.source.paused or self.step_data:
             self.graph_panel.update()
@@ -103,6 +144,6 @@ class DataWindow(QtGui.QTabWidget):
             self.data_mgr.close()
             os.kill(os.getpid(), signal.SIGINT)
         elif event.key() == QtCore.Qt.Key_Right:
-            self.control_panel.step_right_button_handler()
             self.step_data = 1
+            self.control_panel.step_right_button_handler()
         event.accept()
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Database Compaction.
+
+HDF5 does not reclaim the space of deleted datasets, so a database that
+has seen many deletes keeps growing.  `compact_file` rewrites every group,
+dataset and attribute into a fresh file, copying sample data in large
+blocks and optionally re-chunking and recompressing it.  Datasets that are
+hard-linked from several groups (`/samples` and the `/labels` and
+`/subjects` groups) are copied once and linked again in the new file.
+
+The dashboard runs the copy on a background thread from the open database
+and then swaps the new file in with `os.replace`.  From the command line:
+
+    python db_compact.py DATABASE [--compression gzip] [--chunk-rows N]
+
+Author: Jason Merlo
+Maintainer: Jason Merlo (merlojas@msu.edu)
+"""
+import argparse
+import os
+import tempfile
+
+import h5py
+
+# === CONSTANTS ===============================================================
+DEFAULT_BLOCK_CHUNKS = 16384    # rows copied per read/write
+# Keep the filters and chunking each dataset already has
+KEEP = 'keep'
+
+
+def dataset_options(src, compression=KEEP, chunk_rows=None):
+    """Creation keywords for the copy of dataset `src`."""
+    opts = dict(shape=src.shape, dtype=src.dtype, maxshape=src.maxshape)
+    if compression == KEEP:
+        opts.update(compression=src.compression,
+                    compression_opts=src.compression_opts,
+                    shuffle=src.shuffle, chunks=src.chunks)
+    elif compression is not None:
+        opts.update(compression=compression, shuffle=True, chunks=True)
+    if chunk_rows is not None and src.ndim and src.shape[0]:
+        opts['chunks'] = (min(chunk_rows, src.shape[0]),) + src.shape[1:]
+    if opts.get('chunks') is None and src.maxshape != src.shape:
+        # Resizable datasets must be chunked
+        opts['chunks'] = True
+    return opts
+
+
+def copy_dataset(src, dst_group, name, block_chunks, **opts):
+    """Copy `src` into `dst_group[name]` in blocks of `block_chunks` rows."""
+    dst = dst_group.create_dataset(name, **opts)
+    if src.ndim == 0:
+        dst[()] = src[()]
+    else:
+        for start in range(0, src.shape[0], block_chunks):
+            stop = min(start + block_chunks, src.shape[0])
+            dst[start:stop] = src[start:stop]
+    dst.attrs.update(src.attrs)
+    return dst
+
+
+def copy_group(src, dst, copied, stats, compression=KEEP, chunk_rows=None,
+               block_chunks=DEFAULT_BLOCK_CHUNKS, progress=None):
+    """
+    Recursively copy the links of group `src` into group `dst`.
+
+    `copied` maps source object ids to their copies, so an object reached
+    through a second hard link is linked rather than copied again.
+    """
+    dst.attrs.update(src.attrs)
+    # Copy /samples first so data keeps its primary location
+    names = sorted(src, key=lambda n: (n != 'samples', n))
+    for name in names:
+        link = src.get(name, getlink=True)
+        if isinstance(link, h5py.SoftLink):
+            dst[name] = h5py.SoftLink(link.path)
+            continue
+        if isinstance(link, h5py.ExternalLink):
+            dst[name] = h5py.ExternalLink(link.filename, link.path)
+            continue
+
+        obj = src[name]
+        if obj.id in copied:
+            dst[name] = copied[obj.id]
+        elif isinstance(obj, h5py.Group):
+            copied[obj.id] = dst.create_group(name)
+            copy_group(obj, copied[obj.id], copied, stats, compression,
+                       chunk_rows, block_chunks, progress)
+        else:
+            copied[obj.id] = copy_dataset(
+                obj, dst, name, block_chunks,
+                **dataset_options(obj, compression, chunk_rows))
+            stats['datasets'] += 1
+            stats['bytes'] += obj.size * obj.dtype.itemsize
+            if progress is not None:
+                progress(obj.name)
+
+
+def compact_file(src, dst_path, compression=KEEP, chunk_rows=None,
+                 block_chunks=DEFAULT_BLOCK_CHUNKS, progress=None):
+    """
+    Write a compacted copy of the open h5py file `src` to `dst_path`.
+
+    `compression` is an HDF5 filter name, None for no compression or
+    `KEEP`; `chunk_rows` re-chunks datasets along their first axis.
+    Returns a dict of copy statistics.
+    """
+    src.flush()
+    stats = dict(datasets=0, bytes=0)
+    with h5py.File(dst_path, 'w') as dst:
+        copy_group(src, dst, {}, stats, compression, chunk_rows,
+                   block_chunks, progress)
+    stats['size_before'] = os.path.getsize(src.filename)
+    stats['size_after'] = os.path.getsize(dst_path)
+    return stats
+
+
+def temp_path(path):
+    """A temporary file name next to `path`, so the swap stays on one disk."""
+    fd, tmp = tempfile.mkstemp(prefix='.compact_', suffix='.hdf5',
+                               dir=os.path.dirname(os.path.abspath(path)))
+    os.close(fd)
+    return tmp
+
+
+def compact(path, **kwargs):
+    """Compact the database at `path` in place; returns the statistics."""
+    tmp = temp_path(path)
+    try:
+        with h5py.File(path, 'r') as src:
+            stats = compact_file(src, tmp, **kwargs)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return stats
+
+
+def format_stats(stats):
+    return '{} datasets, {:.1f} MB -> {:.1f} MB'.format(
+        stats['datasets'], stats['size_before'] / 1e6,
+        stats['size_after'] / 1e6)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Rewrite a dashboard database to reclaim free space')
+    parser.add_argument('database')
+    parser.add_argument('--compression', default=KEEP,
+                        help='gzip, lzf or none (default: keep each '
+                             "dataset's filters)")
+    parser.add_argument('--chunk-rows', type=int, default=None,
+                        help='re-chunk datasets to N rows per chunk')
+    parser.add_argument('--block-chunks', type=int,
+                        default=DEFAULT_BLOCK_CHUNKS,
+                        help='rows copied per read/write')
+    args = parser.parse_args()
+
+    compression = None if args.compression == 'none' else args.compression
+    stats = compact(args.database, compression=compression,
+                    chunk_rows=args.chunk_rows, block_chunks=args.block_chunks,
+                    progress=lambda name: print('copied', name))
+    print(format_stats(stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+Headless Radar DSP.
+
+Numpy-only range-Doppler processing that mirrors the configuration of the
+pyratk `Radar` object (fast-time FFT per pulse, slow-time FFT across
+pulses) without depending on Qt or a `DataManager`.  Used where the
+processing must run outside the GUI process, e.g. in fusion workers.
+
+Author: Jason Merlo
+Maintainer: Jason Merlo (merlojas@msu.edu)
+"""
+import collections
+
+import numpy as np
+
+try:
+    # scipy.fft keeps single-precision input in single precision; numpy.fft
+    # before 2.0 always computes in complex128
+    import scipy.fft as fft_backend
+except ImportError:
+    fft_backend = np.fft
+
+# === CONSTANTS ===============================================================
+C = 299792458.0  # m/s
+# Default end-to-end latency budget for batched processing (s)
+DEFAULT_LATENCY_TARGET = 0.02
+
+# Field-compatible with pyratk.datatypes.radar.Pulse, for use without pyratk
+Pulse = collections.namedtuple('Pulse', ['fc', 'bw', 'delay'])
+
+# Radar configuration of the dashboard; aps_dashboard.py builds its pipeline
+# from these and the offline tools import them from here
+SAMPLE_RATE = 100000
+PULSE = Pulse(fc=5.825e9, bw=100e6, delay=250e-6)
+CHUNK_SIZE = int(SAMPLE_RATE * PULSE.delay)
+# (I, Q) DAQ channel pair of each receiver, as in its ReceiverTuple
+DAQ_INDEX = ((1, 3), (5, 7))
+FAST_FFT_SIZE = 2**11
+SLOW_FFT_SIZE = 2**5
+
+
+def decode_attr(ds, name):
+    """Return a recording attribute (stored as UTF-8 bytes) as text."""
+    value = ds.attrs.get(name, b'')
+    return value.decode('utf-8') if isinstance(value, bytes) else str(value)
+
+
+class RangeDopplerProcessor(object):
+    """
+    Compute range-Doppler maps from raw 8-channel chunks.
+
+    `daq_index` is a sequence of (I, Q) channel pairs, one per receiver,
+    matching `ReceiverTuple.daq_index`.  Each call to `process` consumes one
+    `(num_channels, chunk_size)` pulse; once `slow_fft_len` pulses have been
+    seen a `(num_receivers, slow_fft_size, fast_fft_size)` power map is
+    available in `self.range_doppler`.
+
+    If `doppler_band` is given as (f_min, f_max) in Hz, the slow-time axis
+    is a zoom FFT of `slow_fft_size` bins spanning only that band instead
+    of the full +/- PRF/2.
+
+    `dtype` selects the working precision.  With `np.complex64` the whole
+    chain (input chunks, FFT buffers and history) stays in native float32 /
+    complex64; inputs of any other type are converted once on entry.
+
+    `iq_correction`, e.g. an `iq_calibration.IQCorrector`, is applied to
+    every raw block before it is processed.
+    """
+
+    def __init__(self, daq_index, sample_rate, pulse, fast_fft_size=2**11,
+                 slow_fft_size=2**5, slow_fft_len=2**5, doppler_band=None,
+                 dtype=np.complex128, iq_correction=None):
+        self.i_idx = np.array([iq[0] for iq in daq_index])
+        self.q_idx = np.array([iq[1] for iq in daq_index])
+        self.sample_rate = sample_rate
+        self.pulse = pulse
+        self.fast_fft_size = fast_fft_size
+        self.slow_fft_size = slow_fft_size
+        self.slow_fft_len = slow_fft_len
+
+        self.dtype = np.dtype(dtype)
+        self.real_dtype = np.finfo(self.dtype).dtype
+        self.iq_correction = iq_correction
+
+        num_rx = len(self.i_idx)
+        self.window = None
+        self.slow_window = np.hanning(slow_fft_len).astype(
+            self.real_dtype)[:, np.newaxis]
+        # Ring of fast-time spectra, one row per pulse
+        self.history = np.zeros((num_rx, slow_fft_len, fast_fft_size),
+                                dtype=self.dtype)
+        self.pulse_count = 0
+        self.range_doppler = None
+
+        # Axes
+        prf = 1.0 / pulse.delay
+        beat = np.fft.fftshift(np.fft.fftfreq(fast_fft_size, 1 / sample_rate))
+        if doppler_band is None:
+            self.slow_zoom = None
+            doppler = np.fft.fftshift(np.fft.fftfreq(slow_fft_size, 1 / prf))
+        else:
+            self.slow_zoom = ZoomFFT(slow_fft_len, doppler_band[0],
+                                     doppler_band[1], slow_fft_size, prf,
+                                     dtype=self.dtype)
+            doppler = self.slow_zoom.freqs
+        self.range_axis = C * beat * pulse.delay / (2 * pulse.bw)
+        self.velocity_axis = doppler * C / (2 * pulse.fc)
+
+    def reset(self):
+        self.history[:] = 0
+        self.pulse_count = 0
+        self.range_doppler = None
+        if self.iq_correction is not None:
+            self.iq_correction.reset()
+
+    def fast_time_fft(self, chunk):
+        """
+        Return the windowed fast-time spectrum of every receiver.
+
+        `chunk` is one `(num_channels, chunk_size)` pulse or a
+        `(K, num_channels, chunk_size)` block of K pulses, which is
+        transformed in a single batched FFT.
+        """
+        # Single conversion boundary (no copy if already the working type)
+        chunk = np.asarray(chunk, dtype=self.real_dtype)
+        i_data = chunk[..., self.i_idx, :]
+        iq = np.empty(i_data.shape, dtype=self.dtype)
+        iq.real = i_data
+        iq.imag = chunk[..., self.q_idx, :]
+        if self.window is None or self.window.shape[-1] != iq.shape[-1]:
+            self.window = np.hanning(iq.shape[-1]).astype(self.real_dtype)
+        iq *= self.window
+        spectrum = fft_backend.fft(iq, self.fast_fft_size, axis=-1)
+        return np.fft.fftshift(spectrum, axes=-1)
+
+    def process(self, chunk):
+        """
+        Add one pulse to the slow-time history.
+
+        Returns the new range-Doppler map, or None until enough pulses have
+        been accumulated.
+        """
+        return self.process_batch(chunk[np.newaxis])
+
+    def process_batch(self, block):
+        """
+        Add a `(K, num_channels, chunk_size)` block of pulses at once.
+
+        The fast-time FFTs of all K pulses are computed in one call and the
+        slow-time FFT is only evaluated once for the whole block.
+        """
+        # Corrected before truncation so stateful corrections see every pulse
+        if self.iq_correction is not None:
+            block = self.iq_correction(block)
+        # Only the newest slow_fft_len pulses can reach the history, but
+        # every pulse advances the ring so its phase follows the pulse count
+        k = block.shape[0]
+        block = block[-self.slow_fft_len:]
+        rows = (self.pulse_count + k - len(block)
+                + np.arange(len(block))) % self.slow_fft_len
+        self.history[:, rows] = self.fast_time_fft(block).swapaxes(0, 1)
+        self.pulse_count += k
+        if self.pulse_count < self.slow_fft_len:
+            return None
+
+        # Oldest pulse first so the slow-time window is applied in order
+        row = rows[-1]
+        ordered = np.roll(self.history, -(row + 1), axis=1)
+        if self.slow_zoom is None:
+            rd = fft_backend.fft(ordered * self.slow_window,
+                                 self.slow_fft_size, axis=1)
+            rd = np.fft.fftshift(rd, axes=1)
+        else:
+            rd = self.slow_zoom(ordered * self.slow_window, axis=1)
+        self.range_doppler = rd.real ** 2 + rd.imag ** 2
+        return self.range_doppler
+
+    def detect(self, threshold_db=15.0, range_doppler=None):
+        """
+        Return the strongest cell of each receiver that clears the median
+        noise floor by `threshold_db`.
+
+        Rows are (receiver, range_m, velocity_mps, power_db).
+        """
+        if range_doppler is None:
+            range_doppler = self.range_doppler
+        if range_doppler is None:
+            return np.empty((0, 4))
+
+        num_rx = range_doppler.shape[0]
+        flat = range_doppler.reshape(num_rx, -1)
+        peak_idx = flat.argmax(axis=1)
+        peak = flat[np.arange(num_rx), peak_idx]
+        floor = np.median(flat, axis=1)
+        snr_db = 10 * np.log10(peak / (floor + 1e-20))
+
+        dop_bin, rng_bin = np.unravel_index(peak_idx, range_doppler.shape[1:])
+        rows = np.column_stack((np.arange(num_rx),
+                                self.range_axis[rng_bin],
+                                self.velocity_axis[dop_bin],
+                                10 * np.log10(peak + 1e-20)))
+        return rows[snr_db > threshold_db]
+
+
+class RangeTrack(object):
+    """Single track; `state` is [x, y, vx, vy] like `fusion.Track`."""
+
+    def __init__(self, rng, range_rate, timestamp):
+        self.state = np.array([0.0, rng, 0.0, range_rate])
+        self.timestamp = timestamp
+        self.misses = 0
+
+
+class RangeTracker(object):
+    """
+    Track the range of the strongest detection.
+
+    Stands in for the dashboard's tracker where only `detect` output is
+    available (e.g. rendering a recording without pyratk's tracker).  The
+    receivers share one location, so there is no bearing: the track is
+    placed on boresight with y the range and vy the range rate.  Range is
+    smoothed alpha-beta style; the range rate is measured directly from
+    the detection's Doppler velocity and smoothed with `beta`.
+
+    Exposes `tracks` and `detections` like the single-array tracker so
+    `telemetry.collect_products` can read it.
+    """
+
+    def __init__(self, alpha=0.5, beta=0.1, max_misses=15):
+        self.alpha = alpha
+        self.beta = beta
+        self.max_misses = max_misses
+        self.tracks = []
+        self.detections = np.empty((0, 4))
+
+    def reset(self):
+        self.tracks = []
+        self.detections = np.empty((0, 4))
+
+    def update(self, timestamp, detections):
+        """Update with one frame of `detect` rows taken at `timestamp`."""
+        self.detections = detections
+        if not len(detections):
+            for track in self.tracks:
+                track.misses += 1
+            self.tracks = [t for t in self.tracks
+                           if t.misses <= self.max_misses]
+            return
+
+        best = detections[detections[:, 3].argmax()]
+        # Approaching targets (positive Doppler) have a falling range
+        rng, range_rate = abs(best[1]), -best[2]
+        if not self.tracks:
+            self.tracks = [RangeTrack(rng, range_rate, timestamp)]
+            return
+
+        track = self.tracks[0]
+        dt = max(timestamp - track.timestamp, 1e-6)
+        predicted = track.state[1] + track.state[3] * dt
+        residual = rng - predicted
+        track.state[1] = predicted + self.alpha * residual
+        track.state[3] += self.beta * (range_rate - track.state[3])
+        track.timestamp = timestamp
+        track.misses = 0
+
+
+class BatchSizeController(object):
+    """
+    Choose how many pulses to read and process per call.
+
+    The batch size is capped so that accumulating a batch never exceeds
+    `latency_target`.  Within that cap it doubles while processing falls
+    behind real time (larger batches amortize the per-call overhead) and
+    shrinks again once processing comfortably keeps up.
+    """
+
+    def __init__(self, pulse_period, latency_target=DEFAULT_LATENCY_TARGET):
+        self.pulse_period = pulse_period
+        self.max_batch = max(1, int(latency_target / pulse_period))
+        self.batch_size = 1
+
+    def update(self, received, elapsed):
+        """Record that `received` pulses took `elapsed` seconds to process."""
+        budget = received * self.pulse_period
+        if elapsed > budget:
+            self.batch_size = min(2 * self.batch_size, self.max_batch)
+        elif elapsed < 0.25 * budget and received < self.batch_size:
+            self.batch_size = max(self.batch_size - 1, 1)
+        return self.batch_size
+
+
+class ZoomFFT(object):
+    """
+    Chirp-z (Bluestein) transform over a narrow frequency band.
+
+    Evaluates the DTFT of `n`-sample inputs at `m` evenly spaced
+    frequencies from `f_start` to `f_stop` (inclusive) using three FFTs of
+    length >= n + m - 1, which is far cheaper than zero-padding a full FFT
+    to the same resolution.  The chirps are computed once, so an instance
+    should be reused for every block of the same length.  Chirps are
+    stored in `dtype`, so complex64 input is transformed in single
+    precision.
+    """
+
+    def __init__(self, n, f_start, f_stop, m, fs, dtype=np.complex128):
+        self.n = n
+        self.m = m
+        self.freqs = np.linspace(f_start, f_stop, m)
+        df = (f_stop - f_start) / (m - 1) if m > 1 else 0.0
+
+        # nk = (n^2 + k^2 - (k - n)^2) / 2 turns the transform into a
+        # convolution with the chirp exp(j pi df/fs m^2)
+        self.nfft = 1 << int(np.ceil(np.log2(n + m - 1)))
+        nn = np.arange(n)
+        kk = np.arange(m)
+        half = np.pi * df / fs
+        # Chirps are evaluated in double precision before any cast
+        self.pre = np.exp(
+            -2j * np.pi * f_start / fs * nn - 1j * half * nn**2).astype(dtype)
+        self.post = np.exp(-1j * half * kk**2).astype(dtype)
+
+        h = np.zeros(self.nfft, dtype=np.complex128)
+        h[:m] = np.exp(1j * half * kk**2)
+        if n > 1:
+            neg = np.arange(1, n)
+            h[-(n - 1):] = np.exp(1j * half * neg[::-1]**2)
+        self.h_fft = np.fft.fft(h).astype(dtype)
+
+    def __call__(self, x, axis=-1):
+        x = np.moveaxis(np.asarray(x), axis, -1)
+        if x.shape[-1] != self.n:
+            raise ValueError('expected {} samples along axis, got {}'.format(
+                self.n, x.shape[-1]))
+        y = fft_backend.fft(x * self.pre, self.nfft, axis=-1)
+        y = fft_backend.ifft(y * self.h_fft, axis=-1)[..., :self.m]
+        y *= self.post
+        return np.moveaxis(y, -1, axis)
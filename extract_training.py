@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+Training-Set Extractor.
+
+Selects recorded samples by label and subject, runs each through the
+headless range-Doppler pipeline (`dsp.RangeDopplerProcessor`) in parallel
+worker processes and cuts the maps into fixed-shape windows.  Windows are
+written to memory-mapped `.npy` shards so training jobs can stream them
+without opening the HDF5 database:
+
+    OUT_DIR/
+        index.json                  classes, shapes and the list of shards
+        shard_<sample>_<K>_x.npy    float32 [windows x frames x rx x
+                                    doppler x range]
+        shard_<sample>_<K>_y.npy    uint8 [windows x classes] multi-hot labels
+        shard_<sample>_<K>_chunk.npy int64 [windows] first chunk of each window
+
+    python extract_training.py DATABASE OUT_DIR --label walking --subject j_doe
+
+Author: Jason Merlo
+Maintainer: Jason Merlo (merlojas@msu.edu)
+"""
+import argparse
+import functools
+import json
+import multiprocessing
+import os
+
+import h5py
+import numpy as np
+
+import dsp
+import precision
+
+# === CONSTANTS ===============================================================
+DEFAULT_FRAME_HOP = 32      # pulses between range-Doppler frames
+DEFAULT_WINDOW = 16         # frames per training window
+DEFAULT_SHARD_SIZE = 256    # windows per shard
+READ_CHUNKS = 4096          # chunks read from HDF5 at a time
+INDEX = 'index.json'
+
+
+def sample_labels(ds):
+    return [l for l in dsp.decode_attr(ds, 'label').split(',') if l]
+
+
+def select_samples(db, labels=None, subjects=None):
+    """
+    Return the `/samples` datasets matching any of `labels` and any of
+    `subjects` (either filter may be empty to match everything).
+    """
+    selected = []
+    for name, ds in db['samples'].items():
+        if labels and not set(labels) & set(sample_labels(ds)):
+            continue
+        if subjects and dsp.decode_attr(ds, 'subject') not in subjects:
+            continue
+        selected.append(name)
+    return selected
+
+
+def range_slice(fast_fft_size, max_bins):
+    """Slice of the non-negative beat frequencies, at most `max_bins`."""
+    start = fast_fft_size // 2
+    stop = fast_fft_size if max_bins is None else min(start + max_bins,
+                                                      fast_fft_size)
+    return slice(start, stop)
+
+
+def window_shape(config):
+    rng = range_slice(config['fast_fft_size'], config['range_bins'])
+    return (config['window'], len(dsp.DAQ_INDEX), config['slow_fft_size'],
+            rng.stop - rng.start)
+
+
+class ShardWriter(object):
+    """Fill fixed-size `.npy` shards through `open_memmap`."""
+
+    def __init__(self, out_dir, prefix, shape, num_classes, shard_size):
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.shape = shape
+        self.num_classes = num_classes
+        self.shard_size = shard_size
+        self.shards = []
+        self.x = self.y = self.chunk = None
+        self.fill = 0
+
+    def open_shard(self):
+        base = '{}_{:d}'.format(self.prefix, len(self.shards))
+        path = functools.partial(os.path.join, self.out_dir)
+        self.x = np.lib.format.open_memmap(
+            path(base + '_x.npy'), 'w+', np.float32,
+            (self.shard_size,) + self.shape)
+        self.y = np.lib.format.open_memmap(
+            path(base + '_y.npy'), 'w+', np.uint8,
+            (self.shard_size, self.num_classes))
+        self.chunk = np.lib.format.open_memmap(
+            path(base + '_chunk.npy'), 'w+', np.int64, (self.shard_size,))
+        self.shards.append(dict(x=base + '_x.npy', y=base + '_y.npy',
+                                chunk=base + '_chunk.npy', count=0))
+        self.fill = 0
+
+    def append(self, window, label_vec, chunk):
+        if self.x is None or self.fill == self.shard_size:
+            self.flush()
+            self.open_shard()
+        self.x[self.fill] = window
+        self.y[self.fill] = label_vec
+        self.chunk[self.fill] = chunk
+        self.fill += 1
+        self.shards[-1]['count'] = self.fill
+
+    def flush(self):
+        if self.x is not None:
+            for arr in (self.x, self.y, self.chunk):
+                arr.flush()
+            self.x = self.y = self.chunk = None
+
+    def close(self):
+        """Flush and trim the last shard to the windows actually written."""
+        last_fill = self.fill
+        self.flush()
+        if self.shards and last_fill < self.shard_size:
+            shard = self.shards[-1]
+            for key in ('x', 'y', 'chunk'):
+                path = os.path.join(self.out_dir, shard[key])
+                arr = np.load(path, mmap_mode='r')[:last_fill]
+                np.save(path + '.tmp.npy', arr)
+                del arr
+                os.replace(path + '.tmp.npy', path)
+        return self.shards
+
+
+def extract_sample(name, db_path, out_dir, classes, config):
+    """
+    Process one sample into shards; runs in a worker process.
+
+    Returns the shard records for the index.
+    """
+    processor = dsp.RangeDopplerProcessor(
+        dsp.DAQ_INDEX, config['sample_rate'], dsp.PULSE,
+        fast_fft_size=config['fast_fft_size'],
+        slow_fft_size=config['slow_fft_size'],
+        slow_fft_len=config['slow_fft_size'], dtype=np.complex64)
+    rng = range_slice(config['fast_fft_size'], config['range_bins'])
+    hop = config['frame_hop']
+    window = config['window']
+    window_hop = config['window_hop']
+
+    with h5py.File(db_path, 'r') as db:
+        ds = db['samples'][name]
+        if ds.attrs.get('sample_rate', config['sample_rate']) != \
+                config['sample_rate']:
+            print('(extract) skipping {}: sample rate {}'.format(
+                name, ds.attrs['sample_rate']))
+            return []
+        label_vec = np.isin(classes, sample_labels(ds)).astype(np.uint8)
+        subject = dsp.decode_attr(ds, 'subject')
+        writer = ShardWriter(out_dir, 'shard_' + name, window_shape(config),
+                             len(classes), config['shard_size'])
+
+        # Ring of the last `window` frames
+        frames = np.empty(window_shape(config), np.float32)
+        num_frames = 0
+        buf = None
+        # Whole frames per read so the frame grid spans reads
+        step = max(READ_CHUNKS // hop, 1) * hop
+        for start in range(0, ds.shape[0], step):
+            stop = min(start + step, ds.shape[0])
+            if buf is None or len(buf) != stop - start:
+                buf = np.empty((stop - start,) + ds.shape[1:], np.float32)
+            precision.read_native(ds, np.s_[start:stop], out=buf)
+            for pos in range(0, len(buf), hop):
+                rd = processor.process_batch(buf[pos:pos + hop])
+                if rd is None or len(buf[pos:pos + hop]) < hop:
+                    continue
+                frames[num_frames % window] = rd[..., rng]
+                num_frames += 1
+                if (num_frames >= window
+                        and (num_frames - window) % window_hop == 0):
+                    # Oldest frame first
+                    order = np.arange(num_frames - window, num_frames) % window
+                    first_chunk = (start + pos + hop) - window * hop
+                    writer.append(frames[order], label_vec, first_chunk)
+        shards = writer.close()
+
+    for shard in shards:
+        shard.update(sample=name, subject=subject,
+                     label=label_vec.tolist())
+    print('(extract) {}: {} windows'.format(
+        name, sum(s['count'] for s in shards)))
+    return shards
+
+
+def extract(db_path, out_dir, labels=None, subjects=None, classes=None,
+            sample_rate=dsp.SAMPLE_RATE, fast_fft_size=dsp.FAST_FFT_SIZE,
+            slow_fft_size=dsp.SLOW_FFT_SIZE, range_bins=None,
+            frame_hop=DEFAULT_FRAME_HOP, window=DEFAULT_WINDOW,
+            window_hop=None, shard_size=DEFAULT_SHARD_SIZE, workers=None):
+    """Extract every selected sample in parallel and write the index."""
+    os.makedirs(out_dir, exist_ok=True)
+    with h5py.File(db_path, 'r') as db:
+        names = select_samples(db, labels, subjects)
+        if classes is None:
+            classes = sorted(set(labels) if labels else
+                             {l for n in names
+                              for l in sample_labels(db['samples'][n])})
+    if not names:
+        print('No samples match the selection')
+        return None
+
+    config = dict(sample_rate=sample_rate, fast_fft_size=fast_fft_size,
+                  slow_fft_size=slow_fft_size, range_bins=range_bins,
+                  frame_hop=frame_hop, window=window,
+                  window_hop=window_hop or window, shard_size=shard_size)
+    job = functools.partial(extract_sample, db_path=db_path, out_dir=out_dir,
+                            classes=np.asarray(classes), config=config)
+    shards = []
+    with multiprocessing.Pool(workers) as pool:
+        for sample_shards in pool.imap(job, names):
+            shards.extend(sample_shards)
+
+    index = dict(database=os.path.abspath(db_path), classes=list(classes),
+                 shape=list(window_shape(config)), dtype='float32',
+                 config=config, count=sum(s['count'] for s in shards),
+                 shards=shards)
+    with open(os.path.join(out_dir, INDEX), 'w') as fp:
+        json.dump(index, fp, indent=1)
+    print('{} windows from {} samples in {} shards'.format(
+        index['count'], len(names), len(shards)))
+    return index
+
+
+class TrainingSet(object):
+    """
+    Random access to an extracted training set without loading it.
+
+    `ts[i]` returns (features, labels) of window `i`; every shard is
+    opened with `mmap_mode='r'`.
+    """
+
+    def __init__(self, out_dir):
+        with open(os.path.join(out_dir, INDEX)) as fp:
+            self.index = json.load(fp)
+        self.classes = self.index['classes']
+        self.shards = [
+            (np.load(os.path.join(out_dir, s['x']), mmap_mode='r'),
+             np.load(os.path.join(out_dir, s['y']), mmap_mode='r'))
+            for s in self.index['shards']]
+        self.starts = np.cumsum([0] + [s['count']
+                                       for s in self.index['shards']])
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def __getitem__(self, idx):
+        shard = np.searchsorted(self.starts, idx, side='right') - 1
+        x, y = self.shards[shard]
+        return x[idx - self.starts[shard]], y[idx - self.starts[shard]]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Extract labelled range-Doppler windows for training')
+    parser.add_argument('database')
+    parser.add_argument('out_dir')
+    parser.add_argument('--label', action='append',
+                        help='select samples with this label (repeatable)')
+    parser.add_argument('--subject', action='append',
+                        help='select samples of this subject (repeatable)')
+    parser.add_argument('--classes', nargs='+',
+                        help='label vector order (default: selected labels)')
+    parser.add_argument('--sample-rate', type=int, default=dsp.SAMPLE_RATE)
+    parser.add_argument('--range-bins', type=int, default=None,
+                        help='keep only the first N positive range bins')
+    parser.add_argument('--frame-hop', type=int, default=DEFAULT_FRAME_HOP,
+                        help='pulses between frames')
+    parser.add_argument('--window', type=int, default=DEFAULT_WINDOW,
+                        help='frames per window')
+    parser.add_argument('--window-hop', type=int, default=None,
+                        help='frames between windows (default: --window)')
+    parser.add_argument('--shard-size', type=int, default=DEFAULT_SHARD_SIZE,
+                        help='windows per shard')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes (default: all cores)')
+    args = parser.parse_args()
+
+    extract(args.database, args.out_dir, labels=args.label,
+            subjects=args.subject, classes=args.classes,
+            sample_rate=args.sample_rate, range_bins=args.range_bins,
+            frame_hop=args.frame_hop, window=args.window,
+            window_hop=args.window_hop, shard_size=args.shard_size,
+            workers=args.workers)
+
+
+if __name__ == '__main__':
+    main()
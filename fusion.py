@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-Array Fusion Classes.
+
+Runs one acquisition -> range-Doppler pipeline per sensor head in its own
+process, time-aligns the per-head detections and fuses them into a single
+track by trilateration across heads.
+
+Each head worker uses the headless `dsp.RangeDopplerProcessor`, so the
+per-head processing scales across cores without touching Qt.
+
+Author: Jason Merlo
+Maintainer: Jason Merlo (merlojas@msu.edu)
+"""
+import collections
+import multiprocessing
+import queue
+import time
+
+import numpy as np
+
+from pyratk.acquisition import daq    # DAQ base class
+
+import dsp
+import net_daq
+import shm_ring
+
+# === CONSTANTS ===============================================================
+# Maximum timestamp spread of detections fused into one frame (s)
+DEFAULT_TOLERANCE = 0.02
+# Pulses between detection reports from each head
+DEFAULT_FRAME_STRIDE = 32
+# Reports kept per head while waiting for the other heads
+DEFAULT_MAX_PENDING = 128
+# A head silent for this long (s) is fused without until it reports again
+DEFAULT_STALL_TIMEOUT = 0.5
+# Detections of a head that has nothing to report for a frame
+NO_DETECTIONS = np.empty((0, 4))
+
+# source is 'HOST[:PORT]' of a capture agent, 'ring:NAME' of a shared-memory
+# ring written by another dashboard, or 'synthetic'
+HeadConfig = collections.namedtuple('HeadConfig',
+                                    ['name', 'source', 'location'])
+
+
+def parse_head(spec):
+    """Parse a 'SOURCE@X,Y' head specification into a `HeadConfig`."""
+    source, _, loc = spec.partition('@')
+    x, y = (float(v) for v in loc.split(',')) if loc else (0.0, 0.0)
+    return HeadConfig(name=source, source=source, location=(x, y))
+
+
+def _open_head_source(head, rd_config):
+    """
+    Return a callable `read_batch(max_count)` for a head.
+
+    It yields (seq, timestamp, block) with `block` shaped
+    `(K, num_channels, chunk_size)`.
+    """
+    if head.source == 'synthetic':
+        chunk_size = int(rd_config['sample_rate'] * rd_config['pulse'].delay)
+        source = net_daq.SyntheticChunkSource(
+            sample_rate=rd_config['sample_rate'],
+            sample_chunk_size=chunk_size)
+        counter = [0]
+
+        def read_batch(max_count):
+            seq = counter[0]
+            counter[0] += max_count
+            chunks = [source()]
+            # Capture time of the first chunk, as stamped by CaptureAgent
+            timestamp = time.time()
+            chunks.extend(source() for _ in range(max_count - 1))
+            return seq, timestamp, np.stack(chunks)
+        return read_batch
+
+    if head.source.startswith('ring:'):
+        reader = shm_ring.RingReader(head.source[len('ring:'):])
+
+        def read_batch(max_count):
+            # Zero-copy views; they are processed before the writer can
+            # come round the ring again
+            seq, times, block = reader.wait(max_count)
+            return seq, float(times[0]), block
+        return read_batch
+
+    host, _, port = head.source.partition(':')
+    client = net_daq.ChunkClient(
+        host, int(port) if port else net_daq.DEFAULT_PORT)
+    return client.read_batch
+
+
+def head_worker(head_idx, head, rd_config, out_queue, stop_event,
+                frame_stride=DEFAULT_FRAME_STRIDE):
+    """
+    Acquire and process one head, reporting detections to `out_queue`.
+
+    Runs in its own process; only the small detection arrays cross the
+    process boundary.  Pulses are read and transformed in batches sized by
+    a `BatchSizeController`.
+    """
+    read_batch = _open_head_source(head, rd_config)
+    processor = dsp.RangeDopplerProcessor(**rd_config)
+    controller = dsp.BatchSizeController(rd_config['pulse'].delay)
+
+    count = 0
+    while not stop_event.is_set():
+        item = read_batch(controller.batch_size)
+        if item is None:
+            break
+        seq, timestamp, block = item
+
+        start = time.perf_counter()
+        processor.process_batch(block)
+        controller.update(len(block), time.perf_counter() - start)
+
+        # Report once per frame_stride pulses
+        prev = count
+        count += len(block)
+        if (count // frame_stride > prev // frame_stride
+                and processor.range_doppler is not None):
+            out_queue.put((head_idx, timestamp, processor.detect()))
+    out_queue.put((head_idx, None, None))
+
+
+class TimeAligner(object):
+    """
+    Pair up per-head reports whose timestamps agree within `tolerance`.
+
+    Reports older than the newest head's front report by more than
+    `tolerance` can never be matched and are dropped.  Each head keeps at
+    most `max_pending` reports.  A head that has stopped, or has reported
+    nothing for `stall_timeout` seconds of the other heads' time, is fused
+    without (it contributes no detections) so the other heads never wait
+    on it.
+    """
+
+    def __init__(self, num_heads, tolerance=DEFAULT_TOLERANCE,
+                 max_pending=DEFAULT_MAX_PENDING,
+                 stall_timeout=DEFAULT_STALL_TIMEOUT):
+        self.tolerance = tolerance
+        self.stall_timeout = stall_timeout
+        self.pending = [collections.deque(maxlen=max_pending)
+                        for _ in range(num_heads)]
+        self.active = [True] * num_heads
+        self.dropped = 0
+
+    def add(self, head_idx, timestamp, detections):
+        q = self.pending[head_idx]
+        if len(q) == q.maxlen:
+            self.dropped += 1
+        q.append((timestamp, detections))
+
+    def remove(self, head_idx):
+        """Stop waiting for a head that will not report again."""
+        self.active[head_idx] = False
+
+    def waiting(self):
+        """True while an active head with no reports may still catch up."""
+        fronts = [q[0][0] for q in self.pending if q]
+        if not fronts:
+            return True
+        newest = max(q[-1][0] for q in self.pending if q)
+        if newest - min(fronts) >= self.stall_timeout:
+            return False
+        return any(active and not q
+                   for active, q in zip(self.active, self.pending))
+
+    def pop_aligned(self):
+        """Return a list of (timestamp, [detections per head]) frames."""
+        frames = []
+        while not self.waiting():
+            present = [q for q in self.pending if q]
+            ref = max(q[0][0] for q in present)
+            stale = False
+            for q in present:
+                while q and q[0][0] < ref - self.tolerance:
+                    q.popleft()
+                    self.dropped += 1
+                if not q:
+                    stale = True
+            if stale:
+                # Something was dropped; check again for a full frame
+                continue
+            frames.append((ref, [q.popleft()[1] if q else NO_DETECTIONS
+                                 for q in self.pending]))
+        return frames
+
+
+class Track(object):
+    """Single fused track; `state` is [x, y, vx, vy]."""
+
+    def __init__(self, position, timestamp):
+        self.state = np.array([position[0], position[1], 0.0, 0.0])
+        self.timestamp = timestamp
+
+
+class FusionTracker(object):
+    """
+    Alpha-beta tracker fed by trilaterated positions from several heads.
+
+    Exposes `tracks` and `detections` like the single-array tracker so it
+    can be shown by the tracker widget.
+    """
+
+    def __init__(self, heads, alpha=0.5, beta=0.1):
+        self.locations = np.array([h.location for h in heads], dtype=float)
+        self.alpha = alpha
+        self.beta = beta
+        self.tracks = []
+        self.detections = np.empty((0, 2))
+
+    def reset(self):
+        self.tracks = []
+        self.detections = np.empty((0, 2))
+
+    def trilaterate(self, ranges):
+        """
+        Estimate an (x, y) position from one range per head.
+
+        Uses linear least squares with three or more heads; with two heads
+        the circle intersection in front of the array (y >= 0) is used.
+        """
+        valid = ~np.isnan(ranges)
+        loc = self.locations[valid]
+        r = ranges[valid]
+        if len(r) >= 3:
+            a = 2 * (loc[1:] - loc[0])
+            b = (r[0] ** 2 - r[1:] ** 2
+                 + np.sum(loc[1:] ** 2, axis=1) - np.sum(loc[0] ** 2))
+            return np.linalg.lstsq(a, b, rcond=None)[0]
+        if len(r) == 2:
+            d = np.linalg.norm(loc[1] - loc[0])
+            if d == 0:
+                return None
+            a = (r[0] ** 2 - r[1] ** 2 + d ** 2) / (2 * d)
+            h = np.sqrt(max(r[0] ** 2 - a ** 2, 0.0))
+            u = (loc[1] - loc[0]) / d
+            base = loc[0] + a * u
+            normal = np.array([-u[1], u[0]])
+            p1, p2 = base + h * normal, base - h * normal
+            return p1 if p1[1] >= p2[1] else p2
+        return None
+
+    def update(self, timestamp, head_detections):
+        """Fuse one aligned frame of per-head detections."""
+        ranges = np.full(len(head_detections), np.nan)
+        for idx, det in enumerate(head_detections):
+            if len(det):
+                # Strongest detection across the head's receivers
+                ranges[idx] = abs(det[det[:, 3].argmax(), 1])
+
+        position = self.trilaterate(ranges)
+        if position is None:
+            return
+        self.detections = np.asarray(position).reshape(1, 2)
+
+        if not self.tracks:
+            self.tracks = [Track(position, timestamp)]
+            return
+
+        track = self.tracks[0]
+        dt = max(timestamp - track.timestamp, 1e-6)
+        predicted = track.state[:2] + track.state[2:] * dt
+        residual = position - predicted
+        track.state[:2] = predicted + self.alpha * residual
+        track.state[2:] += self.beta * residual / dt
+        track.timestamp = timestamp
+
+
+class FusionSource(daq.DAQ):
+    """
+    DataManager source standing in for the head workers in fusion mode.
+
+    Acquisition and processing happen in the workers, so this source never
+    emits chunks; it gives the data window and control panel a source to
+    query and pause.
+    """
+
+    def __init__(self, heads, sample_rate=None, sample_chunk_size=None):
+        super(FusionSource, self).__init__()
+        self.daq_type = 'Fusion ({:d} heads)'.format(len(heads))
+        self.sample_rate = sample_rate
+        self.sample_chunk_size = sample_chunk_size
+        self.paused = False
+
+    def get_samples(self, stride=1, loop=-1, playback_speed=1):
+        """Nothing to acquire; heads report through `FusionManager.poll`."""
+        return
+
+    def close(self):
+        self.running = False
+
+
+class FusionManager(object):
+    """Start one worker process per head and collect aligned frames."""
+
+    def __init__(self, heads, rd_config, tolerance=DEFAULT_TOLERANCE,
+                 frame_stride=DEFAULT_FRAME_STRIDE):
+        self.heads = heads
+        # 'spawn' keeps the workers free of the parent's Qt state
+        ctx = multiprocessing.get_context('spawn')
+        self.out_queue = ctx.Queue()
+        self.stop_event = ctx.Event()
+        self.aligner = TimeAligner(len(heads), tolerance)
+
+        self.workers = []
+        for idx, head in enumerate(heads):
+            p = ctx.Process(
+                target=head_worker,
+                args=(idx, head, rd_config, self.out_queue, self.stop_event,
+                      frame_stride),
+                daemon=True)
+            p.start()
+            self.workers.append(p)
+
+    def poll(self):
+        """Drain worker reports and return any newly aligned frames."""
+        while True:
+            try:
+                head_idx, timestamp, detections = self.out_queue.get_nowait()
+            except queue.Empty:
+                break
+            if timestamp is None:
+                print('(fusion) head {} stopped; fusing without it'.format(
+                    self.heads[head_idx].name))
+                self.aligner.remove(head_idx)
+                continue
+            self.aligner.add(head_idx, timestamp, detections)
+        return self.aligner.pop_aligned()
+
+    def close(self):
+        self.stop_event.set()
+        for p in self.workers:
+            p.join(timeout=1)
+            if p.is_alive():
+                p.terminate()
@@ -11,17 +11,49 @@ Maintainer: Jason Merlo (merlojas@msu.edu)
 import pyqtgraph as pg                  # Graph Elements
 from pyqtgraph import QtCore, QtGui     # Qt Elements
 from custom_ui import QHLine             # Horizontal dividers
+# === Math ===
+import numpy as np
+# === Background Loading ===
+import os
+import threading
 # === GUI Panels ===
-from pyratk.widgets import fft_widget, spectrogram_widget, iq_widget, range_doppler_widget, polar_tracker_widget
+from startup_profile import lazy_import, profiler
+fft_widget = lazy_import('pyratk.widgets.fft_widget')
+spectrogram_widget = lazy_import('pyratk.widgets.spectrogram_widget')
+iq_widget = lazy_import('pyratk.widgets.iq_widget')
+range_doppler_widget = lazy_import('pyratk.widgets.range_doppler_widget')
+polar_tracker_widget = lazy_import('pyratk.widgets.polar_tracker_widget')
+# === Processed-Product Cache ===
+product_cache = lazy_import('product_cache')
+# === Database Maintenance ===
+db_compact = lazy_import('db_compact')
+overview = lazy_import('overview')
 
 class GraphPanel(pg.LayoutWidget):
-    def __init__(self, radar_array, tracker):
+    def __init__(self, radar_array, tracker, deferred=False):
         pg.LayoutWidget.__init__(self)
 
+        self.built = False
+        if deferred:
+            # Plots are built by `build` once the pipeline exists
+            self.loading_label = QtGui.QLabel('Loading plots...')
+            self.loading_label.setAlignment(QtCore.Qt.AlignCenter)
+            self.addWidget(self.loading_label)
+        else:
+            self.loading_label = None
+            self.build(radar_array, tracker)
+
+    def build(self, radar_array, tracker):
         # Copy member objects
         self.radar_array = radar_array
         self.tracker = tracker
 
+        if self.loading_label is not None:
+            self.layout.removeWidget(self.loading_label)
+            self.loading_label.deleteLater()
+            self.loading_label = None
+            self.nextRow()
+
         self.tracker_widget = polar_tracker_widget.PolarTrackerWidget(tracker)
         self.addWidget(self.tracker_widget, colspan=2)
         self.nextRow()
@@ -67,8 +99,11 @@ class GraphPanel(pg.LayoutWidget):
 
         # Remove extra margins around plot widgets
         self.layout.setContentsMargins(0, 0, 0, 0)
+        self.built = True
 
     def update(self):
+        if not self.built:
+            return
         self.tracker_widget.update()
         # for row in self.iq_widget_array:
         #     for rw in row:
@@ -78,6 +113,8 @@ class GraphPanel(pg.LayoutWidget):
                 rw.update()
 
     def reset(self):
+        if not self.built:
+            return
         self.tracker_widget.reset()
         # for row in self.iq_widget_array:
         #     for rw in row:
@@ -87,11 +124,187 @@ class GraphPanel(pg.LayoutWidget):
                 rw.reset()
 
 
+class RemoteGraphPanel(pg.LayoutWidget):
+    """Display products received from a remote `TelemetrySource`."""
+
+    def __init__(self, source):
+        pg.LayoutWidget.__init__(self)
+
+        # Copy member objects
+        self.source = source
+
+        # Tracks are plotted in x/y from the first two state elements
+        self.track_plot = pg.PlotWidget(title='Tracks')
+        self.track_plot.setAspectLocked(True)
+        self.track_scatter = pg.ScatterPlotItem(size=10)
+        self.track_plot.addItem(self.track_scatter)
+        # Range and speed labels, one per track
+        self.track_labels = []
+        self.addWidget(self.track_plot, colspan=2)
+        self.nextRow()
+
+        # Range-Doppler images are created as products first arrive
+        self.rd_images = {}
+
+        # Remove extra margins around plot widgets
+        self.layout.setContentsMargins(0, 0, 0, 0)
+
+    def update(self):
+        products = self.source.products
+        for name in sorted(products):
+            if not name.startswith('range_doppler'):
+                continue
+            if name not in self.rd_images:
+                plot = pg.PlotWidget(title=name)
+                image = pg.ImageItem()
+                plot.addItem(image)
+                self.addWidget(plot)
+                self.rd_images[name] = image
+            self.rd_images[name].setImage(
+                np.log10(products[name] + 1e-12).T, autoLevels=True)
+
+        tracks = products.get('tracks')
+        if tracks is not None and tracks.shape[-1] >= 2:
+            self.track_scatter.setData(tracks[:, 0], tracks[:, 1])
+        else:
+            self.track_scatter.clear()
+            tracks = ()
+        self.label_tracks(tracks)
+
+    def label_tracks(self, tracks):
+        """Annotate each [x, y, vx, vy, ...] track with range and speed."""
+        while len(self.track_labels) < len(tracks):
+            label = pg.TextItem(anchor=(0, 1))
+            self.track_plot.addItem(label)
+            self.track_labels.append(label)
+        for idx, label in enumerate(self.track_labels):
+            if idx >= len(tracks):
+                label.setText('')
+                continue
+            state = tracks[idx]
+            x, y = state[0], state[1]
+            rng = np.hypot(x, y)
+            text = 'T{:d}  {:.2f} m'.format(idx, rng)
+            if len(state) >= 4:
+                # Radial component of the velocity
+                rate = (x * state[2] + y * state[3]) / max(rng, 1e-9)
+                text += '  {:+.2f} m/s'.format(rate)
+            label.setText(text)
+            label.setPos(x, y)
+
+    def set_polar_grid(self, max_range, rings=4, fov=np.pi):
+        """
+        Draw range rings and bearing spokes out to `max_range` (m) so the
+        track plot reads like the dashboard's polar tracker.
+        """
+        angles = np.linspace(-fov / 2, fov / 2, 91)
+        pen = pg.mkPen(color=(100, 100, 100), style=QtCore.Qt.DashLine)
+        for rng in np.linspace(0, max_range, rings + 1)[1:]:
+            self.track_plot.plot(rng * np.sin(angles), rng * np.cos(angles),
+                                 pen=pen)
+            ring_label = pg.TextItem('{:.0f} m'.format(rng),
+                                     color=(150, 150, 150))
+            ring_label.setPos(0, rng)
+            self.track_plot.addItem(ring_label)
+        for angle in np.linspace(-fov / 2, fov / 2, 7):
+            self.track_plot.plot([0, max_range * np.sin(angle)],
+                                 [0, max_range * np.cos(angle)], pen=pen)
+        self.track_plot.setXRange(-max_range, max_range)
+        self.track_plot.setYRange(0, max_range)
+
+    def reset(self):
+        self.track_scatter.clear()
+        self.label_tracks(())
+        for image in self.rd_images.values():
+            image.clear()
+
+
+class OverviewWidget(pg.GraphicsLayoutWidget):
+    """
+    Thumbnail of a recording's stored overview (Doppler spectrogram over
+    the RMS envelope).  Clicking or dragging the cursor requests a jump to
+    that time.
+    """
+
+    # Emitted with the selected time in seconds
+    seek_requested = QtCore.Signal(float)
+
+    # Finest RMS level drawn
+    MAX_BINS = 2000
+
+    def __init__(self):
+        pg.GraphicsLayoutWidget.__init__(self)
+        self.setFixedHeight(180)
+
+        self.spec_plot = self.addPlot()
+        self.spec_plot.hideAxis('bottom')
+        # Strongest range bin of each slow-time (Doppler) bin
+        self.spec_plot.setLabel('left', 'Doppler', units='Hz')
+        self.spec_image = pg.ImageItem()
+        self.spec_plot.addItem(self.spec_image)
+        self.nextRow()
+
+        self.rms_plot = self.addPlot()
+        self.rms_plot.setLabel('bottom', 'Time', units='s')
+        self.rms_plot.setXLink(self.spec_plot)
+        self.rms_curve = self.rms_plot.plot()
+
+        self.cursor = pg.InfiniteLine(angle=90, movable=True)
+        self.rms_plot.addItem(self.cursor)
+        self.cursor.sigPositionChangeFinished.connect(
+            lambda line: self.seek_requested.emit(max(line.value(), 0.0)))
+        self.scene().sigMouseClicked.connect(self.mouse_clicked)
+
+    def show_overview(self, ov):
+        """Draw an `/overviews/<name>` group, or clear for None."""
+        if ov is None:
+            self.spec_image.clear()
+            self.rms_curve.clear()
+            return
+        chunk_period = (float(ov.attrs['sample_chunk_size'])
+                        / ov.attrs['sample_rate'])
+
+        rms, chunks_per_bin = overview.rms_level(ov, self.MAX_BINS)
+        t = np.arange(len(rms)) * chunks_per_bin * chunk_period
+        self.rms_curve.setData(t, rms.mean(axis=1))
+
+        spec = ov['spectrogram'][()]
+        if len(spec):
+            # Sum the receivers' power
+            power = 10 * np.log10((10 ** (spec / 10)).sum(axis=1))
+            prf = 1.0 / chunk_period
+            self.spec_image.setImage(power, autoLevels=True)
+            self.spec_image.setRect(QtCore.QRectF(
+                0, -prf / 2, len(spec) * ov.attrs['spec_chunks']
+                * chunk_period, prf))
+        else:
+            self.spec_image.clear()
+        self.cursor.setValue(0)
+
+    def mouse_clicked(self, event):
+        pos = self.rms_plot.vb.mapSceneToView(event.scenePos())
+        self.cursor.setValue(max(pos.x(), 0.0))
+        self.seek_requested.emit(self.cursor.value())
+
+
 class ControlPanel(pg.LayoutWidget):
     """Handle dataset controls, and label controls."""
 
-    def __init__(self, app, data_mgr, graph_panels):
+    # Emitted from the background loader with the list of dataset keys
+    datasets_loaded = QtCore.Signal(object)
+    # Emitted with a CachedPlayer when a dataset plays from the product
+    # cache, and with None when live processing resumes
+    cache_playback = QtCore.Signal(object)
+    # Emitted from the compaction thread with (temp_path, stats or error)
+    compaction_done = QtCore.Signal(object)
+    # Emitted from the digest thread with (dataset, digest)
+    digest_ready = QtCore.Signal(object)
+    # Emitted from the overview thread with (sample name, None or error)
+    overview_done = QtCore.Signal(object)
+
+    def __init__(self, app, data_mgr, graph_panels, deferred=False):
         pg.LayoutWidget.__init__(self)
+        self.deferred = deferred
 
         #======================================================================
         # todo TEMPORARY
@@ -106,6 +319,21 @@ class ControlPanel(pg.LayoutWidget):
         self.app = app
         self.data_mgr = data_mgr
         self.graph_panels = graph_panels
+        # Set by AsyncRuntime when running on the asyncio loop
+        self.runtime = None
+        # Optional bounded capture buffer used instead of the manager's own
+        self.capture = None
+        # Optional processed-product cache, see set_product_cache
+        self.product_cache = None
+        self.cache_pipeline = None
+        self.digest_ready.connect(self.attach_digest)
+        self.overview_done.connect(self.finish_overview)
+        self.recorder = None
+        self.player = None
+        # Dataset being played back, reloaded after compaction
+        self.loaded_ds_name = None
+        # Seek (s) applied once the selected dataset has been loaded
+        self.pending_seek = None
 
         # Add buttons to screen
         self.add_source_buttons()
@@ -170,7 +398,10 @@ class ControlPanel(pg.LayoutWidget):
         self.nextRow()
         self.addWidget(self.daq_type_label)
 
-        self.update_control_attr_labels()
+        # A deferred panel is built before the DAQ; start_pipeline updates
+        # the labels once there is a source
+        if not self.deferred:
+            self.update_control_attr_labels()
 
         # Align widgets to top instead of center
         # self.layout.setAlignment(self.pause_button, QtCore.Qt.AlignTop)
@@ -223,6 +454,11 @@ class ControlPanel(pg.LayoutWidget):
         self.load_database_button.clicked.connect(
             self.load_database_button_handler)
 
+        self.compact_database_button = QtGui.QPushButton('Compact Database')
+        self.compact_database_button.clicked.connect(
+            self.compact_database_button_handler)
+        self.compaction_done.connect(self.finish_compaction)
+
         # Add widgets to layout
         self.addWidget(self.database_label)
         self.nextRow()
@@ -230,6 +466,8 @@ class ControlPanel(pg.LayoutWidget):
         self.nextRow()
 
         self.addWidget(self.load_database_button)
+        self.nextRow()
+        self.addWidget(self.compact_database_button)
 
     def add_dataset_buttons(self):
         # Add label
@@ -278,23 +516,186 @@ class ControlPanel(pg.LayoutWidget):
 
     def add_dataset_list(self):
         self.dataset_list = QtGui.QListWidget()
+        self.datasets_loaded.connect(self.populate_dataset_list)
 
         # Load datasets
-        self.update_dataset_list()
+        if self.deferred:
+            QtGui.QListWidgetItem('Loading datasets...', self.dataset_list)
+            threading.Thread(target=self.load_dataset_keys,
+                             daemon=True).start()
+        else:
+            self.update_dataset_list()
+
+        # Overview of the selected dataset
+        self.overview_widget = OverviewWidget()
+        self.dataset_list.currentItemChanged.connect(self.dataset_selected)
+        self.overview_widget.seek_requested.connect(self.seek_dataset)
 
         # Add widget to main window
         self.addWidget(self.dataset_list)
+        self.nextRow()
+        self.addWidget(self.overview_widget)
 
 # =============================================================================
 # === HELPER FUNCTIONS ========================================================
 # =============================================================================
 
     def update_dataset_list(self):
+        self.populate_dataset_list(self.data_mgr.get_datasets())
+
+    def load_dataset_keys(self):
+        '''
+        Enumerates the database off the GUI thread.
+
+        The list is handed back to the GUI thread through a queued signal.
+        '''
+        keys = list(self.data_mgr.get_datasets())
+        self.datasets_loaded.emit(keys)
+
+    def populate_dataset_list(self, ds_keys):
         self.dataset_list.clear()
-        for ds_key in self.data_mgr.get_datasets():
+        for ds_key in ds_keys:
             name = ds_key.name.split('/')[-1]
             item = QtGui.QListWidgetItem(name, self.dataset_list)
             item.setData(1, ds_key)
+        profiler.mark('dataset list loaded')
+
+    def save_buffer(self, name, labels, subject, notes):
+        if self.capture is not None:
+            self.capture.save_buffer(name, labels, subject, notes)
+        else:
+            self.data_mgr.save_buffer(name, labels, subject, notes)
+        self.build_overview(name)
+
+    def build_overview(self, name):
+        '''
+        Stores the overview and content digest of `/samples/<name>` on a
+        background thread.
+
+        Buttons that modify the database are disabled until
+        `finish_overview`.
+        '''
+        db = self.data_mgr.db
+        ds = db['samples'][name]
+        self.set_database_buttons_enabled(False)
+
+        def run():
+            error = None
+            try:
+                digest = product_cache.DigestBuilder(
+                    ds.shape, ds.dtype, ds.attrs.get('sample_rate'),
+                    ds.attrs.get('sample_chunk_size'))
+                overview.store_overview(db, ds, also=(digest,))
+                product_cache.store_digest(ds, digest.hexdigest())
+            except Exception as e:
+                error = e
+            self.overview_done.emit((name, error))
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def finish_overview(self, done):
+        name, error = done
+        self.set_database_buttons_enabled(True)
+        if error is not None:
+            print('(gui_panels) could not build overview of', name, error)
+            return
+        # Redraw if the saved dataset is the selected one
+        ds = self.selected_dataset()
+        if ds is not None and ds.name.split('/')[-1] == name:
+            self.dataset_selected(self.dataset_list.currentItem())
+
+    def selected_dataset(self):
+        selected_items = self.dataset_list.selectedItems()
+        if not selected_items:
+            return None
+        return self.dataset_list.indexFromItem(selected_items[0]).data(1)
+
+    def dataset_selected(self, current, previous=None):
+        ds = current.data(1) if current is not None else None
+        if ds is None:
+            self.overview_widget.show_overview(None)
+            return
+        self.overview_widget.show_overview(overview.get_overview(
+            self.data_mgr.db, ds.name.split('/')[-1]))
+
+    def seek_dataset(self, seconds):
+        '''
+        Jumps playback of the selected dataset to `seconds`, loading it
+        first if another dataset is playing.
+        '''
+        ds = self.selected_dataset()
+        if ds is None:
+            return
+        if (ds.name != self.loaded_ds_name
+                or self.data_mgr.source is not self.data_mgr.virt_daq):
+            self.pending_seek = seconds
+            self.load_dataset_button_handler()
+            return
+
+        chunk = int(seconds * ds.attrs['sample_rate']
+                    / ds.attrs['sample_chunk_size'])
+        if self.player is not None:
+            self.player.seek(chunk)
+            return
+        virt_daq = self.data_mgr.virt_daq
+        self.step(chunk - virt_daq.sample_num)
+
+    def set_product_cache(self, cache, receivers, tracker, config_digest):
+        '''
+        Enables the product cache for recorded datasets.
+
+        `config_digest` identifies the configuration of the pipeline made
+        of `receivers` and `tracker`.
+        '''
+        self.product_cache = cache
+        self.cache_pipeline = (receivers, tracker, config_digest)
+
+    def attach_product_cache(self, ds):
+        '''
+        Plays `ds` from the product cache, or records it there on a miss.
+
+        Datasets saved without a stored digest are hashed on a background
+        thread and attached once `digest_ready` arrives.
+        '''
+        self.stop_product_cache()
+        if self.product_cache is None:
+            return
+        digest = product_cache.stored_digest(ds)
+        if digest is None:
+            def run():
+                self.digest_ready.emit((ds, product_cache.dataset_digest(ds)))
+            threading.Thread(target=run, daemon=True).start()
+            return
+        self.attach_digest((ds, digest))
+
+    def attach_digest(self, result):
+        ds, digest = result
+        # Another dataset may have been loaded while hashing
+        if ds.name != self.loaded_ds_name:
+            return
+        receivers, tracker, config_digest = self.cache_pipeline
+        key = self.product_cache.key(ds, config_digest, digest)
+        entry = self.product_cache.get(key)
+        if entry is None:
+            self.recorder = product_cache.CacheRecorder(
+                self.product_cache, key, self.data_mgr, receivers, tracker,
+                ds.shape[0])
+            return
+
+        print('(gui_panels) playing from product cache:', key)
+        self.data_mgr.paused = True
+        frame_period = (entry.frame_stride * ds.attrs['sample_chunk_size']
+                        / float(ds.attrs['sample_rate']))
+        self.player = product_cache.CachedPlayer(entry, frame_period)
+        self.cache_playback.emit(self.player)
+
+    def stop_product_cache(self):
+        if self.recorder is not None:
+            self.recorder.abort()
+            self.recorder = None
+        if self.player is not None:
+            self.player = None
+            self.cache_playback.emit(None)
 
     def menu_pause_set(self):
         '''
@@ -378,6 +779,79 @@ class ControlPanel(pg.LayoutWidget):
 
         self.menu_pause_restore()
 
+    def compact_database_button_handler(self):
+        '''
+        Rewrites the database into a new file on a background thread.
+
+        Playback and capture continue meanwhile; buttons that modify the
+        database are disabled until `finish_compaction` swaps the new file
+        in.
+        '''
+        db = self.data_mgr.db
+        tmp = db_compact.temp_path(db.filename)
+        self.set_database_buttons_enabled(False)
+        print('(gui_panels) compacting database:', db.filename)
+
+        def run():
+            try:
+                result = db_compact.compact_file(db, tmp)
+            except Exception as e:
+                result = e
+            self.compaction_done.emit((tmp, result))
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def finish_compaction(self, done):
+        tmp, result = done
+        try:
+            if isinstance(result, Exception):
+                print('(gui_panels) compaction failed:', result)
+                os.remove(tmp)
+            else:
+                self.swap_compacted(tmp, result)
+        finally:
+            self.set_database_buttons_enabled(True)
+
+    def swap_compacted(self, tmp, stats):
+        '''
+        Replaces the open database with the compacted copy `tmp`.
+
+        If the swap fails the original file, which is only replaced by a
+        complete copy, is reopened and `tmp` is removed.
+        '''
+        path = self.data_mgr.db.filename
+        paused = self.data_mgr.paused
+        self.data_mgr.paused = True
+        try:
+            try:
+                self.data_mgr.db.close()
+                os.replace(tmp, path)
+                self.data_mgr.open_database(path)
+            except Exception as e:
+                print('(gui_panels) could not swap in compacted database:',
+                      e)
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                self.data_mgr.open_database(path)
+                stats = None
+            # Playback held a dataset of the closed file
+            if (self.data_mgr.source is self.data_mgr.virt_daq
+                    and self.loaded_ds_name in self.data_mgr.db):
+                self.data_mgr.load_dataset(
+                    self.data_mgr.db[self.loaded_ds_name])
+        finally:
+            self.data_mgr.paused = paused
+        if stats is not None:
+            print('(gui_panels) compacted database:',
+                  db_compact.format_stats(stats))
+        self.update_dataset_list()
+
+    def set_database_buttons_enabled(self, enabled):
+        for button in (self.load_database_button,
+                       self.compact_database_button, self.save_button,
+                       self.edit_dataset_button, self.delete_dataset_button):
+            button.setEnabled(enabled)
+
     def save_database_as_button_handler(self):
         self.menu_pause_set()
 
@@ -404,7 +878,9 @@ class ControlPanel(pg.LayoutWidget):
                 self, title, message, options, default)
 
             if buttonReply == QtGui.QMessageBox.Yes:
+                name = item.name.split('/')[-1]
                 self.data_mgr.delete_dataset(item)
+                overview.delete_overview(self.data_mgr.db, name)
                 print("delete dataset...", item)
                 self.update_dataset_list()
 
@@ -439,17 +915,40 @@ class ControlPanel(pg.LayoutWidget):
             self.data_mgr.paused = True
 
             ds = self.dataset_list.indexFromItem(selected_items[0]).data(1)
+            if self.runtime is not None:
+                self.runtime.spawn(self.load_dataset_async(ds))
+                return
             self.data_mgr.load_dataset(ds)
             # print('(gui_panels.load_dataset) source:', self.data_mgr.source)
 
             # self.data_mgr.get_samples()
-            self.update_source_buttons()
-            # self.reset_button_handler()
+            self.loaded_dataset(ds)
 
-            self.reset_panels()
-            self.update_control_attr_labels()
-            self.rad_dataset.setEnabled(True)
-            self.data_mgr.paused = False
+    async def load_dataset_async(self, ds):
+        self.load_dataset_button.setEnabled(False)
+        try:
+            await self.runtime.run_io(self.data_mgr.load_dataset, ds)
+        finally:
+            self.load_dataset_button.setEnabled(True)
+        self.loaded_dataset(ds)
+
+    def loaded_dataset(self, ds=None):
+        '''
+        Updates controls and panels once a dataset has been loaded.
+        '''
+        self.update_source_buttons()
+        # self.reset_button_handler()
+
+        self.reset_panels()
+        self.update_control_attr_labels()
+        self.rad_dataset.setEnabled(True)
+        self.data_mgr.paused = False
+        if ds is not None:
+            self.loaded_ds_name = ds.name
+            self.attach_product_cache(ds)
+        if self.pending_seek is not None:
+            seconds, self.pending_seek = self.pending_seek, None
+            self.seek_dataset(seconds)
 
     def edit_dataset_button_handler(self):
         # Get selected item.  If multiple selected, load first item in list
@@ -515,26 +1014,80 @@ class ControlPanel(pg.LayoutWidget):
 
             # If "save" button selected it TRUE
             if results[-1]:
-                self.data_mgr.save_buffer(*(results[:-1]),)
+                self.edit_dataset(ds, *(results[:-1]),)
                 print("DATASET SAVED AS: ", results[0])
 
             self.update_dataset_list()
 
             self.menu_pause_restore()
 
+    def edit_dataset(self, ds, name, labels, subject, notes):
+        '''
+        Rewrites the attributes and label/subject links of a saved dataset,
+        renaming it (and its overview) if `name` changed.
+
+        The samples are never touched; the live buffer is only written by
+        `save_buffer`.
+        '''
+        db = self.data_mgr.db
+        old = ds.name.split('/')[-1]
+        if name and name != old:
+            samples = db['samples']
+            if name in samples:
+                print('(gui_panels) cannot rename {} to {}: name in '
+                      'use'.format(old, name))
+                name = old
+            else:
+                samples.move(old, name)
+                overview.rename_overview(db, old, name)
+                if self.loaded_ds_name == '/samples/' + old:
+                    self.loaded_ds_name = ds.name
+                # Drop the links under the old name; the selected label and
+                # subject groups are linked again below
+                for group_name in ('labels', 'subjects'):
+                    for group in db.get(group_name, {}).values():
+                        if old in group:
+                            del group[old]
+        name = name or old
+
+        label_names = [label.name.split('/')[-1] for label in labels]
+        ds.attrs['label'] = ','.join(label_names).encode('utf-8')
+        ds.attrs['subject'] = (subject.name.split('/')[-1].encode('utf-8')
+                               if subject is not None else b'')
+        ds.attrs['notes'] = notes.encode('utf-8')
+        for group in list(labels) + ([subject] if subject is not None
+                                     else []):
+            if name not in group:
+                group[name] = ds
+        db.flush()
+
 # === DATA ACQUISITION CONTROL HANDLER FUNCTIONS ==============================
 
     def pause_button_handler(self):
+        if self.player is not None:
+            self.player.pause_toggle()
+            return
         self.data_mgr.pause_toggle()
 
     def step_right_button_handler(self):
-        if self.data_mgr.source is self.data_mgr.virt_daq:
-            self.data_mgr.virt_daq.get_samples(stride=1, loop=False)
-            self.app.processEvents()
+        self.step(1)
 
     def step_left_button_handler(self):
-        if self.data_mgr.source is self.data_mgr.virt_daq:
-            self.data_mgr.virt_daq.get_samples(stride=-1, loop=False)
+        self.step(-1)
+
+    def step(self, stride):
+        if self.player is not None:
+            self.player.step(stride)
+            return
+        if self.data_mgr.source is not self.data_mgr.virt_daq:
+            return
+        if self.runtime is not None:
+            # Read on the acquisition thread; the redraw follows the data
+            self.runtime.spawn(self.runtime.run_acq(
+                lambda: self.data_mgr.virt_daq.get_samples(
+                    stride=stride, loop=False)))
+        else:
+            self.data_mgr.virt_daq.get_samples(stride=stride, loop=False)
             self.app.processEvents()
 
     def save_dataset_button_handler(self):
@@ -543,14 +1096,27 @@ class ControlPanel(pg.LayoutWidget):
         num_ds = len(self.data_mgr.get_datasets())
         default_name = 'sample_{:}'.format(num_ds)
         results = SaveDialog.saveDialog(self.data_mgr, name=default_name)
+        if results[-1] and self.runtime is not None:
+            self.runtime.spawn(self.save_dataset_async(results))
+            return
         if results[-1]:
-            self.data_mgr.save_buffer(*(results[:-1]))
+            self.save_buffer(*(results[:-1]))
             print("DATASET SAVED AS: ", results[0])
 
         self.update_dataset_list()
 
         self.menu_pause_restore()
 
+    async def save_dataset_async(self, results):
+        self.save_button.setEnabled(False)
+        try:
+            await self.runtime.run_io(self.save_buffer, *(results[:-1]))
+            print("DATASET SAVED AS: ", results[0])
+        finally:
+            self.save_button.setEnabled(True)
+            self.update_dataset_list()
+            self.menu_pause_restore()
+
 # === Save/Edit Dialog ========================================================
 
 
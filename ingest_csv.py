@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+DAQami CSV Bulk Ingestion.
+
+Converts a directory of DAQami CSV captures into `/samples/sample_N`
+datasets in the dashboard's HDF5 database so bench captures can be
+browsed and replayed in the dashboard.
+
+CSV files are parsed in parallel worker processes, which also compute each
+recording's overview and content digest; the main process is the only HDF5 writer and
+appends each parsed file in order.
+
+    python ingest_csv.py CSV_DIR DATABASE [--label L] [--subject S]
+
+Author: Jason Merlo
+Maintainer: Jason Merlo (merlojas@msu.edu)
+"""
+import argparse
+import functools
+import glob
+import multiprocessing
+import os
+
+import h5py
+import numpy as np
+
+import daqami
+import dsp
+import overview
+import product_cache
+
+# === CONSTANTS ===============================================================
+# Samples per chunk of the dashboard
+DEFAULT_CHUNK_SIZE = dsp.CHUNK_SIZE
+DAQ_TYPE = 'DAQami CSV'
+
+
+def parse_file(path, chunk_size, channel_map):
+    """
+    Parse one CSV into (path, chunks, sample_rate, overview_builder,
+    digest); runs in a worker.
+    """
+    samples, sample_rate = daqami.read_csv(path, dtype=np.float32,
+                                           verbose=False)
+    samples = daqami.to_daq_order(samples, channel_map)
+    chunks = daqami.to_chunks(samples, chunk_size)
+    builder = overview.OverviewBuilder()
+    builder.add(chunks)
+    # Hashed with the attribute values stored by `ingest`
+    digest = product_cache.DigestBuilder(chunks.shape, chunks.dtype,
+                                         np.int32(sample_rate),
+                                         np.int32(chunk_size))
+    digest.add(chunks)
+    return path, chunks, sample_rate, builder, digest.hexdigest()
+
+
+def next_sample_index(samples):
+    """Return the first N for which `sample_N` is unused."""
+    used = set()
+    for name in samples:
+        prefix, _, num = name.rpartition('_')
+        if prefix == 'sample' and num.isdigit():
+            used.add(int(num))
+    idx = len(samples)
+    while idx in used:
+        idx += 1
+    return idx
+
+
+def link_sample(db, group_name, key, name, ds):
+    """Hard-link `ds` into `/<group_name>/<key>/` like the save dialog."""
+    if not key:
+        return
+    group = db.require_group(group_name).require_group(key)
+    if name not in group:
+        group[name] = ds
+
+
+def ingest(csv_dir, db_path, label='', subject='', chunk_size=DEFAULT_CHUNK_SIZE,
+           channel_map=None, workers=None, compression=None):
+    """Ingest every CSV in `csv_dir`; returns the names of new samples."""
+    paths = sorted(glob.glob(os.path.join(csv_dir, '*.csv')))
+    if not paths:
+        print('No CSV files found in', csv_dir)
+        return []
+
+    parse = functools.partial(parse_file, chunk_size=chunk_size,
+                              channel_map=channel_map)
+    created = []
+    with h5py.File(db_path, 'a') as db, \
+            multiprocessing.Pool(workers) as pool:
+        samples = db.require_group('samples')
+        idx = next_sample_index(samples)
+
+        # imap keeps file order while later files are parsed in parallel
+        for path, chunks, sample_rate, builder, digest in pool.imap(
+                parse, paths):
+            name = 'sample_{:}'.format(idx)
+            idx += 1
+            ds = samples.create_dataset(name, data=chunks,
+                                        compression=compression)
+            ds.attrs['label'] = label.encode('utf-8')
+            ds.attrs['subject'] = subject.encode('utf-8')
+            ds.attrs['notes'] = 'Imported from {}'.format(
+                os.path.basename(path)).encode('utf-8')
+            ds.attrs['sample_rate'] = np.int32(sample_rate)
+            ds.attrs['sample_chunk_size'] = np.int32(chunk_size)
+            ds.attrs['daq_type'] = DAQ_TYPE.encode('utf-8')
+            product_cache.store_digest(ds, digest)
+
+            for key in label.split(','):
+                link_sample(db, 'labels', key, name, ds)
+            link_sample(db, 'subjects', subject, name, ds)
+            overview.write_overview(db, name, builder, sample_rate,
+                                    chunk_size)
+            db.flush()
+
+            print('{} -> /samples/{} {}'.format(
+                os.path.basename(path), name, chunks.shape))
+            created.append(name)
+    return created
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Convert DAQami CSV files into dashboard HDF5 samples')
+    parser.add_argument('csv_dir')
+    parser.add_argument('database')
+    parser.add_argument('--label', default='',
+                        help='comma separated class labels')
+    parser.add_argument('--subject', default='', help='first_last')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--channel-map', type=int, nargs=8, default=None,
+                        help='CSV column of I0 Q0 I1 Q1 I2 Q2 I3 Q3 '
+                             '(default: DAQami columns are DAQ channels)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='parser processes (default: all cores)')
+    parser.add_argument('--compression', default=None,
+                        help='HDF5 compression filter, e.g. gzip or lzf')
+    args = parser.parse_args()
+
+    ingest(args.csv_dir, args.database, label=args.label,
+           subject=args.subject, chunk_size=args.chunk_size,
+           channel_map=args.channel_map, workers=args.workers,
+           compression=args.compression)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+IQ Calibration.
+
+Corrects the DC offset and the gain and phase imbalance of each receiver's
+I/Q channel pair, and optionally removes static clutter.
+
+Coefficients are estimated from a recording of an empty scene (no moving
+targets).  With I0, Q0 the channels after DC removal, the amplitude ratio
+is a = sqrt(E[Q0^2] / E[I0^2]) and the phase error is
+phi = asin(E[I0 Q0] / sqrt(E[I0^2] E[Q0^2])).  The correction
+
+    I = I0
+    Q = (Q0 / a - I0 sin(phi)) / cos(phi)
+
+is affine in the raw channels, so all receivers are corrected at once with
+one `(channels x channels)` matrix product plus an offset over a whole
+`(K, channels, chunk_size)` batch.
+
+Coefficients are stored in the database:
+
+    /calibration/<name>/
+        daq_index   int32 [receivers x 2]   (I, Q) channel of each receiver
+        dc          float64 [receivers x 2] DC offset of I and Q
+        gain        float64 [receivers]     Q/I amplitude ratio a
+        phase       float64 [receivers]     phase error phi (rad)
+
+    python iq_calibration.py DATABASE sample_N [--name default]
+
+Author: Jason Merlo
+Maintainer: Jason Merlo (merlojas@msu.edu)
+"""
+import argparse
+
+import h5py
+import numpy as np
+
+import dsp
+import precision
+
+# === CONSTANTS ===============================================================
+GROUP = 'calibration'
+DEFAULT_NAME = 'default'
+READ_CHUNKS = 16384
+
+
+class IQCalibration(object):
+    """DC offset and gain/phase imbalance of each receiver."""
+
+    def __init__(self, daq_index, dc, gain, phase):
+        self.daq_index = np.asarray(daq_index, dtype=np.int32)
+        self.dc = np.asarray(dc, dtype=np.float64)
+        self.gain = np.asarray(gain, dtype=np.float64)
+        self.phase = np.asarray(phase, dtype=np.float64)
+
+    @classmethod
+    def estimate(cls, blocks, daq_index=dsp.DAQ_INDEX):
+        """
+        Estimate coefficients from an iterable of `(K, channels, chunk)`
+        blocks of a quiet recording.
+        """
+        i_idx = [iq[0] for iq in daq_index]
+        q_idx = [iq[1] for iq in daq_index]
+        count = 0
+        sums = 0.0
+        for block in blocks:
+            i = block[:, i_idx].astype(np.float64)
+            q = block[:, q_idx].astype(np.float64)
+            # Per receiver: sum I, Q, I^2, Q^2, IQ
+            sums = sums + np.stack([
+                i.sum(axis=(0, 2)), q.sum(axis=(0, 2)),
+                (i * i).sum(axis=(0, 2)), (q * q).sum(axis=(0, 2)),
+                (i * q).sum(axis=(0, 2))])
+            count += i.shape[0] * i.shape[2]
+        if not count:
+            raise ValueError('no samples to estimate the calibration from')
+
+        mean_i, mean_q, ii, qq, iq = sums / count
+        var_i = ii - mean_i ** 2
+        var_q = qq - mean_q ** 2
+        cov = iq - mean_i * mean_q
+        gain = np.sqrt(var_q / var_i)
+        phase = np.arcsin(np.clip(cov / np.sqrt(var_i * var_q), -1, 1))
+        return cls(daq_index, np.column_stack((mean_i, mean_q)), gain, phase)
+
+    @classmethod
+    def from_dataset(cls, ds, daq_index=dsp.DAQ_INDEX):
+        """Estimate coefficients from a recorded `/samples` dataset."""
+        def blocks():
+            for start in range(0, ds.shape[0], READ_CHUNKS):
+                yield precision.read_native(ds, np.s_[start:start
+                                                      + READ_CHUNKS])
+        calibration = cls.estimate(blocks(), daq_index)
+        calibration.source = ds.name
+        return calibration
+
+    def matrix(self, num_channels):
+        """
+        Return (A, b) such that `A @ x + b` corrects a `(channels, n)`
+        chunk x; channels outside `daq_index` pass through unchanged.
+        """
+        a = np.eye(num_channels)
+        for (i, q), gain, phase in zip(self.daq_index, self.gain,
+                                       self.phase):
+            a[q, i] = -np.tan(phase)
+            a[q, q] = 1.0 / (gain * np.cos(phase))
+        dc = np.zeros(num_channels)
+        dc[self.daq_index[:, 0]] = self.dc[:, 0]
+        dc[self.daq_index[:, 1]] = self.dc[:, 1]
+        return a, -a.dot(dc)
+
+    def save(self, db, name=DEFAULT_NAME):
+        group = db.require_group(GROUP)
+        if name in group:
+            del group[name]
+        cal = group.create_group(name)
+        cal['daq_index'] = self.daq_index
+        cal['dc'] = self.dc
+        cal['gain'] = self.gain
+        cal['phase'] = self.phase
+        cal.attrs['source'] = getattr(self, 'source', '').encode('utf-8')
+        return cal
+
+    @classmethod
+    def load(cls, db, name=DEFAULT_NAME):
+        cal = db[GROUP][name]
+        return cls(cal['daq_index'][()], cal['dc'][()], cal['gain'][()],
+                   cal['phase'][()])
+
+    def __repr__(self):
+        rows = ['rx {}: dc=({:+.4g}, {:+.4g}) gain={:.4f} phase={:+.2f} deg'
+                .format(tuple(int(c) for c in idx), dc[0], dc[1], gain,
+                        np.degrees(phase))
+                for idx, dc, gain, phase in zip(self.daq_index, self.dc,
+                                                self.gain, self.phase)]
+        return '\n'.join(rows)
+
+
+class StaticClutterFilter(object):
+    """
+    Subtract an exponential moving average of past pulses from each pulse.
+
+    The average has time constant 1/alpha pulses and removes returns that
+    do not change from pulse to pulse (zero Doppler).  A batch is filtered
+    exactly as if its pulses arrived one by one, with one matrix product
+    over the pulse axis.
+    """
+
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self.mean = None
+        self.weights = {}
+
+    def batch_weights(self, k):
+        """
+        Return (L, p) with L[j, i] = alpha (1 - alpha)^(j - 1 - i) for
+        i < j (else 0) and p[n] = (1 - alpha)^n.
+        """
+        if k not in self.weights:
+            decay = 1.0 - self.alpha
+            j, i = np.indices((k, k))
+            lower = np.where(i < j, self.alpha
+                             * decay ** np.maximum(j - 1 - i, 0), 0.0)
+            self.weights[k] = (lower, decay ** np.arange(k + 1))
+        return self.weights[k]
+
+    def __call__(self, block):
+        k = block.shape[0]
+        if self.mean is None:
+            self.mean = block.mean(axis=0)
+        lower, powers = self.batch_weights(k)
+        dtype = block.dtype
+        # Average of the pulses before each pulse of the batch
+        before = (powers[:k, None, None] * self.mean
+                  + np.tensordot(lower.astype(dtype), block, axes=1))
+        self.mean = (powers[k] * self.mean + self.alpha
+                     * np.tensordot(powers[k - 1::-1].astype(dtype), block,
+                                    axes=1))
+        return (block - before).astype(dtype, copy=False)
+
+    def reset(self):
+        self.mean = None
+
+
+class IQCorrector(object):
+    """
+    Apply an `IQCalibration` and optional static-clutter removal to chunks.
+
+    Accepts one `(channels, n)` chunk or a `(K, channels, n)` batch and
+    returns float32 output of the same shape.
+    """
+
+    def __init__(self, calibration=None, clutter_alpha=None, num_channels=8):
+        if calibration is not None:
+            a, b = calibration.matrix(num_channels)
+            self.a = a.astype(np.float32)
+            self.b = b.astype(np.float32)[:, np.newaxis]
+        else:
+            self.a = None
+        self.clutter = (StaticClutterFilter(clutter_alpha)
+                        if clutter_alpha else None)
+
+    def __call__(self, block):
+        block = precision.as_native_f32(block)
+        single = block.ndim == 2
+        if single:
+            block = block[np.newaxis]
+        if self.a is not None:
+            # Every receiver of every chunk in one product
+            block = np.matmul(self.a, block)
+            block += self.b
+        if self.clutter is not None:
+            block = self.clutter(block)
+        return block[0] if single else block
+
+    def reset(self):
+        if self.clutter is not None:
+            self.clutter.reset()
+
+
+class CorrectedSignal(object):
+    """
+    Stand-in for a source's `data_available_signal` that corrects each
+    emitted `(data, seq)` chunk before passing it on to the real signal.
+
+    Connections, including those made before it was installed, stay on the
+    real signal, so every slot receives corrected chunks.
+    """
+
+    def __init__(self, signal, corrector):
+        self.signal = signal
+        self.corrector = corrector
+
+    def emit(self, data_tuple):
+        data = self.corrector(data_tuple[0])
+        self.signal.emit((data,) + tuple(data_tuple[1:]))
+
+    def __getattr__(self, name):
+        # connect, disconnect, ...
+        return getattr(self.signal, name)
+
+
+def correct_source(source, corrector):
+    """
+    Apply `corrector` to every chunk `source` emits, whichever DAQ it is
+    (hardware, dataset playback, ...).  Returns False if the source's
+    signal cannot be replaced.
+    """
+    signal = source.data_available_signal
+    if isinstance(signal, CorrectedSignal):
+        signal.corrector = corrector
+        return True
+    try:
+        source.data_available_signal = CorrectedSignal(signal, corrector)
+    except AttributeError:
+        return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Estimate IQ calibration from a quiet recording and '
+                    'store it in the database')
+    parser.add_argument('database')
+    parser.add_argument('sample', help='quiet dataset under /samples')
+    parser.add_argument('--name', default=DEFAULT_NAME,
+                        help='calibration name (default: %(default)s)')
+    parser.add_argument('--daq-index', type=int, nargs='+',
+                        default=[c for iq in dsp.DAQ_INDEX for c in iq],
+                        metavar='CH', help='I Q channel of each receiver')
+    args = parser.parse_args()
+
+    daq_index = list(zip(args.daq_index[0::2], args.daq_index[1::2]))
+    with h5py.File(args.database, 'a') as db:
+        calibration = IQCalibration.from_dataset(db['samples'][args.sample],
+                                                 daq_index)
+        calibration.save(db, args.name)
+    print(calibration)
+    print('Saved as /{}/{}'.format(GROUP, args.name))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,429 @@
+# -*- coding: utf-8 -*-
+"""
+Network DAQ Classes.
+
+Moves raw 8-channel ADC chunks from a small capture node to the processing
+machine over TCP.
+
+The capture side runs a `CaptureAgent`, which serves chunks from any chunk
+source.  The processing side adds a `NetworkDAQ` to the `DataManager` like
+any other DAQ.  Flow control is credit based: the `NetworkDAQ` grants the
+agent a number of chunks it is able to buffer and returns credit as chunks
+are consumed, so a slow consumer never grows unbounded queues.  Chunks the
+agent could not send are dropped at the agent and show up as sequence gaps
+on the consumer.
+
+Run `python net_daq.py --agent` to serve synthetic chunks over loopback,
+or `python net_daq.py` to run a self-contained loopback test.
+
+Author: Jason Merlo
+Maintainer: Jason Merlo (merlojas@msu.edu)
+"""
+import argparse
+import collections
+import queue
+import socket
+import threading
+import time
+
+import numpy as np
+
+from pyratk.acquisition import daq    # DAQ base class
+
+import dsp
+import stream_protocol as sp
+
+# === CONSTANTS ===============================================================
+DEFAULT_PORT = 5558
+# Chunks the consumer is willing to buffer (credit window)
+DEFAULT_WINDOW = 256
+# Agent-side backlog used while the consumer has no credit
+DEFAULT_BACKLOG = 1024
+# Most chunks the agent packs into one frame when it has fallen behind
+DEFAULT_MAX_BATCH = 64
+
+
+class ChunkClient(object):
+    """
+    Receive raw chunks from a `CaptureAgent` without any Qt machinery.
+
+    Handles the credit window and sequence-gap accounting; used directly by
+    worker processes and wrapped by `NetworkDAQ` for the `DataManager`.
+    """
+
+    def __init__(self, host, port=DEFAULT_PORT, window=DEFAULT_WINDOW):
+        self.window = window
+
+        # Statistics
+        self.last_seq = None
+        self.gaps = 0
+        self.missed = 0
+
+        # One extra slot for the end-of-stream marker
+        self.chunks = queue.Queue(window + 1)
+        self.partial = None
+        self.consumed = 0
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send_lock = threading.Lock()
+
+        self.t_recv = threading.Thread(target=self.recv_loop, daemon=True)
+        self.t_recv.start()
+        self.grant(window)
+
+    def grant(self, count):
+        """Return `count` chunks of credit to the agent."""
+        with self.send_lock:
+            sp.send_frame(self.sock, sp.KIND_CREDIT, 0,
+                          {'credit': np.uint32(count)})
+
+    def recv_loop(self):
+        while True:
+            try:
+                frame = sp.recv_frame(self.sock)
+            except OSError:
+                frame = None
+            if frame is None:
+                self.chunks.put(None)
+                break
+            kind, seq, timestamp, arrays = frame
+            if kind != sp.KIND_RAW_CHUNK:
+                continue
+            # Never blocks: the agent only sends within the granted window
+            data = arrays['data']
+            if data.ndim == 2:
+                data = data[np.newaxis]
+            # Capture time of each chunk; older agents only stamp the frame
+            times = arrays.get('time')
+            if times is None:
+                times = np.full(len(data), timestamp)
+            self.chunks.put((seq, times, data))
+
+    def take(self, max_count, wait=True):
+        """
+        Take up to `max_count` consecutive chunks from the next queued block.
+
+        Raises `queue.Empty` if `wait` is False and nothing is queued.
+        """
+        if self.partial is None:
+            item = self.chunks.get() if wait else self.chunks.get_nowait()
+            if item is None:
+                # Leave the marker for any later callers
+                self.chunks.put(None)
+                return None
+            self.partial = item
+        seq, times, block = self.partial
+        n = min(max_count, len(block))
+        if n < len(block):
+            self.partial = (seq + n, times[n:], block[n:])
+        else:
+            self.partial = None
+
+        if self.last_seq is not None and seq != self.last_seq + 1:
+            self.gaps += 1
+            self.missed += max(seq - self.last_seq - 1, 0)
+            print('(net_daq) WARNING: sequence gap {} -> {}'.format(
+                self.last_seq, seq))
+        self.last_seq = seq + n - 1
+
+        # Return credit in batches to keep the control traffic small
+        self.consumed += n
+        if self.consumed >= self.window // 4:
+            self.grant(self.consumed)
+            self.consumed = 0
+        return seq, float(times[0]), block[:n]
+
+    def read(self):
+        """
+        Wait for the next chunk.
+
+        Returns (seq, timestamp, data), or None once the agent has closed
+        the stream.
+        """
+        item = self.take(1)
+        if item is None:
+            return None
+        seq, timestamp, block = item
+        return seq, timestamp, block[0]
+
+    def read_batch(self, max_count):
+        """
+        Wait for at least one chunk and return up to `max_count` of them.
+
+        Returns (seq, timestamp, block) where `block` is a contiguous
+        `(K, num_channels, sample_chunk_size)` array, or None once the agent
+        has closed the stream.  Only chunks that are already queued are
+        added after the first, so batching never waits for data.  A batch
+        never spans a sequence gap: chunks after a gap start the next batch.
+        """
+        first = self.take(max_count)
+        if first is None:
+            return None
+        parts = [first]
+        count = len(first[2])
+        expected = first[0] + count
+        while count < max_count:
+            # Look at the next queued block before consuming it
+            if self.partial is None:
+                try:
+                    item = self.chunks.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.chunks.put(None)
+                    break
+                self.partial = item
+            if self.partial[0] != expected:
+                break
+            part = self.take(max_count - count)
+            parts.append(part)
+            count += len(part[2])
+            expected += len(part[2])
+
+        if len(parts) == 1:
+            return first
+        block = np.concatenate([p[2] for p in parts])
+        return first[0], first[1], block
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class NetworkDAQ(daq.DAQ):
+    """
+    DataManager source receiving raw ADC chunks from a `CaptureAgent`.
+
+    Each chunk is decoded with `np.frombuffer` straight from its receive
+    buffer and emitted as `(data, sample_num)` where `data` has shape
+    `(num_channels, sample_chunk_size)`.
+
+    Chunks are read and IQ-corrected in batches sized by a
+    `dsp.BatchSizeController`, then emitted one by one as the `DataManager`
+    expects.
+    """
+
+    def __init__(self, host, port=DEFAULT_PORT, sample_rate=None,
+                 sample_chunk_size=None, num_channels=8,
+                 window=DEFAULT_WINDOW, iq_correction=None):
+        super(NetworkDAQ, self).__init__()
+        self.daq_type = 'Network ({}:{})'.format(host, port)
+        self.sample_rate = sample_rate
+        self.sample_chunk_size = sample_chunk_size
+        self.num_channels = num_channels
+        self.host = host
+        self.port = port
+        # Optional callable applied to each chunk before it is emitted
+        self.iq_correction = iq_correction
+
+        pulse_period = (sample_chunk_size / float(sample_rate)
+                        if sample_rate and sample_chunk_size
+                        else dsp.PULSE.delay)
+        self.controller = dsp.BatchSizeController(pulse_period)
+
+        self.client = ChunkClient(host, port, window)
+
+    def get_samples(self, stride=1, loop=-1, playback_speed=1):
+        """Wait for the next chunks and emit up to one batch of them."""
+        item = self.client.read_batch(self.controller.batch_size)
+        if item is None:
+            print('(net_daq) capture agent closed the stream')
+            self.running = False
+            return
+        seq, timestamp, block = item
+
+        start = time.perf_counter()
+        if self.iq_correction is not None:
+            block = self.iq_correction(block)
+        for idx, data in enumerate(block):
+            self.data = data
+            self.sample_num = seq + idx
+            self.data_available_signal.emit((data, seq + idx))
+        self.controller.update(len(block), time.perf_counter() - start)
+
+    def close(self):
+        self.running = False
+        self.client.close()
+
+
+class CaptureAgent(object):
+    """
+    Serve raw chunks to a single `NetworkDAQ` at a time.
+
+    `read_chunk` is called repeatedly and must return one
+    `(num_channels, sample_chunk_size)` array per call, blocking at the
+    acquisition rate.  Chunks are held in a bounded backlog while the
+    consumer has no credit; once the backlog is full the oldest chunks are
+    dropped, which the consumer reports as sequence gaps.  Chunks that have
+    built up are sent together as one `(K, num_channels, chunk_size)` frame.
+    """
+
+    def __init__(self, read_chunk, host='0.0.0.0', port=DEFAULT_PORT,
+                 backlog=DEFAULT_BACKLOG, max_batch=DEFAULT_MAX_BATCH):
+        self.read_chunk = read_chunk
+        self.max_batch = max_batch
+        self.backlog = collections.deque(maxlen=backlog)
+        self.cond = threading.Condition()
+        self.credit = 0
+        self.seq = 0
+        self.dropped = 0
+        self.running = True
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(1)
+        # Actual port, in case port 0 was requested
+        self.port = self.server.getsockname()[1]
+
+        self.t_capture = threading.Thread(target=self.capture_loop,
+                                          daemon=True)
+        self.t_capture.start()
+
+    def capture_loop(self):
+        while self.running:
+            data = np.ascontiguousarray(self.read_chunk(), dtype=np.float32)
+            # Stamp at capture, not at send, so queueing and credit stalls
+            # do not shift the head's timeline
+            timestamp = time.time()
+            with self.cond:
+                if len(self.backlog) == self.backlog.maxlen:
+                    self.dropped += 1
+                self.backlog.append((self.seq, timestamp, data))
+                self.seq += 1
+                self.cond.notify()
+
+    def credit_loop(self, conn):
+        while self.running:
+            try:
+                frame = sp.recv_frame(conn)
+            except OSError:
+                frame = None
+            with self.cond:
+                if frame is None:
+                    self.credit = -1
+                    self.cond.notify()
+                    break
+                kind, seq, timestamp, arrays = frame
+                if kind == sp.KIND_CREDIT:
+                    self.credit += int(arrays['credit'])
+                    self.cond.notify()
+
+    def serve_forever(self):
+        """Accept consumers one at a time and stream chunks to them."""
+        while self.running:
+            try:
+                conn, addr = self.server.accept()
+            except OSError:
+                break
+            print('(net_daq) consumer connected:', addr)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.cond:
+                self.credit = 0
+            threading.Thread(target=self.credit_loop, args=(conn,),
+                             daemon=True).start()
+            try:
+                self.stream(conn)
+            except OSError as e:
+                print('(net_daq) consumer disconnected:', e)
+            conn.close()
+
+    def stream(self, conn):
+        while self.running:
+            with self.cond:
+                while self.running and (self.credit == 0 or not self.backlog):
+                    self.cond.wait()
+                if self.credit < 0:
+                    return
+                # Send whatever has built up as one block; the backlog only
+                # drops from the left, so the chunks are always consecutive
+                n = min(self.credit, len(self.backlog), self.max_batch)
+                items = [self.backlog.popleft() for _ in range(n)]
+                self.credit -= n
+            block = np.stack([data for _, _, data in items])
+            times = np.array([timestamp for _, timestamp, _ in items])
+            sp.send_frame(conn, sp.KIND_RAW_CHUNK, items[0][0],
+                          {'data': block, 'time': times},
+                          timestamp=times[0])
+
+    def close(self):
+        self.running = False
+        with self.cond:
+            self.cond.notify_all()
+        self.server.close()
+
+
+class SyntheticChunkSource(object):
+    """
+    Stand-in for the radar array producing paced noise-plus-tone chunks.
+
+    Useful for exercising `CaptureAgent`/`NetworkDAQ` without hardware.
+    """
+
+    def __init__(self, sample_rate=dsp.SAMPLE_RATE,
+                 sample_chunk_size=dsp.CHUNK_SIZE,
+                 num_channels=8, tone=1000.0):
+        self.sample_rate = sample_rate
+        self.sample_chunk_size = sample_chunk_size
+        self.num_channels = num_channels
+        self.tone = tone
+        self.sample_num = 0
+        self.period = sample_chunk_size / float(sample_rate)
+        self.next_time = time.time()
+
+    def __call__(self):
+        self.next_time += self.period
+        delay = self.next_time - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+        t = (np.arange(self.sample_chunk_size) + self.sample_num) \
+            / self.sample_rate
+        self.sample_num += self.sample_chunk_size
+        data = np.random.normal(
+            scale=0.01, size=(self.num_channels, self.sample_chunk_size))
+        data[0::2] += np.cos(2 * np.pi * self.tone * t)
+        data[1::2] += np.sin(2 * np.pi * self.tone * t)
+        return data.astype(np.float32)
+
+
+# === LOOPBACK SELF-TEST ======================================================
+def _loopback_test(num_chunks=4000):
+    """Stream synthetic chunks over loopback and report throughput."""
+    source = SyntheticChunkSource()
+    agent = CaptureAgent(source, host='127.0.0.1', port=0)
+    threading.Thread(target=agent.serve_forever, daemon=True).start()
+
+    client = ChunkClient('127.0.0.1', agent.port)
+    start = time.time()
+    for _ in range(num_chunks):
+        client.read()
+    elapsed = time.time() - start
+
+    print('{:d} chunks in {:.3f} s ({:.0f} chunks/s), gaps={}, missed={}'
+          .format(num_chunks, elapsed, num_chunks / elapsed, client.gaps,
+                  client.missed))
+    client.close()
+    agent.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Raw chunk network DAQ')
+    parser.add_argument('--agent', action='store_true',
+                        help='serve synthetic chunks instead of testing')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    args = parser.parse_args()
+
+    if args.agent:
+        agent = CaptureAgent(SyntheticChunkSource(), port=args.port)
+        print('Serving synthetic chunks on port', agent.port)
+        agent.serve_forever()
+    else:
+        _loopback_test()
+
+
+if __name__ == '__main__':
+    main()
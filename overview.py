@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+Recording Overviews.
+
+A small, decimated summary of each recording, computed when it is saved
+or ingested, so recordings can be browsed without replaying them:
+
+    /overviews/<sample name>/
+        rms_0, rms_1, ...   float32 [bins x channels] RMS envelope pyramid;
+                            level 0 bins are `base_chunks` chunks long and
+                            each level is `factor` times coarser
+        spectrogram         float32 [columns x receivers x bins] slow-time
+                            (Doppler) power in dB, one column per
+                            `spec_chunks` chunks
+
+The spectrogram takes a fast-time (range) FFT of every chunk and a
+slow-time FFT of each range bin, with the static (per-column mean)
+component removed, and keeps the strongest range bin of each Doppler bin.
+Taking the chunk mean instead would only see the zero-range (DC) bin.
+
+`python overview.py DATABASE` adds overviews to recordings that have none
+(`--force` recomputes all of them) and removes those of deleted samples.
+
+Author: Jason Merlo
+Maintainer: Jason Merlo (merlojas@msu.edu)
+"""
+import argparse
+
+import h5py
+import numpy as np
+
+import dsp
+import precision
+
+# === CONSTANTS ===============================================================
+GROUP = 'overviews'
+DEFAULT_BASE_CHUNKS = 40        # 10 ms at 4000 chunks/s
+PYRAMID_FACTOR = 4
+MIN_LEVEL_BINS = 64             # coarsest level has at most this many bins
+DEFAULT_SPEC_CHUNKS = 512       # slow-time samples per spectrogram column
+DEFAULT_SPEC_BINS = 128         # Doppler bins; columns average 4 segments
+READ_CHUNKS = 16384
+
+
+class OverviewBuilder(object):
+    """
+    Accumulate an overview from consecutive `(K, channels, chunk_size)`
+    blocks without keeping the recording in memory.
+    """
+
+    def __init__(self, daq_index=dsp.DAQ_INDEX, base_chunks=DEFAULT_BASE_CHUNKS,
+                 spec_chunks=DEFAULT_SPEC_CHUNKS, spec_bins=DEFAULT_SPEC_BINS):
+        self.i_idx = np.array([iq[0] for iq in daq_index])
+        self.q_idx = np.array([iq[1] for iq in daq_index])
+        self.base_chunks = base_chunks
+        self.spec_chunks = spec_chunks
+        self.spec_bins = spec_bins
+        self.spec_window = np.hanning(spec_bins).astype(np.float32)
+        # Fast-time window, created once the chunk size is known
+        self.range_window = None
+
+        self.msq_bins = []      # mean-square of each full base bin
+        self.msq_pending = None
+        self.columns = []
+        self.iq_pending = None
+
+    def add(self, block):
+        block = np.asarray(block)
+        msq = np.square(block, dtype=np.float64).mean(axis=-1)
+        if self.range_window is None:
+            self.range_window = np.hanning(block.shape[-1]).astype(
+                np.float32)
+        # (K, rx, range bins) fast-time spectra of each chunk
+        iq = np.fft.fft((block[:, self.i_idx] + 1j * block[:, self.q_idx])
+                        * self.range_window, axis=-1).astype(np.complex64)
+
+        self.msq_pending = self._take(self.msq_pending, msq, self.base_chunks,
+                                      self._add_rms)
+        self.iq_pending = self._take(self.iq_pending, iq, self.spec_chunks,
+                                     self._add_columns)
+
+    @staticmethod
+    def _take(pending, new, size, consume):
+        """Pass whole groups of `size` rows to `consume`; return the rest."""
+        if pending is not None and len(pending):
+            new = np.concatenate((pending, new))
+        full = len(new) // size * size
+        if full:
+            consume(new[:full].reshape((-1, size) + new.shape[1:]))
+        return new[full:]
+
+    def _add_rms(self, groups):
+        self.msq_bins.append(groups.mean(axis=1))
+
+    def _add_columns(self, groups):
+        # (cols, spec_chunks, rx, range) -> (cols, segments, spec_bins, ...)
+        cols = groups.shape[0]
+        groups = groups - groups.mean(axis=1, keepdims=True)
+        segs = groups.reshape((cols, -1, self.spec_bins) + groups.shape[2:])
+        spectrum = np.fft.fft(
+            segs * self.spec_window[:, np.newaxis, np.newaxis], axis=2)
+        # Strongest range bin of each Doppler bin -> (cols, spec_bins, rx)
+        power = (np.abs(spectrum) ** 2).mean(axis=1).max(axis=-1)
+        power = np.fft.fftshift(power, axes=1).transpose(0, 2, 1)
+        self.columns.append(
+            (10 * np.log10(power + 1e-12)).astype(np.float32))
+
+    def finish(self):
+        """Return the overview as a dict of named arrays."""
+        bins = list(self.msq_bins)
+        if self.msq_pending is not None and len(self.msq_pending):
+            # Final partial bin
+            bins.append(self.msq_pending.mean(axis=0, keepdims=True))
+        num_channels = bins[0].shape[1] if bins else 0
+        level = (np.concatenate(bins) if bins
+                 else np.empty((0, num_channels)))
+
+        arrays = {}
+        idx = 0
+        while True:
+            arrays['rms_{:d}'.format(idx)] = np.sqrt(level).astype(np.float32)
+            if len(level) <= MIN_LEVEL_BINS:
+                break
+            pad = -len(level) % PYRAMID_FACTOR
+            if pad:
+                # Average the last group over the rows it actually has
+                tail = level[-(PYRAMID_FACTOR - pad):].mean(axis=0)
+                level = np.concatenate((level, np.repeat(tail[None], pad, 0)))
+            level = level.reshape(-1, PYRAMID_FACTOR, num_channels).mean(1)
+            idx += 1
+
+        arrays['spectrogram'] = (
+            np.concatenate(self.columns) if self.columns else
+            np.empty((0, len(self.i_idx), self.spec_bins), np.float32))
+        return arrays
+
+
+def write_overview(db, name, builder, sample_rate, sample_chunk_size):
+    """Store the finished `builder` as `/overviews/<name>`."""
+    group = db.require_group(GROUP)
+    if name in group:
+        del group[name]
+    ov = group.create_group(name)
+    for key, arr in builder.finish().items():
+        ov.create_dataset(key, data=arr)
+    ov.attrs['base_chunks'] = builder.base_chunks
+    ov.attrs['factor'] = PYRAMID_FACTOR
+    ov.attrs['spec_chunks'] = builder.spec_chunks
+    ov.attrs['sample_rate'] = sample_rate
+    ov.attrs['sample_chunk_size'] = sample_chunk_size
+    return ov
+
+
+def store_overview(db, ds, also=(), **kwargs):
+    """
+    Compute and store the overview of sample dataset `ds`.
+
+    Each builder in `also` (e.g. a `product_cache.DigestBuilder`) is fed
+    the same blocks, so the dataset is read once.
+    """
+    builder = OverviewBuilder(**kwargs)
+    buf = None
+    for start in range(0, ds.shape[0], READ_CHUNKS):
+        stop = min(start + READ_CHUNKS, ds.shape[0])
+        buf = precision.read_native(
+            ds, np.s_[start:stop],
+            out=buf if buf is not None and len(buf) == stop - start else None)
+        builder.add(buf)
+        for other in also:
+            other.add(buf)
+    return write_overview(db, ds.name.split('/')[-1], builder,
+                          ds.attrs.get('sample_rate', 0),
+                          ds.attrs.get('sample_chunk_size', ds.shape[-1]))
+
+
+def get_overview(db, name):
+    """Return the `/overviews/<name>` group, or None if there is none."""
+    group = db.get(GROUP)
+    if group is None or name not in group:
+        return None
+    return group[name]
+
+
+def delete_overview(db, name):
+    group = db.get(GROUP)
+    if group is not None and name in group:
+        del group[name]
+
+
+def rename_overview(db, old, new):
+    """Move the overview of a sample renamed from `old` to `new`."""
+    group = db.get(GROUP)
+    if group is None or old not in group:
+        return
+    if new in group:
+        del group[new]
+    group.move(old, new)
+
+
+def prune_overviews(db):
+    """Delete overviews whose sample no longer exists; return their names."""
+    group = db.get(GROUP)
+    samples = db.get('samples')
+    if group is None:
+        return []
+    stale = [name for name in group if samples is None or name not in samples]
+    for name in stale:
+        del group[name]
+    return stale
+
+
+def rms_level(ov, max_bins):
+    """Return (rms, chunks_per_bin) of the finest level with <= max_bins."""
+    idx = 0
+    while 'rms_{:d}'.format(idx + 1) in ov and \
+            len(ov['rms_{:d}'.format(idx)]) > max_bins:
+        idx += 1
+    chunks = int(ov.attrs['base_chunks']) * int(ov.attrs['factor']) ** idx
+    return ov['rms_{:d}'.format(idx)][()], chunks
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Add overviews to recordings that have none')
+    parser.add_argument('database')
+    parser.add_argument('--force', action='store_true',
+                        help='recompute existing overviews')
+    args = parser.parse_args()
+
+    with h5py.File(args.database, 'a') as db:
+        for name, ds in db['samples'].items():
+            if get_overview(db, name) is not None and not args.force:
+                continue
+            store_overview(db, ds)
+            print('overview:', name)
+        for name in prune_overviews(db):
+            print('removed overview of deleted sample:', name)
+
+
+if __name__ == '__main__':
+    main()
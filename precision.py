@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Sample Precision Helpers.
+
+Recordings in older databases are stored big-endian (`H5T_IEEE_F32BE`).
+Reading them with plain numpy indexing and doing arithmetic on the result
+byte-swaps and, for most numpy routines, upcasts to float64/complex128.
+These helpers keep samples in native-endian float32 and make every
+conversion an explicit, single step.
+
+Author: Jason Merlo
+Maintainer: Jason Merlo (merlojas@msu.edu)
+"""
+import numpy as np
+
+# === CONSTANTS ===============================================================
+NATIVE_F32 = np.dtype('=f4')
+NATIVE_C64 = np.dtype('=c8')
+# Processor dtype for each --precision choice
+PRECISIONS = {'single': np.complex64, 'double': np.complex128}
+
+
+def is_native_f32(arr):
+    """True if `arr` is already native-endian float32."""
+    return arr.dtype == NATIVE_F32 and arr.dtype.isnative
+
+
+def as_native_f32(arr):
+    """
+    Return `arr` as native-endian float32.
+
+    Returns `arr` itself when no conversion is needed, otherwise one copy
+    that swaps and/or narrows in a single pass.
+    """
+    arr = np.asarray(arr)
+    if is_native_f32(arr):
+        return arr
+    return arr.astype(NATIVE_F32)
+
+
+def read_native(ds, sel=Ellipsis, out=None):
+    """
+    Read `ds[sel]` from an h5py dataset into native float32.
+
+    The byte-swap is done by HDF5 while copying into `out` (allocated if
+    not given), so no big-endian temporary is created.  Pass the same
+    `out` buffer for every block to avoid per-read allocations.
+    """
+    # Zero-stride stand-in gives the selection shape without allocating
+    shape = np.lib.stride_tricks.as_strided(
+        np.zeros(1, np.bool_), ds.shape, (0,) * len(ds.shape))[sel].shape
+    if out is None:
+        out = np.empty(shape, dtype=NATIVE_F32)
+    elif out.shape != shape or not is_native_f32(out):
+        raise ValueError('out must be native float32 of shape {}'.format(
+            shape))
+    ds.read_direct(out, source_sel=sel if sel is not Ellipsis else None)
+    return out
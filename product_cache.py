@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+"""
+Processed-Product Cache.
+
+Stores the products of the radar pipeline (range-Doppler frames,
+detections and tracker states, as gathered by
+`telemetry.collect_products`) for a recorded dataset, so a recording that
+has already been processed with the same configuration can be re-viewed
+and scrubbed as pure playback.
+
+Entries are keyed by a digest of the dataset contents plus a digest of the
+pipeline configuration:
+
+    <cache_dir>/<dataset digest>-<config digest>/
+        manifest.json           frame count, stride and product layout
+        <product>.bin           frames of each product, concatenated
+        <product>.offsets.npy   row offset of each frame in <product>.bin
+
+Products are read back through `np.memmap`.  When the cache grows beyond
+its disk budget the least recently used entries are deleted.
+
+The dataset digest is stored in the `content_digest` attribute when a
+recording is saved or ingested, so loading a dataset does not have to hash
+it.
+
+Author: Jason Merlo
+Maintainer: Jason Merlo (merlojas@msu.edu)
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from startup_profile import lazy_import
+telemetry = lazy_import('telemetry')
+
+# === CONSTANTS ===============================================================
+# Bump when the entry layout or the meaning of a product changes
+CACHE_VERSION = 1
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.aps_dashboard',
+                                 'product_cache')
+DEFAULT_BUDGET = 4 * 2**30      # bytes
+# Chunks per cached frame (120 chunks of 250 us ~ one 30 ms GUI frame)
+DEFAULT_FRAME_STRIDE = 120
+# Chunks hashed per read when computing a dataset digest
+DIGEST_BLOCK = 4096
+# Dataset attribute holding the stored content digest
+DIGEST_ATTR = 'content_digest'
+MANIFEST = 'manifest.json'
+
+
+def _json_default(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    # A repr may hold an id() and would change the key on every run
+    raise TypeError('cannot hash {} in a pipeline configuration'.format(
+        type(obj).__name__))
+
+
+def _plain(obj):
+    """
+    Reduce tuples, namedtuples, points and parameter objects to plain
+    lists, dicts and numbers; anything else is left to `_json_default`.
+    """
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, (list, tuple)):
+        return [_plain(v) for v in obj]
+    if isinstance(obj, dict):
+        return {k: _plain(v) for k, v in obj.items()}
+    if all(hasattr(obj, axis) for axis in 'xyz'):
+        # pyratk Point
+        return [_plain(obj.x), _plain(obj.y), _plain(obj.z)]
+    if hasattr(obj, '__dict__') and not callable(obj):
+        # Parameter objects such as pyratk's Pulse
+        return dict(_plain(vars(obj)), type=type(obj).__name__)
+    return obj
+
+
+def config_hash(config):
+    """Digest of a JSON-serializable pipeline configuration."""
+    text = json.dumps([CACHE_VERSION, config], sort_keys=True,
+                      default=_json_default)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+def pipeline_config(transmitters, receivers, tracker_type, **settings):
+    """
+    Describe a `Radar`/tracker pipeline for `config_hash`.
+
+    `transmitters` and `receivers` are the `TransmitterTuple` and
+    `ReceiverTuple` lists given to `Radar`; `settings` are its remaining
+    keyword arguments (FFT sizes, ...).
+    """
+    return dict(transmitters=_plain(transmitters),
+                receivers=_plain(receivers),
+                tracker=tracker_type,
+                settings=_plain(settings))
+
+
+class DigestBuilder(object):
+    """
+    Compute a dataset digest from blocks of its chunks, e.g. while the
+    recording is written.
+
+    `shape` and `dtype` are those of the stored dataset; blocks of any
+    float type are hashed as `dtype`.
+    """
+
+    def __init__(self, shape, dtype, sample_rate, sample_chunk_size):
+        self.dtype = np.dtype(dtype)
+        self.h = hashlib.blake2b(digest_size=16)
+        self.h.update(repr((tuple(shape), self.dtype.str)).encode('ascii'))
+        for value in (sample_rate, sample_chunk_size):
+            if isinstance(value, np.generic):
+                value = value.item()
+            self.h.update(repr(value).encode('ascii'))
+
+    def add(self, block):
+        self.h.update(np.ascontiguousarray(block, dtype=self.dtype).data)
+
+    def hexdigest(self):
+        return self.h.hexdigest()
+
+
+def store_digest(ds, digest):
+    """Record `digest` on the dataset so loading it does not hash it."""
+    ds.attrs[DIGEST_ATTR] = digest.encode('utf-8')
+
+
+def stored_digest(ds):
+    """Return the digest stored on `ds`, or None."""
+    digest = ds.attrs.get(DIGEST_ATTR)
+    if isinstance(digest, bytes):
+        digest = digest.decode('utf-8')
+    return digest
+
+
+_digests = {}
+
+
+def dataset_digest(ds, block_chunks=DIGEST_BLOCK):
+    """
+    Content digest of a recorded dataset.
+
+    Uses the stored digest if there is one.  Otherwise hashes the samples
+    block by block along with the shape and recording attributes, which
+    reads the whole dataset; results are remembered per file, dataset and
+    file modification time, so re-selecting a dataset does not re-read it.
+    """
+    digest = stored_digest(ds)
+    if digest is not None:
+        return digest
+    filename = ds.file.filename
+    memo_key = (os.path.abspath(filename), ds.name, ds.shape,
+                os.stat(filename).st_mtime)
+    if memo_key in _digests:
+        return _digests[memo_key]
+
+    builder = DigestBuilder(ds.shape, ds.dtype, ds.attrs.get('sample_rate'),
+                            ds.attrs.get('sample_chunk_size'))
+    for start in range(0, ds.shape[0], block_chunks):
+        builder.add(ds[start:start + block_chunks])
+    digest = builder.hexdigest()
+    _digests[memo_key] = digest
+    return digest
+
+
+class CacheEntry(object):
+    """Read-only view of one cached recording."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST)) as fp:
+            self.manifest = json.load(fp)
+        self.frame_stride = self.manifest['frame_stride']
+        self.num_frames = self.manifest['num_frames']
+
+        self.data = {}
+        self.offsets = {}
+        for name, layout in self.manifest['products'].items():
+            offsets = np.load(os.path.join(path, name + '.offsets.npy'))
+            shape = (int(offsets[-1]),) + tuple(layout['shape'])
+            if shape[0]:
+                self.data[name] = np.memmap(
+                    os.path.join(path, name + '.bin'), mode='r',
+                    dtype=layout['dtype'], shape=shape)
+            else:
+                self.data[name] = np.empty(shape, layout['dtype'])
+            self.offsets[name] = offsets
+
+    def __len__(self):
+        return self.num_frames
+
+    def frame(self, idx):
+        """Products of frame `idx`, in the form of `collect_products`."""
+        products = {}
+        for name, data in self.data.items():
+            start, stop = self.offsets[name][idx:idx + 2]
+            if stop > start:
+                products[name] = data[start:stop]
+        return products
+
+
+class CacheWriter(object):
+    """
+    Append frames of products to a new entry in a temporary directory.
+
+    A product is stored as rows: each frame contributes its array along
+    the first axis (a frame without the product contributes no rows).
+    """
+
+    def __init__(self, cache_dir, frame_stride):
+        self.path = tempfile.mkdtemp(prefix='.tmp_', dir=cache_dir)
+        self.frame_stride = frame_stride
+        self.num_frames = 0
+        self.layouts = {}
+        self.files = {}
+        self.offsets = {}
+
+    def append(self, products):
+        for name, arr in products.items():
+            arr = np.ascontiguousarray(arr)
+            if arr.ndim == 0:
+                arr = arr.reshape(1)
+            if name not in self.files:
+                self.layouts[name] = dict(dtype=arr.dtype.str,
+                                          shape=list(arr.shape[1:]))
+                self.files[name] = open(
+                    os.path.join(self.path, name + '.bin'), 'wb')
+                # Frames recorded before the product first appeared
+                self.offsets[name] = [0] * (self.num_frames + 1)
+            elif (list(arr.shape[1:]) != self.layouts[name]['shape']
+                  or arr.dtype.str != self.layouts[name]['dtype']):
+                raise ValueError('product {} changed shape or type'.format(
+                    name))
+            arr.tofile(self.files[name])
+            self.offsets[name].append(self.offsets[name][-1] + len(arr))
+        self.num_frames += 1
+        # Products missing from this frame get no rows
+        for name, offsets in self.offsets.items():
+            if len(offsets) < self.num_frames + 1:
+                offsets.append(offsets[-1])
+
+    def finish(self):
+        """Close the product files and write the manifest."""
+        for name, fp in self.files.items():
+            fp.close()
+            np.save(os.path.join(self.path, name + '.offsets.npy'),
+                    np.asarray(self.offsets[name], dtype=np.int64))
+        self.files = {}
+        manifest = dict(version=CACHE_VERSION, frame_stride=self.frame_stride,
+                        num_frames=self.num_frames, products=self.layouts)
+        with open(os.path.join(self.path, MANIFEST), 'w') as fp:
+            json.dump(manifest, fp)
+
+    def abort(self):
+        for fp in self.files.values():
+            fp.close()
+        self.files = {}
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class ProductCache(object):
+    """Directory of cache entries with LRU eviction by total size."""
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, budget=DEFAULT_BUDGET):
+        self.cache_dir = cache_dir
+        self.budget = budget
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, ds, config_digest, digest=None):
+        if digest is None:
+            digest = dataset_digest(ds)
+        return '{}-{}'.format(digest, config_digest)
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key):
+        """Return the `CacheEntry` for `key`, or None on a miss."""
+        path = self.entry_path(key)
+        if not os.path.exists(os.path.join(path, MANIFEST)):
+            return None
+        # Entry directory mtime records the last use
+        os.utime(path, None)
+        return CacheEntry(path)
+
+    def writer(self, frame_stride=DEFAULT_FRAME_STRIDE):
+        return CacheWriter(self.cache_dir, frame_stride)
+
+    def commit(self, key, writer):
+        """Publish a finished writer as `key` and enforce the budget."""
+        writer.finish()
+        path = self.entry_path(key)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(writer.path, path)
+        self.evict(keep=key)
+        return CacheEntry(path)
+
+    def entries(self):
+        """List (last_used, size, key) of every committed entry."""
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            path = self.entry_path(key)
+            if key.startswith('.') or not os.path.isdir(path):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, f))
+                       for f in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, key))
+        return entries
+
+    def evict(self, keep=None):
+        """Delete least recently used entries until within the budget."""
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.budget:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self.entry_path(key), ignore_errors=True)
+            total -= size
+        return total
+
+
+class CacheRecorder(object):
+    """
+    Record the products of a dataset playback into a `ProductCache`.
+
+    Connects to the manager's `data_available_signal` after the pipeline,
+    so the products gathered for chunk N already include it.  One frame is
+    recorded every `frame_stride` chunks; the entry is committed once the
+    whole dataset has been played through in order.  Stepping backwards or
+    skipping chunks abandons the recording.
+    """
+
+    def __init__(self, cache, key, data_mgr, receivers, tracker, num_chunks,
+                 frame_stride=DEFAULT_FRAME_STRIDE):
+        self.cache = cache
+        self.key = key
+        self.data_mgr = data_mgr
+        self.receivers = receivers
+        self.tracker = tracker
+        self.num_frames = num_chunks // frame_stride
+        self.frame_stride = frame_stride
+        self.writer = cache.writer(frame_stride)
+        self.last_seq = -1
+        self.entry = None
+        data_mgr.data_available_signal.connect(self.on_data)
+
+    @property
+    def active(self):
+        return self.writer is not None
+
+    def on_data(self, data_tuple):
+        if self.writer is None:
+            return
+        seq = data_tuple[1]
+        if seq != self.last_seq + 1:
+            self.abort()
+            return
+        self.last_seq = seq
+        if (seq + 1) % self.frame_stride:
+            return
+        self.writer.append(
+            telemetry.collect_products(self.receivers, self.tracker))
+        if self.writer.num_frames == self.num_frames:
+            self.entry = self.cache.commit(self.key, self.writer)
+            self.writer = None
+            self.disconnect()
+            print('(product_cache) cached', self.key)
+
+    def disconnect(self):
+        try:
+            self.data_mgr.data_available_signal.disconnect(self.on_data)
+        except (TypeError, RuntimeError):
+            pass
+
+    def abort(self):
+        if self.writer is not None:
+            self.writer.abort()
+            self.writer = None
+        self.disconnect()
+
+
+class CachedPlayer(object):
+    """
+    Play a `CacheEntry` back in real time.
+
+    Exposes the current frame as `self.products` (like `TelemetrySource`),
+    so it can drive a `RemoteGraphPanel`.  `update` advances by the wall
+    time elapsed since the previous call.
+    """
+
+    def __init__(self, entry, frame_period, playback_speed=1.0):
+        self.entry = entry
+        self.frame_period = frame_period
+        self.playback_speed = playback_speed
+        self.paused = False
+        self.position = 0.0     # frames
+        self.last_update = None
+        self.products = entry.frame(0) if len(entry) else {}
+
+    @property
+    def frame_idx(self):
+        return int(self.position)
+
+    def update(self):
+        now = time.time()
+        if not self.paused and self.last_update is not None:
+            self.position += ((now - self.last_update) * self.playback_speed
+                              / self.frame_period)
+            # Loop like dataset playback
+            self.position %= max(len(self.entry), 1)
+        self.last_update = now
+        self.products = self.entry.frame(self.frame_idx)
+        return self.products
+
+    def seek(self, chunk):
+        """Jump to the frame containing chunk index `chunk`."""
+        frame = chunk // self.entry.frame_stride
+        self.position = float(min(max(frame, 0), len(self.entry) - 1))
+        self.products = self.entry.frame(self.frame_idx)
+
+    def step(self, stride=1):
+        self.seek((self.frame_idx + stride) * self.entry.frame_stride)
+
+    def pause_toggle(self):
+        self.paused = not self.paused
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Headless Recording Renderer.
+
+Replays a recorded dataset without a display and renders one image per
+output frame with Qt's offscreen platform.  Range-Doppler maps are
+computed with the headless `dsp.RangeDopplerProcessor`, a `dsp.RangeTracker`
+is updated from their detections every frame, and the products collected
+as for remote telemetry are drawn with the dashboard's `RemoteGraphPanel`:
+a polar tracker panel with annotated tracks over the range-Doppler maps,
+titled with the dataset name, labels, subject and playback time.
+
+The frame range is split into contiguous blocks rendered by separate
+worker processes.  Output is a PNG sequence, optionally encoded into a
+video with ffmpeg (which must be on the PATH):
+
+    python render_recording.py DATABASE sample_3 OUT_DIR [--video clip.mp4]
+
+Author: Jason Merlo
+Maintainer: Jason Merlo (merlojas@msu.edu)
+"""
+import argparse
+import multiprocessing
+import os
+import subprocess
+import types
+
+import h5py
+import numpy as np
+
+import dsp
+import precision
+
+# === CONSTANTS ===============================================================
+# Frames the tracker runs before a worker's first frame, so blocks
+# rendered by different workers do not start with an empty tracker
+TRACK_WARMUP_FRAMES = 30
+# Outer range ring of the tracker panel (m)
+TRACK_MAX_RANGE = 10.0
+
+DEFAULT_FPS = 30
+DEFAULT_SIZE = (1280, 720)
+FRAME_PATTERN = 'frame_{:06d}.png'
+
+
+def frame_blocks(num_frames, workers):
+    """Split range(num_frames) into `workers` contiguous (start, stop)."""
+    edges = np.linspace(0, num_frames, workers + 1).astype(int)
+    return [(int(a), int(b)) for a, b in zip(edges[:-1], edges[1:]) if b > a]
+
+
+def render_block(db_path, name, out_dir, first, stop, hop, size):
+    """
+    Render frames [first, stop) of `/samples/<name>`; runs in a worker.
+
+    Frame k shows the range-Doppler map after chunk (k + 1) * hop - 1.
+    """
+    # Must be set before Qt is loaded in this process
+    os.environ['QT_QPA_PLATFORM'] = 'offscreen'
+    import pyqtgraph as pg
+    from gui_panels import RemoteGraphPanel
+    import telemetry
+
+    app = pg.mkQApp()
+    with h5py.File(db_path, 'r') as db:
+        ds = db['samples'][name]
+        sample_rate = int(ds.attrs.get('sample_rate', dsp.SAMPLE_RATE))
+        chunk_size = ds.shape[-1]
+        annotation = '{}   label: {}   subject: {}'.format(
+            name, dsp.decode_attr(ds, 'label'), dsp.decode_attr(ds, 'subject'))
+
+        processor = dsp.RangeDopplerProcessor(
+            dsp.DAQ_INDEX, sample_rate, dsp.PULSE,
+            fast_fft_size=dsp.FAST_FFT_SIZE,
+            slow_fft_size=dsp.SLOW_FFT_SIZE, slow_fft_len=dsp.SLOW_FFT_SIZE,
+            dtype=np.complex64)
+        tracker = dsp.RangeTracker()
+        # collect_products reads one `range_doppler` per receiver
+        receivers = [types.SimpleNamespace(range_doppler=None)
+                     for _ in dsp.DAQ_INDEX]
+        # Only the last slow_fft_len chunks of a frame reach the map; start
+        # early enough to fill the slow-time history and settle the tracker
+        tail = min(hop, dsp.SLOW_FFT_SIZE)
+        warmup = max(-(-dsp.SLOW_FFT_SIZE // tail) - 1, TRACK_WARMUP_FRAMES)
+        start_frame = max(first - warmup, 0)
+
+        source = RenderSource()
+        window = pg.QtGui.QWidget()
+        layout = pg.QtGui.QVBoxLayout(window)
+        title = pg.QtGui.QLabel()
+        panel = RemoteGraphPanel(source)
+        panel.set_polar_grid(TRACK_MAX_RANGE)
+        layout.addWidget(title)
+        layout.addWidget(panel)
+        window.resize(*size)
+        window.show()
+
+        buf = np.empty((tail,) + ds.shape[1:], np.float32)
+        for frame in range(start_frame, stop):
+            end = (frame + 1) * hop
+            precision.read_native(ds, np.s_[end - tail:end], out=buf)
+            rd = processor.process_batch(buf)
+            seconds = (frame + 1) * hop * chunk_size / float(sample_rate)
+            if rd is not None:
+                tracker.update(seconds, processor.detect())
+                for idx, rx in enumerate(receivers):
+                    rx.range_doppler = rd[idx]
+            if frame < first:
+                continue
+            source.products = telemetry.collect_products(receivers, tracker)
+            title.setText('{}   t = {:.2f} s'.format(annotation, seconds))
+            panel.update()
+            app.processEvents()
+            window.grab().save(os.path.join(out_dir,
+                                            FRAME_PATTERN.format(frame)))
+    window.close()
+    return stop - first
+
+
+class RenderSource(object):
+    """Holds the products shown by `RemoteGraphPanel`."""
+
+    def __init__(self):
+        self.products = {}
+
+
+def encode_video(out_dir, video_path, fps, first=0):
+    """Encode the PNG sequence in `out_dir` starting at frame `first`."""
+    subprocess.check_call([
+        'ffmpeg', '-y', '-loglevel', 'error', '-framerate', str(fps),
+        '-start_number', str(first),
+        '-i', os.path.join(out_dir, FRAME_PATTERN.replace('{:06d}', '%06d')),
+        '-c:v', 'libx264', '-pix_fmt', 'yuv420p',
+        # libx264 needs even frame dimensions
+        '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2', video_path])
+
+
+def render(db_path, name, out_dir, fps=DEFAULT_FPS, start=0.0, duration=None,
+           size=DEFAULT_SIZE, workers=None, video=None):
+    """
+    Render `/samples/<name>` from `start` s for `duration` s (default: to
+    the end) at `fps` frames per second of recording time.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    with h5py.File(db_path, 'r') as db:
+        ds = db['samples'][name]
+        sample_rate = int(ds.attrs.get('sample_rate', dsp.SAMPLE_RATE))
+        chunk_rate = sample_rate / float(ds.shape[-1])
+        num_chunks = ds.shape[0]
+    hop = max(int(round(chunk_rate / fps)), 1)
+    first = int(start * chunk_rate) // hop
+    stop = num_chunks // hop
+    if duration is not None:
+        stop = min(stop, first + int(duration * chunk_rate) // hop)
+    if stop <= first:
+        print('Nothing to render')
+        return 0
+
+    workers = workers or multiprocessing.cpu_count()
+    blocks = frame_blocks(stop - first, workers)
+    # Qt must not be inherited from a forked parent
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(len(blocks)) as pool:
+        results = [pool.apply_async(render_block, (
+            db_path, name, out_dir, first + a, first + b, hop, size))
+            for a, b in blocks]
+        rendered = sum(r.get() for r in results)
+    print('Rendered {} frames of {} to {}'.format(rendered, name, out_dir))
+
+    if video is not None:
+        encode_video(out_dir, video, fps, first)
+        print('Encoded', video)
+    return rendered
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Render a recorded dataset to PNG frames or video '
+                    'without a display')
+    parser.add_argument('database')
+    parser.add_argument('sample', help='dataset name under /samples')
+    parser.add_argument('out_dir', help='directory for the PNG frames')
+    parser.add_argument('--video', metavar='FILE',
+                        help='also encode the frames into FILE with ffmpeg')
+    parser.add_argument('--fps', type=float, default=DEFAULT_FPS)
+    parser.add_argument('--start', type=float, default=0.0,
+                        help='first second of the recording to render')
+    parser.add_argument('--duration', type=float, default=None,
+                        help='seconds to render (default: to the end)')
+    parser.add_argument('--size', type=int, nargs=2, default=DEFAULT_SIZE,
+                        metavar=('W', 'H'))
+    parser.add_argument('--workers', type=int, default=None,
+                        help='render processes (default: all cores)')
+    args = parser.parse_args()
+
+    render(args.database, args.sample, args.out_dir, fps=args.fps,
+           start=args.start, duration=args.duration, size=tuple(args.size),
+           workers=args.workers, video=args.video)
+
+
+if __name__ == '__main__':
+    main()
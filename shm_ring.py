@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""
+Shared-Memory Ring Buffer.
+
+A single-writer, multi-reader ring of raw ADC chunks living in a
+`multiprocessing.shared_memory` block.  The acquisition side writes each
+chunk once; DSP workers, the recorder and the GUI attach by name, keep
+their own read cursor and get zero-copy numpy views of the chunks, so no
+sample data is pickled through queues.
+
+Layout of the shared block:
+
+    header  uint64[8]   write_seq, slots, channels, chunk_size, ...
+    seqs    uint64[slots]       sequence number held in each slot
+    times   float64[slots]      acquisition timestamp of each slot
+    data    float32[slots, channels, chunk_size]
+
+The writer fills a slot and only then publishes it by advancing
+`write_seq`; readers never take locks.  The slot after the newest chunk
+is the one being overwritten next, so at most `slots - 1` chunks can be
+read back.  A reader that falls further behind skips forward and counts
+the overrun.  Because a slow reader may have its view overwritten while
+still using it, readers should call `still_valid` after processing a view.
+
+The fusion head workers read a ring with `--head ring:NAME@X,Y`.
+
+Requires Python 3.8+ for `multiprocessing.shared_memory`.
+
+Author: Jason Merlo
+Maintainer: Jason Merlo (merlojas@msu.edu)
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:
+    shared_memory = None
+
+# === CONSTANTS ===============================================================
+DEFAULT_NAME = 'aps_dashboard_ring'
+DEFAULT_SLOTS = 1 << 14
+
+HEADER_WORDS = 8
+H_WRITE_SEQ, H_SLOTS, H_CHANNELS, H_CHUNK = range(4)
+
+
+class SharedRing(object):
+    """Map the header, slot tables and data of a ring onto a shared block."""
+
+    def __init__(self, shm):
+        self.shm = shm
+        buf = shm.buf
+        self.header = np.ndarray((HEADER_WORDS,), np.uint64, buf)
+        slots, channels, chunk = (int(v) for v in self.header[1:4])
+        self.slots = slots
+
+        offset = self.header.nbytes
+        self.seqs = np.ndarray((slots,), np.uint64, buf, offset)
+        offset += self.seqs.nbytes
+        self.times = np.ndarray((slots,), np.float64, buf, offset)
+        offset += self.times.nbytes
+        self.data = np.ndarray((slots, channels, chunk), np.float32, buf,
+                               offset)
+
+    @staticmethod
+    def nbytes(slots, channels, chunk):
+        return (8 * HEADER_WORDS + 16 * slots
+                + 4 * slots * channels * chunk)
+
+    @property
+    def write_seq(self):
+        return int(self.header[H_WRITE_SEQ])
+
+    def close(self):
+        # Views must be released before the mapping can be closed
+        self.header = self.seqs = self.times = self.data = None
+        self.shm.close()
+
+
+def _require_shared_memory():
+    if shared_memory is None:
+        raise RuntimeError('shared-memory ring needs Python 3.8 or newer '
+                           '(running {}.{})'.format(*sys.version_info[:2]))
+
+
+class RingWriter(SharedRing):
+    """
+    Create a ring and append chunks to it.
+
+    With `replace`, a block left under `name` by a writer that did not
+    close (e.g. a crashed dashboard) is unlinked and created again.
+    """
+
+    def __init__(self, channels, chunk_size, slots=DEFAULT_SLOTS,
+                 name=DEFAULT_NAME, replace=False):
+        _require_shared_memory()
+        size = SharedRing.nbytes(slots, channels, chunk_size)
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True,
+                                             size=size)
+        except FileExistsError:
+            if not replace:
+                raise
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            shm = shared_memory.SharedMemory(name=name, create=True,
+                                             size=size)
+        header = np.ndarray((HEADER_WORDS,), np.uint64, shm.buf)
+        header[:] = 0
+        header[H_SLOTS] = slots
+        header[H_CHANNELS] = channels
+        header[H_CHUNK] = chunk_size
+        del header
+        super(RingWriter, self).__init__(shm)
+        self.name = shm.name
+
+    def write(self, chunk, timestamp=None):
+        """Copy one `(channels, chunk_size)` chunk into the ring."""
+        seq = self.write_seq
+        slot = seq % self.slots
+        self.data[slot] = chunk
+        self.times[slot] = time.time() if timestamp is None else timestamp
+        self.seqs[slot] = seq
+        # Publish only after the slot is complete
+        self.header[H_WRITE_SEQ] = seq + 1
+        return seq
+
+    def on_data(self, data_tuple):
+        """Slot for a DAQ `data_available_signal` emitting (data, seq)."""
+        self.write(data_tuple[0])
+
+    def close(self):
+        super(RingWriter, self).close()
+        self.shm.unlink()
+
+
+class RingReader(SharedRing):
+    """
+    Attach to an existing ring with an independent cursor.
+
+    New readers start at the newest chunk unless `from_start` is set, in
+    which case they start at the oldest chunk that is not being
+    overwritten.
+    """
+
+    def __init__(self, name=DEFAULT_NAME, from_start=False):
+        _require_shared_memory()
+        shm = shared_memory.SharedMemory(name=name)
+        # Readers do not own the block; stop the resource tracker from
+        # unlinking it when this process exits
+        try:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        except Exception:
+            pass
+        super(RingReader, self).__init__(shm)
+        head = self.write_seq
+        self.cursor = self.oldest(head) if from_start else head
+        self.overruns = 0
+        self.missed = 0
+
+    def oldest(self, head):
+        """Oldest readable chunk; slot `head % slots` is being written."""
+        return max(head - self.slots + 1, 0)
+
+    def available(self):
+        return self.write_seq - self.cursor
+
+    def read(self, max_count=1):
+        """
+        Return (seq, times, data) views of up to `max_count` new chunks.
+
+        The views are contiguous, so a batch stops at the end of the ring;
+        the next call continues from the start.  Returns None if no new
+        chunk has been written.
+        """
+        head = self.write_seq
+        if self.cursor < self.oldest(head):
+            # Fell behind far enough that unread chunks were overwritten
+            self.overruns += 1
+            self.missed += self.oldest(head) - self.cursor
+            self.cursor = self.oldest(head)
+        count = min(head - self.cursor, max_count)
+        if count <= 0:
+            return None
+
+        seq = self.cursor
+        start = seq % self.slots
+        count = min(count, self.slots - start)
+        self.cursor += count
+        return (seq, self.times[start:start + count],
+                self.data[start:start + count])
+
+    def wait(self, max_count=1, timeout=None, poll=0.0005):
+        """Like `read`, but poll until data arrives or `timeout` expires."""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            item = self.read(max_count)
+            if item is not None:
+                return item
+            if deadline is not None and time.time() > deadline:
+                return None
+            time.sleep(poll)
+
+    def still_valid(self, seq):
+        """True if chunk `seq` has not been (or is not being) overwritten."""
+        # The writer fills slot write_seq % slots before publishing it
+        return self.write_seq - seq < self.slots
+
+
+# === OVERRUN SELF-TEST =======================================================
+def _overrun_test(slots=64):
+    """
+    Overrun a reader and check it never returns the slot being written.
+
+    Every chunk is filled with its own sequence number; the writer is left
+    part-way through the next chunk, which reuses the oldest slot.
+    """
+    writer = RingWriter(2, 4, slots=slots,
+                        name='{}_test_{:d}'.format(DEFAULT_NAME, os.getpid()))
+    reader = RingReader(writer.name)
+    try:
+        for seq in range(3 * slots):
+            writer.write(np.full((2, 4), seq, np.float32))
+        # Torn, unpublished chunk
+        writer.data[writer.write_seq % slots] = -1
+
+        late = RingReader(writer.name, from_start=True)
+        for ring in (reader, late):
+            seen = []
+            item = ring.read(slots)
+            while item is not None:
+                seq, times, data = item
+                expected = seq + np.arange(len(data))
+                assert (data == expected[:, None, None]).all(), \
+                    'torn slot returned at {}'.format(seq)
+                seen.extend(expected.tolist())
+                item = ring.read(slots)
+            assert seen == list(range(2 * slots + 1, 3 * slots)), seen
+        assert reader.overruns == 1 and reader.missed == 2 * slots + 1
+        late.close()
+    finally:
+        reader.close()
+        writer.close()
+    print('overrun test passed ({} slots)'.format(slots))
+
+
+def main():
+    """Attach to a ring and report the rate seen by an independent reader."""
+    parser = argparse.ArgumentParser(
+        description='Report the chunk rate of a shared-memory ring')
+    parser.add_argument('name', nargs='?', default=DEFAULT_NAME)
+    parser.add_argument('--test', action='store_true',
+                        help='run the overrun self-test instead')
+    args = parser.parse_args()
+    if args.test:
+        _overrun_test()
+        return
+
+    name = args.name
+    reader = RingReader(name)
+    print('Attached to {} ({} slots of {})'.format(
+        name, reader.slots, reader.data.shape[1:]))
+    count = 0
+    last = time.time()
+    try:
+        while True:
+            item = reader.wait(max_count=256, timeout=1.0)
+            if item is not None:
+                count += len(item[2])
+            now = time.time()
+            if now - last >= 1.0:
+                print('{:.0f} chunks/s, overruns={}, missed={}'.format(
+                    count / (now - last), reader.overruns, reader.missed))
+                count = 0
+                last = now
+    except KeyboardInterrupt:
+        pass
+    reader.close()
+
+
+if __name__ == '__main__':
+    main()
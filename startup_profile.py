@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Startup Profiling and Lazy Imports.
+
+Provides `lazy_import`, which defers loading a module until one of its
+attributes is first used, and a small profiler reporting where dashboard
+start-up time goes (imports and start-up milestones).
+
+Profiling is enabled with `--profile-startup` and must be installed before
+any heavy imports, so this module only depends on the standard library.
+
+Author: Jason Merlo
+Maintainer: Jason Merlo (merlojas@msu.edu)
+"""
+import builtins
+import collections
+import importlib
+import sys
+import threading
+import time
+import types
+
+# === CONSTANTS ===============================================================
+# Number of slowest imports listed in the report
+REPORT_IMPORTS = 15
+
+
+class StartupProfiler(object):
+    """Collect import times and start-up milestones."""
+
+    def __init__(self):
+        self.enabled = False
+        self.start = time.perf_counter()
+        # Import nesting depth of each thread, so imports made by background
+        # loader threads do not disturb the main thread's breakdown
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.import_times = collections.defaultdict(float)
+        self.original_import = None
+
+    def install(self):
+        """Start timing every top-level import statement."""
+        self.enabled = True
+        self.original_import = builtins.__import__
+        builtins.__import__ = self.timed_import
+
+    def uninstall(self):
+        if self.original_import is not None:
+            builtins.__import__ = self.original_import
+            self.original_import = None
+
+    def enter(self):
+        """Start timing an import on the calling thread."""
+        self.local.depth = getattr(self.local, 'depth', 0) + 1
+        return time.perf_counter()
+
+    def leave(self, name, start):
+        """
+        Finish timing an import started with `enter`.
+
+        Only imports made directly by application code are charged; nested
+        imports are included in their parent's time.
+        """
+        self.local.depth -= 1
+        if self.local.depth == 0:
+            self.record_import(name, time.perf_counter() - start)
+
+    def timed_import(self, name, globals=None, locals=None, fromlist=(),
+                     level=0):
+        start = self.enter()
+        try:
+            return self.original_import(name, globals, locals, fromlist,
+                                        level)
+        finally:
+            self.leave(name, start)
+
+    def record_import(self, name, elapsed):
+        if self.enabled:
+            with self.lock:
+                self.import_times[name] += elapsed
+
+    def mark(self, label):
+        """Print the time elapsed since start-up for a milestone."""
+        if self.enabled:
+            print('(startup) {:7.3f} s  {}'.format(
+                time.perf_counter() - self.start, label))
+
+    def report(self):
+        """Print the slowest imports seen so far."""
+        if not self.enabled:
+            return
+        total = sum(self.import_times.values())
+        print('(startup) imports: {:.3f} s total'.format(total))
+        slowest = sorted(self.import_times.items(), key=lambda kv: -kv[1])
+        for name, elapsed in slowest[:REPORT_IMPORTS]:
+            print('(startup) {:7.3f} s  import {}'.format(elapsed, name))
+
+
+profiler = StartupProfiler()
+
+
+def install(enabled=None):
+    """Enable profiling if requested on the command line."""
+    if enabled is None:
+        enabled = '--profile-startup' in sys.argv
+    if enabled:
+        profiler.install()
+    return profiler
+
+
+class LazyModule(types.ModuleType):
+    """Module placeholder that imports the real module on first use."""
+
+    def __init__(self, name):
+        super(LazyModule, self).__init__(name)
+        self.__dict__['_lazy_loaded'] = False
+
+    def __getattr__(self, attr):
+        # Only called for attributes not yet copied from the real module
+        if self.__dict__['_lazy_loaded']:
+            raise AttributeError(attr)
+        module = import_timed(self.__name__)
+        self.__dict__.update(module.__dict__)
+        self.__dict__['_lazy_loaded'] = True
+        return getattr(module, attr)
+
+
+def import_timed(name):
+    """Import `name`, charging nested imports to it as `timed_import` does."""
+    start = profiler.enter()
+    try:
+        return importlib.import_module(name)
+    finally:
+        profiler.leave(name, start)
+
+
+def lazy_import(name):
+    """Return `name` as a module that is only imported when first used."""
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
+
+
+def preload(modules):
+    """
+    Import `modules` (names or lazy modules) on a background thread.
+
+    Returns a `threading.Event` set once all have been tried, so the GUI
+    thread can keep drawing meanwhile and only then touch them.  Import
+    errors are left to be raised again where the module is first used.
+    """
+    names = [getattr(m, '__name__', m) for m in modules]
+    done = threading.Event()
+
+    def run():
+        for name in names:
+            try:
+                import_timed(name)
+            except Exception:
+                pass
+        done.set()
+
+    threading.Thread(target=run, daemon=True).start()
+    return done
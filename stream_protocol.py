@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Stream Protocol.
+
+Compact binary framing used to move numpy arrays between dashboard
+processes over plain TCP sockets.
+
+Every frame is a fixed header followed by a payload holding one or more
+named arrays.  Array data is padded to 8-byte boundaries so the receiving
+side can decode it with `np.frombuffer` without copying.
+
+    frame   := HEADER payload
+    HEADER  := magic(4s) version(B) kind(B) num_arrays(H)
+               seq(Q) timestamp(d) payload_len(I)
+    payload := { ARRAY_HEADER name dtype shape pad data pad }*
+
+Author: Jason Merlo
+Maintainer: Jason Merlo (merlojas@msu.edu)
+"""
+import struct
+import time
+
+import numpy as np
+
+# === CONSTANTS ===============================================================
+MAGIC = b'APSD'
+VERSION = 1
+
+# Frame kinds
+KIND_PRODUCTS = 1       # processed products (range-Doppler, tracks, ...)
+KIND_RAW_CHUNK = 2      # raw 8-channel ADC chunk
+KIND_CREDIT = 3         # flow-control credit returned by a consumer
+
+HEADER = struct.Struct('<4sBBHQdI')
+ARRAY_HEADER = struct.Struct('<BBB')   # name_len, dtype_len, ndim
+ALIGN = 8
+
+
+class ProtocolError(Exception):
+    """Raised when a malformed frame is received."""
+
+
+def _pad(length):
+    return (-length) % ALIGN
+
+
+def encode_frame(kind, seq, arrays, timestamp=None):
+    """
+    Encode a dict of named arrays into a single frame.
+
+    Returns a `bytes` object ready to be passed to `socket.sendall`.
+    """
+    if timestamp is None:
+        timestamp = time.time()
+
+    parts = []
+    payload_len = 0
+    for name, value in arrays.items():
+        # tobytes() always emits C order, so no contiguous copy is needed
+        arr = np.asarray(value)
+        name_b = name.encode('utf-8')
+        dtype_b = arr.dtype.str.encode('ascii')
+        meta = (ARRAY_HEADER.pack(len(name_b), len(dtype_b), arr.ndim)
+                + name_b + dtype_b
+                + struct.pack('<{:d}I'.format(arr.ndim), *arr.shape))
+        meta += b'\x00' * _pad(len(meta))
+        data = arr.tobytes()
+        parts.append(meta)
+        parts.append(data)
+        parts.append(b'\x00' * _pad(len(data)))
+        payload_len += len(meta) + len(data) + _pad(len(data))
+
+    header = HEADER.pack(MAGIC, VERSION, kind, len(arrays), seq,
+                         timestamp, payload_len)
+    return header + b''.join(parts)
+
+
+def decode_header(buf):
+    """Return (kind, num_arrays, seq, timestamp, payload_len) from a header."""
+    magic, version, kind, num_arrays, seq, timestamp, payload_len = \
+        HEADER.unpack_from(buf)
+    if magic != MAGIC:
+        raise ProtocolError('bad frame magic: {!r}'.format(magic))
+    if version != VERSION:
+        raise ProtocolError('unsupported frame version: {}'.format(version))
+    return kind, num_arrays, seq, timestamp, payload_len
+
+
+def decode_payload(payload, num_arrays):
+    """
+    Decode the payload of a frame into a dict of arrays.
+
+    The returned arrays are views into `payload`; no sample data is copied.
+    """
+    arrays = {}
+    view = memoryview(payload)
+    offset = 0
+    for _ in range(num_arrays):
+        start = offset
+        name_len, dtype_len, ndim = ARRAY_HEADER.unpack_from(view, offset)
+        offset += ARRAY_HEADER.size
+        name = bytes(view[offset:offset + name_len]).decode('utf-8')
+        offset += name_len
+        dtype = np.dtype(bytes(view[offset:offset + dtype_len]).decode())
+        offset += dtype_len
+        shape = struct.unpack_from('<{:d}I'.format(ndim), view, offset)
+        offset += 4 * ndim
+        offset += _pad(offset - start)
+
+        count = int(np.prod(shape)) if ndim else 1
+        nbytes = count * dtype.itemsize
+        if offset + nbytes > len(view):
+            raise ProtocolError('truncated array: {}'.format(name))
+        arr = np.frombuffer(view, dtype=dtype, count=count, offset=offset)
+        arrays[name] = arr.reshape(shape)
+        offset += nbytes + _pad(nbytes)
+    return arrays
+
+
+def decode_frame(buf):
+    """Decode a complete frame held in `buf`."""
+    kind, num_arrays, seq, timestamp, payload_len = decode_header(buf)
+    payload = memoryview(buf)[HEADER.size:HEADER.size + payload_len]
+    return kind, seq, timestamp, decode_payload(payload, num_arrays)
+
+
+# === SOCKET HELPERS ==========================================================
+def recv_exact(sock, buf):
+    """
+    Fill `buf` (a writable buffer) from `sock`.
+
+    Returns False if the peer closed the connection before `buf` was full.
+    """
+    view = memoryview(buf)
+    while len(view):
+        n = sock.recv_into(view)
+        if n == 0:
+            return False
+        view = view[n:]
+    return True
+
+
+def recv_frame(sock):
+    """
+    Receive one frame from `sock`.
+
+    Returns (kind, seq, timestamp, arrays), or None once the peer has
+    closed the connection.  Each frame is received into its own buffer so
+    the decoded arrays remain valid after the next call.
+    """
+    header = bytearray(HEADER.size)
+    if not recv_exact(sock, header):
+        return None
+    kind, num_arrays, seq, timestamp, payload_len = decode_header(header)
+    payload = bytearray(payload_len)
+    if not recv_exact(sock, payload):
+        return None
+    return kind, seq, timestamp, decode_payload(payload, num_arrays)
+
+
+def send_frame(sock, kind, seq, arrays, timestamp=None):
+    """Encode and send one frame on `sock`."""
+    sock.sendall(encode_frame(kind, seq, arrays, timestamp))
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Remote Telemetry Classes.
+
+Streams processed radar products (range-Doppler frames, detections and
+tracker state) from the acquisition host to any number of remote viewers
+over plain TCP, using the framing defined in `stream_protocol`.
+
+Run `python telemetry.py` to exercise a publisher and subscriber over
+loopback without any radar hardware.
+
+Author: Jason Merlo
+Maintainer: Jason Merlo (merlojas@msu.edu)
+"""
+import queue
+import socket
+import threading
+import time
+import warnings
+
+import numpy as np
+
+from pyratk.acquisition import daq    # DAQ base class
+
+import stream_protocol as sp
+
+# === CONSTANTS ===============================================================
+DEFAULT_PORT = 5557
+# Frames queued per viewer before new frames are dropped for that viewer
+DEFAULT_MAX_PENDING = 8
+
+
+def check_pipeline(receivers, tracker):
+    """
+    Check once that the pipeline has the attributes `collect_products` reads.
+
+    Warns about each missing product and raises AttributeError if none are
+    found, since the publisher would otherwise never send anything.
+    """
+    missing = []
+    if not any(hasattr(rx, 'range_doppler') for rx in receivers):
+        missing.append('receiver.range_doppler')
+    for name in ('detections', 'tracks'):
+        if not hasattr(tracker, name):
+            missing.append('tracker.' + name)
+    if len(missing) == 3:
+        raise AttributeError('pipeline has none of the published products '
+                             '({})'.format(', '.join(missing)))
+    for name in missing:
+        warnings.warn('(telemetry) {} not found; it will not be '
+                      'published'.format(name))
+
+
+def collect_products(receivers, tracker):
+    """
+    Gather the latest processed products from the live pipeline.
+
+    Returns a dict of named arrays suitable for `TelemetryPublisher.publish`.
+    Products which have not been computed yet are skipped.
+    """
+    products = {}
+    for idx, rx in enumerate(receivers):
+        rd = getattr(rx, 'range_doppler', None)
+        if rd is not None:
+            products['range_doppler_{:d}'.format(idx)] = np.abs(rd).astype(
+                np.float32)
+
+    detections = getattr(tracker, 'detections', None)
+    if detections is not None and len(detections):
+        products['detections'] = np.asarray(detections, dtype=np.float32)
+
+    tracks = getattr(tracker, 'tracks', None)
+    if tracks is not None and len(tracks):
+        products['tracks'] = np.asarray(
+            [np.asarray(t.state, dtype=np.float32).ravel() for t in tracks])
+    return products
+
+
+class TelemetryPublisher(object):
+    """
+    Fan-out TCP server for processed products.
+
+    Each frame is encoded once and queued to every connected viewer.  A
+    viewer that cannot keep up has frames dropped rather than stalling the
+    acquisition host.
+    """
+
+    def __init__(self, host='0.0.0.0', port=DEFAULT_PORT,
+                 max_pending=DEFAULT_MAX_PENDING):
+        self.max_pending = max_pending
+        self.seq = 0
+        self.dropped = 0
+        self.clients = []
+        self.lock = threading.Lock()
+        self.running = True
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(4)
+        # Actual port, in case port 0 was requested
+        self.port = self.server.getsockname()[1]
+
+        self.t_accept = threading.Thread(target=self.accept_loop, daemon=True)
+        self.t_accept.start()
+
+    def accept_loop(self):
+        while self.running:
+            try:
+                conn, addr = self.server.accept()
+            except OSError:
+                break
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            pending = queue.Queue(self.max_pending)
+            with self.lock:
+                self.clients.append(pending)
+            print('(telemetry) viewer connected:', addr)
+            threading.Thread(target=self.send_loop, args=(conn, pending),
+                             daemon=True).start()
+
+    def send_loop(self, conn, pending):
+        try:
+            while True:
+                frame = pending.get()
+                if frame is None:
+                    break
+                conn.sendall(frame)
+        except OSError as e:
+            print('(telemetry) viewer disconnected:', e)
+        finally:
+            with self.lock:
+                if pending in self.clients:
+                    self.clients.remove(pending)
+            conn.close()
+
+    def publish(self, products, kind=sp.KIND_PRODUCTS):
+        """Queue one frame of products to every connected viewer."""
+        if not products:
+            return
+        with self.lock:
+            clients = list(self.clients)
+        if not clients:
+            return
+
+        frame = sp.encode_frame(kind, self.seq, products)
+        self.seq += 1
+        for pending in clients:
+            try:
+                pending.put_nowait(frame)
+            except queue.Full:
+                self.dropped += 1
+
+    def close(self):
+        self.running = False
+        self.server.close()
+        with self.lock:
+            for pending in self.clients:
+                try:
+                    pending.put_nowait(None)
+                except queue.Full:
+                    pass
+            self.clients = []
+
+
+class TelemetrySource(daq.DAQ):
+    """
+    DataManager source that subscribes to a `TelemetryPublisher`.
+
+    The most recent frame is kept in `self.products`, a dict of named
+    arrays, for widgets such as `RemoteGraphPanel` to poll.  Frames are not
+    emitted on `data_available_signal`: the `DataManager` appends everything
+    emitted there to its buffer, which would keep every frame for the
+    lifetime of the viewer.
+    """
+
+    def __init__(self, host, port=DEFAULT_PORT, sample_rate=None,
+                 sample_chunk_size=None):
+        super(TelemetrySource, self).__init__()
+        self.daq_type = 'Telemetry ({}:{})'.format(host, port)
+        self.sample_rate = sample_rate
+        self.sample_chunk_size = sample_chunk_size
+        self.host = host
+        self.port = port
+
+        self.products = {}
+        self.timestamp = None
+        self.missed = 0
+        self.last_seq = None
+
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def get_samples(self, stride=1, loop=-1, playback_speed=1):
+        """Block until the next frame arrives, then make it current."""
+        try:
+            frame = sp.recv_frame(self.sock)
+        except OSError:
+            frame = None
+        if frame is None:
+            print('(telemetry) publisher closed the stream')
+            self.running = False
+            return
+
+        kind, seq, timestamp, products = frame
+        if self.last_seq is not None and seq > self.last_seq + 1:
+            self.missed += seq - self.last_seq - 1
+        self.last_seq = seq
+
+        self.products = products
+        self.timestamp = timestamp
+        self.sample_num = seq
+
+    def close(self):
+        self.running = False
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+# === LOOPBACK SELF-TEST ======================================================
+def _loopback_test(num_frames=100):
+    """Publish synthetic products over loopback and check they round-trip."""
+    pub = TelemetryPublisher(host='127.0.0.1', port=0)
+    sub = socket.create_connection(('127.0.0.1', pub.port))
+    # Wait for the publisher to register the viewer
+    while not pub.clients:
+        time.sleep(0.01)
+
+    rd = np.random.rand(32, 1024).astype(np.float32)
+    start = time.time()
+    for i in range(num_frames):
+        pub.publish({'range_doppler_0': rd, 'tracks': np.eye(1, 4) * i})
+        kind, seq, timestamp, products = sp.recv_frame(sub)
+        assert seq == i
+        assert np.array_equal(products['range_doppler_0'], rd)
+        assert products['tracks'][0, 0] == i
+    elapsed = time.time() - start
+
+    sub.close()
+    pub.close()
+    print('{:d} frames round-tripped in {:.3f} s ({:.1f} MB/s)'.format(
+        num_frames, elapsed, num_frames * rd.nbytes / elapsed / 1e6))
+
+
+if __name__ == '__main__':
+    _loopback_test()